@@ -0,0 +1,7 @@
+-- upgrade a database created before corpora had the phrase_dictionary column.
+-- run once before ingesting with this version: PhraseSequencer reads and sets
+-- the column, see Corpus.phrase_dictionary_token().
+-- existing corpora start without a token, so their phrase dictionaries are
+-- rebuilt from the phrases table when next opened.
+
+alter table corpora add column phrase_dictionary varchar;
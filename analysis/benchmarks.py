@@ -0,0 +1,286 @@
+"""Timings for the hot spots of the ingestion and clustering pipeline.
+
+Run through the management command, e.g.
+
+    ./manage.py benchmark similarity --docs 5000
+    ./manage.py benchmark similarity --corpus 123
+    ./manage.py benchmark parse --processes 8
+    ./manage.py benchmark load --corpus 123
+    ./manage.py benchmark copy --docs 5000 --upload
+    ./manage.py benchmark partition --docs 1000000
+    ./manage.py benchmark codec --corpus 123
+
+Each benchmark takes the command's options and prints a small report.
+Without --corpus a synthetic corpus is generated, so no database is needed.
+"""
+
+import time
+import multiprocessing
+from random import Random
+
+import ingestion
+import similarity
+
+
+def synthetic_docs(num_docs, doc_size=300, copies=10, vocabulary=1000000, max_noise=0.8, boilerplate=0, seed=0):
+    """Return noisy copies of random phrase sets, roughly like a docket full of form letters.
+
+    If boilerplate is given, every other document also gets up to that many
+    phrases from a list shared by the whole corpus.
+    """
+
+    random = Random(seed)
+    docs = {}
+    while len(docs) < num_docs:
+        template = random.sample(xrange(vocabulary), doc_size)
+        for _ in range(copies):
+            noise = random.uniform(0, max_noise)
+            phrases = set(p for p in template if random.random() > noise)
+            phrases.update(random.sample(xrange(vocabulary), doc_size - len(phrases)))
+            if boilerplate and len(docs) % 2 == 0:
+                phrases.update(xrange(vocabulary, vocabulary + random.randint(1, boilerplate)))
+            docs[len(docs)] = sorted(phrases)
+
+    return docs
+
+
+def _timed(f, *args, **kwargs):
+    start = time.time()
+    result = f(*args, **kwargs)
+    return (result, time.time() - start)
+
+
+def _load_docs(options):
+    if options.get('corpus'):
+        from corpus import Corpus
+        return Corpus(int(options['corpus'])).all_docs()
+
+    return synthetic_docs(int(options.get('docs') or 1000))
+
+
+def _report(name, seconds, baseline_seconds, extra=""):
+    speedup = baseline_seconds / seconds if seconds else float('inf')
+    print "%-12s %10.2fs %8.1fx  %s" % (name, seconds, speedup, extra)
+
+
+def bench_similarity(options):
+    """Compare each similarity engine against the exhaustive pair loop."""
+
+    docs = _load_docs(options)
+    new_doc_ids = docs.keys()
+    min_similarity = float(options.get('min_similarity') or 0.5)
+    print "%s documents, min_similarity=%s" % (len(docs), min_similarity)
+
+    (expected, baseline) = _timed(lambda: set((x, y) for (x, y, _) in similarity.exhaustive(docs, new_doc_ids, min_similarity)))
+    _report('exhaustive', baseline, baseline, "%s pairs" % len(expected))
+
+    for name in sorted(similarity.ENGINES):
+        if name == 'exhaustive':
+            continue
+        try:
+            engine = similarity.engine_by_name(name)
+        except ImportError, e:
+            print "%-12s skipped: %s" % (name, e)
+            continue
+        (found, seconds) = _timed(lambda: set((x, y) for (x, y, _) in engine(docs, new_doc_ids, min_similarity)))
+        recall = float(len(found & expected)) / len(expected) if expected else 1.0
+        _report(name, seconds, baseline, "%s pairs, recall %.4f, %s spurious" % (len(found), recall, len(found - expected)))
+
+
+def bench_parse(options):
+    """Time serial against pooled parsing of synthetic text, and check the output matches."""
+
+    from parser import ngram_parser, sentence_parse
+
+    random = Random(0)
+    words = ["w%s" % i for i in range(5000)]
+    texts = [". ".join(" ".join(random.sample(words, 12)) for _ in range(20)) + "." for _ in range(int(options.get('docs') or 1000))]
+    processes = int(options.get('processes') or multiprocessing.cpu_count())
+    print "%s documents, %s processes" % (len(texts), processes)
+
+    for (name, parser) in [('sentence', sentence_parse), ('4-gram', ngram_parser(4))]:
+        results = []
+        for p in (1, processes):
+            # a fresh sequencer numbers phrases just like the recorder
+            sequencer = ingestion._PhraseRecorder()
+            pool = ingestion._parse_pool(parser, p) if p > 1 else None
+            try:
+                results.append(_timed(ingestion.parse_texts, texts, parser, sequencer, pool, p))
+            finally:
+                if pool:
+                    pool.terminate()
+        (serial, serial_seconds), (pooled, pooled_seconds) = results
+        _report(name, serial_seconds, serial_seconds, "serial")
+        _report(name, pooled_seconds, serial_seconds, "%s processes, %s" % (processes, "identical" if serial == pooled else "MISMATCH"))
+
+
+def bench_load(options):
+    """Time Corpus.all_docs() against the compact Corpus.all_docs_csr(). Needs --corpus."""
+
+    if not options.get('corpus'):
+        print "The load benchmark needs a corpus."
+        return
+
+    from corpus import Corpus
+    corpus = Corpus(int(options['corpus']))
+
+    (compact, compact_seconds) = _timed(corpus.all_docs_csr)
+    (docs, seconds) = _timed(corpus.all_docs)
+    compact_bytes = compact.doc_ids.nbytes + compact.offsets.nbytes + compact.phrases.nbytes
+
+    _report('all_docs', seconds, seconds, "%s documents, %s occurrences" % (len(docs), len(compact.phrases)))
+    _report('all_docs_csr', compact_seconds, seconds, "%.1f MB of arrays" % (compact_bytes / 1e6))
+
+
+def _parsed_docs(num_docs, seed=0):
+    """Return (text, phrases, metadata) for documents shaped like a 4-gram parse."""
+
+    random = Random(seed)
+    docs = []
+    for doc_id in xrange(num_docs):
+        text = u" ".join(u"word%s" % random.randint(0, 10000) for _ in range(300))
+        phrases = [(phrase_id, [(j * 10, j * 10 + 9) for j in range(random.randint(1, 3))]) for phrase_id in range(random.randint(50, 200))]
+        docs.append((text, phrases, dict(document_id="DOC-%s" % doc_id, title=u"T\xeftle")))
+    return docs
+
+
+def bench_copy(options):
+    """Time writing parsed documents to CSV and to binary COPY files.
+
+    With --upload, also time uploading them to new corpora, in a
+    transaction that's rolled back.
+    """
+
+    docs = _parsed_docs(int(options.get('docs') or 1000))
+    print "%s documents, %s occurrences" % (len(docs), sum(len(phrases) for (_, phrases, _) in docs))
+
+    def run(new_corpus):
+        baseline = None
+        for copy_format in ('csv', 'binary'):
+            corpus = new_corpus()
+            corpus_id = corpus.id if corpus else 0
+
+            if copy_format == 'binary':
+                files = ingestion.BinaryDocumentFiles(corpus_id, corpus.type_oid('int_bounds') if corpus else 0)
+            else:
+                files = ingestion.CSVDocumentFiles(corpus_id)
+
+            seconds = _timed(lambda: [files.write(doc_id, text, phrases, metadata) for (doc_id, (text, phrases, metadata)) in enumerate(docs)])[1]
+            size = files.size()
+            if corpus:
+                seconds += _timed(files.upload, corpus)[1]
+
+            baseline = baseline or seconds
+            _report(copy_format, seconds, baseline, "%.1f MB, %.0f documents/s" % (size / 1e6, len(docs) / seconds))
+
+    if not options.get('upload'):
+        run(lambda: None)
+        return
+
+    from django.db import transaction
+    from corpus import Corpus
+
+    with transaction.commit_manually():
+        try:
+            run(lambda: Corpus(metadata=dict(benchmark='copy')))
+        finally:
+            transaction.rollback()
+
+
+def _synthetic_pairs(num_docs, num_pairs, seed=0):
+    """Return pairs of documents within runs of consecutive documents, averaging 50 documents a run."""
+
+    import numpy
+    random = numpy.random.RandomState(seed)
+
+    ends = numpy.cumsum(random.geometric(0.02, num_docs))
+    ends = numpy.append(ends[ends < num_docs], num_docs)
+    starts = numpy.concatenate([[0], ends[:-1]])
+
+    xs = random.randint(0, num_docs, num_pairs)
+    runs = numpy.searchsorted(ends, xs, 'right')
+    ys = starts[runs] + (random.random_sample(num_pairs) * (ends[runs] - starts[runs])).astype(int)
+    return (xs.astype(numpy.int32), ys.astype(numpy.int32))
+
+
+def bench_partition(options):
+    """Time merging similar pairs and listing the sets with each Partition implementation."""
+
+    from partition import Partition
+    from npartition import NumpyPartition
+
+    num_docs = int(options.get('docs') or 100000)
+    (xs, ys) = _synthetic_pairs(num_docs, 2 * num_docs)
+    print "%s documents, %s pairs" % (num_docs, len(xs))
+
+    def merge_each(p):
+        for (x, y) in zip(xs.tolist(), ys.tolist()):
+            p.merge(x, y)
+
+    implementations = [('partition', Partition, merge_each),
+                       ('npartition', NumpyPartition, lambda p: p.merge_many(xs, ys))]
+    try:
+        from cpartition import cPartition
+        implementations.append(('cpartition', cPartition, merge_each))
+    except (ImportError, OSError), e:
+        print "%-12s skipped: %s" % ('cpartition', e)
+
+    baseline = None
+    expected = None
+    for (name, cls, merge) in implementations:
+        p = cls(range(num_docs))
+        merge_seconds = _timed(merge, p)[1]
+        (overview, sets_seconds) = _timed(p.sets_overview)
+
+        # Partition returns a dict, the array-based partitions (representatives, sizes)
+        sizes = sorted(overview.values()) if isinstance(overview, dict) else sorted(overview[1].tolist())
+        expected = expected or sizes
+
+        baseline = baseline or merge_seconds + sets_seconds
+        _report(name, merge_seconds + sets_seconds, baseline, "merge %.2fs, sets %.2fs, %s sets%s" %
+                (merge_seconds, sets_seconds, len(sizes), "" if sizes == expected else ", MISMATCH"))
+        p.free()
+
+
+def bench_codec(options):
+    """Compare size and decoding speed of LZ4 chunks of raw pairs and of paircodec encoded pairs.
+
+    With --corpus, the pairs of the corpus' similarity store are used.
+    """
+
+    import numpy
+    import lz4
+    import bsims
+    from paircodec import encode_pairs, decode_pairs
+
+    if options.get('corpus'):
+        chunks = [pairs for (_, pairs) in bsims.get_similarity_reader(int(options['corpus'])).iter_chunks() if len(pairs)]
+    else:
+        num_docs = int(options.get('docs') or 100000)
+        (xs, ys) = _synthetic_pairs(num_docs, 20 * num_docs)
+        pairs = numpy.column_stack([xs, ys]).astype(numpy.uint32)
+        chunks = [pairs[start:start + 1000000] for start in range(0, len(pairs), 1000000)]
+    num_pairs = sum(len(pairs) for pairs in chunks)
+    print "%s pairs in %s chunks, %.1f MB raw" % (num_pairs, len(chunks), num_pairs * 8 / 1e6)
+
+    codecs = [('lz4', lambda pairs: pairs.tostring(), lambda data: numpy.fromstring(data, numpy.uint32).reshape(-1, 2)),
+              ('delta+lz4', encode_pairs, decode_pairs)]
+    baseline = None
+    for (name, encode, decode) in codecs:
+        (compressed, encode_seconds) = _timed(lambda: [lz4.compressHC(encode(pairs)) for pairs in chunks])
+        size = sum(len(c) for c in compressed)
+        decode_seconds = _timed(lambda: [decode(lz4.uncompress(c)) for c in compressed])[1]
+
+        baseline = baseline or decode_seconds
+        _report(name, decode_seconds, baseline, "%.2f MB, %.2f bytes/pair, decoding %.0fM pairs/s, encoding %.1fs" %
+                (size / 1e6, float(size) / num_pairs, num_pairs / decode_seconds / 1e6, encode_seconds))
+
+
+BENCHMARKS = {
+    'codec': bench_codec,
+    'copy': bench_copy,
+    'load': bench_load,
+    'partition': bench_partition,
+    'parse': bench_parse,
+    'similarity': bench_similarity,
+}
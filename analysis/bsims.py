@@ -3,15 +3,21 @@ try:
 except:
 	pass
 import numpy
+import fcntl
+import lz4
 import os
+import struct
 import sys
 import tempfile
-from itertools import chain
+from contextlib import contextmanager
+from itertools import groupby
 import shutil
 
 from django.conf import settings
 
-from utils import BufferedCompressedWriter, BufferedCompressedReader, LZ4CompressedWriter, LZ4CompressedReader
+from utils import BufferedCompressedWriter, BufferedCompressedReader, LZ4CompressedWriter, LZ4CompressedReader, ensure_dir, \
+	read_manifest, chunk_names
+from paircodec import PairCodec, ScoredPairCodec, scored_records
 
 
 DATA_DIR = getattr(settings, 'SIMS_DATA_DIR', '.')
@@ -19,17 +25,83 @@ DATA_DIR = getattr(settings, 'SIMS_DATA_DIR', '.')
 STORED_SIMILARITY_CUTOFFS = [0.9, 0.8, 0.7, 0.6, 0.5]
 SIMILARITY_IO_BUFFER_SIZE = 100 * 1024 * 1024 # 100MB, enough so vast majority of corpora fit in single buffer
 
+# format of new similarity stores. Existing stores keep their format, see store_format().
+DEFAULT_STORE_FORMAT = getattr(settings, 'SIMS_STORE_FORMAT', 'lz4')
+
+# share of a store's documents that may be deleted before it's compacted, see remove_documents()
+COMPACTION_RATIO = getattr(settings, 'SIMS_COMPACTION_RATIO', 0.25)
+
+# compaction sorts with about this much memory, on top of one read buffer of SIMILARITY_IO_BUFFER_SIZE
+COMPACTION_MEMORY = getattr(settings, 'SIMS_COMPACTION_MEMORY', 256 * 1024 * 1024)
+# pairs per chunk written by compaction
+COMPACTED_CHUNK_PAIRS = getattr(settings, 'SIMS_COMPACTED_CHUNK_PAIRS', 4 * 1024 * 1024)
+# LZ4 stores with more chunks than this in any cutoff directory need compaction
+MAX_CHUNKS = getattr(settings, 'SIMS_MAX_CHUNKS', 32)
+
+# scored stores keep each similarity rounded down to a multiple of 1 / SCORE_STEPS, in one byte.
+# Steps of 1/200 make every stored cutoff exact.
+SCORE_STEPS = 200
+SCORE_STEP = 1.0 / SCORE_STEPS
+
+# .pairs files start with this, followed by the raw uint32 pairs
+PAIRS_HEADER = 'SIMPAIRS' + struct.pack('<II', 1, 0)
+
+def _lock_file(corpus_id, root, exclusive, blocking=True):
+	f = open(os.path.join(root, "%s.lock" % corpus_id), 'a')
+	try:
+		fcntl.flock(f, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | (0 if blocking else fcntl.LOCK_NB))
+	except IOError:
+		f.close()
+		return None
+	return f
+
+@contextmanager
+def store_lock(corpus_id, root=DATA_DIR, exclusive=False, blocking=True):
+	"""Lock the corpus' similarity store, yielding whether the lock was taken.
+
+	Readers and writers share the lock. Rewriting the store takes it
+	exclusively, so no one is reading a directory while it's swapped out,
+	or appending to one that's being replaced."""
+	f = _lock_file(corpus_id, root, exclusive, blocking)
+	try:
+		yield f is not None
+	finally:
+		if f is not None:
+			f.close()
+
+def quantize(similarities):
+	"""Return similarities rounded down to multiples of SCORE_STEP, as uint8 numbers of steps."""
+	# the epsilon keeps e.g. 0.29 * 200 = 57.99999999999999 in step 58
+	steps = numpy.floor(numpy.asarray(similarities, numpy.float64) * SCORE_STEPS + 1e-9)
+	return steps.clip(0, SCORE_STEPS).astype(numpy.uint8)
+
+def score_range(min_similarity, max_similarity=None):
+	"""Return the quantized scores [low, high) of similarities in [min_similarity, max_similarity)."""
+	return (int(quantize(min_similarity)), int(quantize(max_similarity)) if max_similarity is not None else SCORE_STEPS + 1)
+
+def _bucket(similarity):
+	"""Return the index of the STORED_SIMILARITY_CUTOFFS bucket of a similarity, or None if it's below them all."""
+	i = 0
+	while STORED_SIMILARITY_CUTOFFS[i] > similarity:
+		i += 1
+		if i == len(STORED_SIMILARITY_CUTOFFS):
+			return None
+	return i
+
 class SimilarityWriter(object):
 
 	def __init__(self, corpus_id, root=DATA_DIR):
 		dir = os.path.join(root, str(corpus_id))
-		if not os.path.isdir(dir):
-			os.mkdir(dir)
+		ensure_dir(dir)
+		self.lock = _lock_file(corpus_id, root, exclusive=False)
 		self.buffers = [list() for _ in range(len(STORED_SIMILARITY_CUTOFFS))]
 
-		self.writers = [BufferedCompressedWriter(open(os.path.join(dir, "%s.sims" % str(9-i)), 'a')) 
+		self.writers = [self._file_writer(os.path.join(dir, str(9-i)))
 						for i in range(len(STORED_SIMILARITY_CUTOFFS))]
 
+	def _file_writer(self, path):
+		return BufferedCompressedWriter(open(path + ".sims", 'a'))
+
 	def __enter__(self):
 		return self
 
@@ -37,14 +109,18 @@ class SimilarityWriter(object):
 		self.close()
 
 	def write(self, x, y, s):
-		i = 0
-		while STORED_SIMILARITY_CUTOFFS[i] > s:
-			i += 1
-			if i == len(STORED_SIMILARITY_CUTOFFS):
-				return
+		i = _bucket(s)
+		if i is None:
+			return
 
 		self.buffers[i] += (x, y)
 
+	def write_pairs(self, cutoff, pairs):
+		"""Write a (k, 2) array of pairs whose similarities are all in the bucket of cutoff,
+		one of STORED_SIMILARITY_CUTOFFS."""
+		i = STORED_SIMILARITY_CUTOFFS.index(cutoff)
+		self.writers[i].write(numpy.asarray(pairs, numpy.uint32).tostring())
+
 	def flush(self):
 		for i in range(len(STORED_SIMILARITY_CUTOFFS)):
 			serialization = numpy.array(self.buffers[i], numpy.uint32).tostring()
@@ -56,112 +132,631 @@ class SimilarityWriter(object):
 		self.flush()
 		for w in self.writers:
 			w.close()
+		self.lock.close()
 
 class LZ4SimilarityWriter(SimilarityWriter):
+	suffix = ".lz4sims"
+	codec = None
+
+	def _file_writer(self, path):
+		return LZ4CompressedWriter(path + self.suffix, codec=self.codec)
+
+class DeltaLZ4SimilarityWriter(LZ4SimilarityWriter):
+	"""Writes LZ4 chunks of pairs encoded by paircodec, which are sorted and much smaller."""
+	suffix = ".dlz4sims"
+	codec = PairCodec
+
+class ScoredLZ4SimilarityWriter(LZ4SimilarityWriter):
+	"""Writes LZ4 chunks of pairs with their quantize()d similarity, highest first.
+
+	Pairs are still bucketed by STORED_SIMILARITY_CUTOFFS, so the store reads
+	like any other, but ScoredLZ4SimilarityReader can also pick out the
+	pairs of any other range of similarities."""
+	suffix = ".slz4sims"
+	codec = ScoredPairCodec
+
 	def __init__(self, corpus_id, root=DATA_DIR):
-		dir = os.path.join(root, str(corpus_id))
-		if not os.path.isdir(dir):
-			os.mkdir(dir)
-		self.buffers = [list() for _ in range(len(STORED_SIMILARITY_CUTOFFS))]
+		super(ScoredLZ4SimilarityWriter, self).__init__(corpus_id, root)
+		self.scores = [list() for _ in range(len(STORED_SIMILARITY_CUTOFFS))]
 
-		self.writers = [LZ4CompressedWriter(os.path.join(dir, "%s.lz4sims" % str(9-i))) 
-						for i in range(len(STORED_SIMILARITY_CUTOFFS))]
+	def write(self, x, y, s):
+		i = _bucket(s)
+		if i is None:
+			return
+
+		self.buffers[i] += (x, y)
+		self.scores[i].append(s)
+
+	def write_pairs(self, cutoff, pairs):
+		"""Write pairs as in SimilarityWriter.write_pairs(), with cutoff as their similarity."""
+		self.write_scored(cutoff, pairs, quantize(cutoff))
 
-def get_similarity_writer(corpus_id, root=DATA_DIR):
+	def write_scored(self, cutoff, pairs, scores):
+		"""Write a (k, 2) array of pairs in the bucket of cutoff with their quantized similarities."""
+		i = STORED_SIMILARITY_CUTOFFS.index(cutoff)
+		self.writers[i].write(scored_records(pairs, scores))
+
+	def flush(self):
+		for i in range(len(STORED_SIMILARITY_CUTOFFS)):
+			serialization = scored_records(numpy.array(self.buffers[i], numpy.uint32), quantize(self.scores[i]))
+			self.buffers[i] = []
+			self.scores[i] = []
+			self.writers[i].write(serialization)
+			self.writers[i].flush()
+
+class PairsFileWriter(object):
+	"""Appends uint32 pairs, uncompressed, to a file starting with PAIRS_HEADER.
+
+	Each flush appends under an exclusive lock, so several processes can
+	write to the same file."""
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.buffer = []
+		self.flush()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def write(self, bytes):
+		self.buffer.append(bytes)
+
+	def flush(self):
+		bytes = ''.join(self.buffer)
+		self.buffer = []
+
+		fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX)
+			if os.fstat(fd).st_size == 0:
+				bytes = PAIRS_HEADER + bytes
+			while bytes:
+				bytes = bytes[os.write(fd, bytes):]
+		finally:
+			os.close(fd)
+
+	def close(self):
+		self.flush()
+
+class PairsSimilarityWriter(SimilarityWriter):
+	def _file_writer(self, path):
+		return PairsFileWriter(path + ".pairs")
+
+def uses_zlib(corpus_id, root=DATA_DIR):
+	"""Return whether the corpus' similarities are in the old single-file zlib format."""
+	return os.path.exists(os.path.join(root, str(corpus_id), "5.sims"))
+
+def store_format(corpus_id, root=DATA_DIR):
+	"""Return the format of the corpus' similarity store, one of STORE_FORMATS, or None if it has none."""
 	dir = os.path.join(root, str(corpus_id))
-	if os.path.exists(dir) and os.path.exists(os.path.join(dir, "5.sims")):
-		return SimilarityWriter(corpus_id, root)
-	else:
+	if uses_zlib(corpus_id, root):
+		return 'zlib'
+	if os.path.exists(os.path.join(dir, "5.pairs")):
+		return 'pairs'
+	if os.path.exists(os.path.join(dir, "5.lz4sims")):
+		return 'lz4'
+	if os.path.exists(os.path.join(dir, "5.dlz4sims")):
+		return 'delta'
+	if os.path.exists(os.path.join(dir, "5.slz4sims")):
+		return 'scored'
+	return None
+
+def chunk_dir(corpus_id, level, root=DATA_DIR):
+	"""Return the chunk directory of STORED_SIMILARITY_CUTOFFS[level] in an LZ4 or delta store."""
+	suffix = STORE_FORMATS[store_format(corpus_id, root) or 'lz4'][0].suffix
+	return os.path.join(root, str(corpus_id), "%s%s" % (str(9-level), suffix))
+
+def store_generation(corpus_id, root=DATA_DIR):
+	"""Return the token that changes whenever the store is rewritten rather than appended to."""
+	path = os.path.join(root, str(corpus_id), "generation")
+	return open(path).read() if os.path.exists(path) else None
+
+def get_similarity_writer(corpus_id, root=DATA_DIR, format=None):
+	"""Return a writer adding to the corpus' similarity store.
+
+	A new store is created in the given format, by default DEFAULT_STORE_FORMAT."""
+	format = store_format(corpus_id, root) or format or DEFAULT_STORE_FORMAT
+	if format == 'lz4':
 		print "using lz4"
-		return LZ4SimilarityWriter(corpus_id, root)
+	return STORE_FORMATS[format][0](corpus_id, root)
+
+def _tombstone_path(corpus_id, root=DATA_DIR):
+	return os.path.join(root, str(corpus_id), "deleted.bitmap")
+
+def read_tombstones(corpus_id, root=DATA_DIR):
+	"""Return the bitmap of deleted document IDs as a uint8 array, most significant bit first,
+	or None if no documents were deleted since the store was last rewritten."""
+	path = _tombstone_path(corpus_id, root)
+	if not os.path.exists(path) or os.path.getsize(path) == 0:
+		return None
+	return numpy.fromfile(path, numpy.uint8)
+
+def add_tombstones(corpus_id, doc_ids, root=DATA_DIR):
+	"""Set the bits of doc_ids in the deleted document bitmap, touching only their bytes."""
+	doc_ids = numpy.asarray(doc_ids, numpy.int64)
+	if not len(doc_ids):
+		return
+
+	with open(_tombstone_path(corpus_id, root), 'a+b') as f:
+		fcntl.flock(f, fcntl.LOCK_EX)
+		size = max(os.fstat(f.fileno()).st_size, doc_ids.max() / 8 + 1)
+		f.truncate(size)
+		bitmap = numpy.memmap(f, numpy.uint8, 'r+', shape=(size,))
+		numpy.bitwise_or.at(bitmap, doc_ids >> 3, (0x80 >> (doc_ids & 7)).astype(numpy.uint8))
+		bitmap.flush()
+		del bitmap
+
+def deleted_mask(tombstones, doc_ids):
+	"""Return which of an array of doc_ids are marked in the tombstones bitmap."""
+	doc_ids = numpy.asarray(doc_ids, numpy.int64)
+	covered = doc_ids < 8 * len(tombstones)
+	marked = tombstones[numpy.where(covered, doc_ids >> 3, 0)]
+	return covered & ((marked >> (7 - (doc_ids & 7))) & 1).astype(bool)
+
+def live_pairs(pairs, tombstones):
+	"""Return the rows of a (k, 2) array of pairs that don't involve deleted documents."""
+	if tombstones is None or not len(pairs):
+		return pairs
+	return pairs[_live_mask(pairs, tombstones)]
+
+def _live_mask(pairs, tombstones):
+	return ~deleted_mask(tombstones, pairs).any(axis=1)
+
+def max_deleted_id(corpus_id, root=DATA_DIR):
+	"""Return the highest deleted document ID whose similarities may still be stored, or None.
+
+	New documents must get higher IDs, or they'd inherit the deleted documents' similarities."""
+	tombstones = read_tombstones(corpus_id, root)
+	if tombstones is None:
+		return None
+	deleted = numpy.flatnonzero(numpy.unpackbits(tombstones))
+	return int(deleted[-1]) if len(deleted) else None
 
 class SimilarityReader(object):
 
 	def __init__(self, corpus_id, root=DATA_DIR):
+		self.corpus_id = corpus_id
+		self.root = root
 		self.dir = os.path.join(root, str(corpus_id))
 
 	def __iter__(self):
-		return chain.from_iterable(
-			(self._file_iter(os.path.join(self.dir, "%s.sims" % str(9-i)), STORED_SIMILARITY_CUTOFFS[i] + 0.05) 
-			for i in range(len(STORED_SIMILARITY_CUTOFFS))))
+		"""Yield (x, y, similarity) for each stored pair.
+
+		Kept for backwards compatibility, iter_chunks() is much faster."""
+		for (cutoff, pairs) in self.iter_chunks():
+			similarity = cutoff + 0.05
+			for (x, y) in pairs.astype(numpy.int64).tolist():
+				yield (x, y, similarity)
+
+	def iter_chunks(self, doc_ids=None):
+		"""Yield (cutoff, pairs) for blocks of stored pairs, highest cutoff first.
+
+		pairs is a (k, 2) uint32 array of pairs with similarity in the bucket of cutoff.
+		Pairs involving deleted documents are left out, and if doc_ids is given,
+		so are pairs not involving any of them."""
+		if doc_ids is not None:
+			doc_ids = numpy.unique(numpy.asarray(doc_ids, numpy.uint32))
+		with store_lock(self.corpus_id, self.root):
+			tombstones = read_tombstones(self.corpus_id, self.root)
+			for (cutoff, pairs) in self._stored_chunks(doc_ids):
+				pairs = live_pairs(pairs, tombstones)
+				if doc_ids is not None:
+					pairs = pairs[numpy.in1d(pairs, doc_ids).reshape(-1, 2).any(axis=1)]
+				yield (cutoff, pairs)
+
+	def _stored_chunks(self, doc_ids=None):
+		for i in range(len(STORED_SIMILARITY_CUTOFFS)):
+			for pairs in self._file_chunks(os.path.join(self.dir, "%s.sims" % str(9-i))):
+				yield (STORED_SIMILARITY_CUTOFFS[i], pairs)
 
-	def _file_iter(self, filename, similarity):
+	def _file_chunks(self, filename):
 		with BufferedCompressedReader(open(filename, 'r')) as reader:
+			for pairs in self._read_chunks(reader):
+				yield pairs
 
+	def _read_chunks(self, reader):
+		serialized_bytes = reader.read(SIMILARITY_IO_BUFFER_SIZE)
+		while serialized_bytes:
+			yield numpy.fromstring(serialized_bytes, numpy.uint32).reshape(-1, 2)
 			serialized_bytes = reader.read(SIMILARITY_IO_BUFFER_SIZE)
-			while serialized_bytes:
-				pairs = numpy.fromstring(serialized_bytes, numpy.uint32)
-				for i in range(0, len(pairs), 2):
-					yield (int(pairs[i]), int(pairs[i+1]), similarity)
-
-				serialized_bytes = reader.read(SIMILARITY_IO_BUFFER_SIZE)
 
 class LZ4SimilarityReader(SimilarityReader):
-	def __iter__(self):
-		return chain.from_iterable(
-			(self._file_iter(os.path.join(self.dir, "%s.lz4sims" % str(9-i)), STORED_SIMILARITY_CUTOFFS[i] + 0.05) 
-			for i in range(len(STORED_SIMILARITY_CUTOFFS))))
+	suffix = LZ4SimilarityWriter.suffix
+	codec = None
 
-	def _file_iter(self, filename, similarity):
-		with LZ4CompressedReader(filename) as reader:
+	def _stored_chunks(self, doc_ids=None):
+		for i in range(len(STORED_SIMILARITY_CUTOFFS)):
+			for pairs in self._file_chunks(os.path.join(self.dir, "%s%s" % (str(9-i), self.suffix)), doc_ids):
+				yield (STORED_SIMILARITY_CUTOFFS[i], pairs)
 
-			serialized_bytes = reader.read(SIMILARITY_IO_BUFFER_SIZE)
-			while serialized_bytes:
-				pairs = numpy.fromstring(serialized_bytes, numpy.uint32)
-				for i in range(0, len(pairs), 2):
-					yield (int(pairs[i]), int(pairs[i+1]), similarity)
+	def _file_chunks(self, dirname, doc_ids=None):
+		chunk_filter = None
+		if doc_ids is not None:
+			# chunks whose range of documents holds none of doc_ids are skipped unread
+			def chunk_filter(chunk):
+				i = numpy.searchsorted(doc_ids, chunk['min_id']) if chunk['pairs'] else len(doc_ids)
+				return i < len(doc_ids) and doc_ids[i] <= chunk['max_id']
 
-				serialized_bytes = reader.read(SIMILARITY_IO_BUFFER_SIZE)
+		with LZ4CompressedReader(dirname, chunk_filter=chunk_filter, codec=self.codec) as reader:
+			for pairs in self._read_chunks(reader):
+				yield pairs
 
 	def files_by_cutoff(self):
+		"""Return (cutoff, chunk file paths) for each cutoff.
+
+		The files are read as they are, so callers must hold store_lock() and
+		skip the documents in read_tombstones() themselves."""
 		return (
 			(
 				STORED_SIMILARITY_CUTOFFS[i],
 				[
-					os.path.join(self.dir, "%s.lz4sims" % str(9-i), f)	
-					for f in sorted(os.listdir(os.path.join(self.dir, "%s.lz4sims" % str(9-i))), key=lambda x: int(x.split('.')[0]))
+					os.path.join(self.dir, "%s%s" % (str(9-i), self.suffix), f)
+					for f in chunk_names(os.path.join(self.dir, "%s%s" % (str(9-i), self.suffix)))
 				],
 			)
 			for i in range(len(STORED_SIMILARITY_CUTOFFS))
 		)
 
+class DeltaLZ4SimilarityReader(LZ4SimilarityReader):
+	suffix = DeltaLZ4SimilarityWriter.suffix
+	codec = PairCodec
+
+class ScoredLZ4SimilarityReader(LZ4SimilarityReader):
+	suffix = ScoredLZ4SimilarityWriter.suffix
+	codec = ScoredPairCodec
+
+	def __iter__(self):
+		"""Yield (x, y, similarity) for each stored pair, similarity rounded down to a multiple of SCORE_STEP."""
+		for (similarities, pairs) in self.iter_scored_chunks(STORED_SIMILARITY_CUTOFFS[-1]):
+			for ((x, y), similarity) in zip(pairs.astype(numpy.int64).tolist(), similarities.tolist()):
+				yield (x, y, similarity)
+
+	def scored_files(self, min_similarity, max_similarity=None):
+		"""Return the paths of the chunk files that may hold pairs with similarity in [min_similarity, max_similarity).
+
+		Chunks whose manifest entry shows their scores are out of range are
+		left out, and buckets below min_similarity aren't looked at. As with
+		files_by_cutoff(), callers must hold store_lock() and skip deleted documents."""
+		(low, high) = score_range(min_similarity, max_similarity)
+		paths = []
+		for (i, cutoff) in enumerate(STORED_SIMILARITY_CUTOFFS):
+			bucket_high = int(quantize(STORED_SIMILARITY_CUTOFFS[i - 1])) if i else SCORE_STEPS + 1
+			if bucket_high <= low:
+				break
+			if int(quantize(cutoff)) >= high:
+				continue
+
+			dirname = os.path.join(self.dir, "%s%s" % (str(9-i), self.suffix))
+			manifest = read_manifest(dirname)
+			entries = manifest['chunks'] if manifest is not None else [dict(name=name) for name in chunk_names(dirname)]
+			for entry in entries:
+				if entry.get('pairs') == 0 or entry.get('max_score', high - 1) < low or entry.get('min_score', low) >= high:
+					continue
+				paths.append(os.path.join(dirname, str(entry['name'])))
+		return paths
+
+	def iter_scored_chunks(self, min_similarity, max_similarity=None, doc_ids=None):
+		"""Yield (similarities, pairs) for blocks of stored pairs with similarity in [min_similarity, max_similarity).
+
+		Both bounds are rounded down to multiples of SCORE_STEP, and so are
+		the float similarities of the (k, 2) uint32 pairs. Chunks are read
+		only if they can hold such pairs, and only as far as they do.
+		Deleted documents and doc_ids are handled as in iter_chunks()."""
+		(low, high) = score_range(min_similarity, max_similarity)
+		if doc_ids is not None:
+			doc_ids = numpy.unique(numpy.asarray(doc_ids, numpy.uint32))
+		with store_lock(self.corpus_id, self.root):
+			tombstones = read_tombstones(self.corpus_id, self.root)
+			for path in self.scored_files(min_similarity, max_similarity):
+				compressed = open(path).read()
+				if not compressed:
+					continue
+				uncompressed = lz4.uncompress(compressed)
+				scores = self.codec.scores(uncompressed)
+				# scores are in descending order
+				(start, end) = len(scores) - numpy.searchsorted(scores[::-1], [high, low])
+				pairs = numpy.fromstring(uncompressed[8 * start:8 * end], numpy.uint32).reshape(-1, 2)
+				scores = scores[start:end]
+
+				keep = numpy.ones(len(pairs), bool)
+				if tombstones is not None and len(pairs):
+					keep &= _live_mask(pairs, tombstones)
+				if doc_ids is not None:
+					keep &= numpy.in1d(pairs, doc_ids).reshape(-1, 2).any(axis=1)
+				yield (scores[keep] / float(SCORE_STEPS), pairs[keep])
+
+	def _stored_scored_chunks(self):
+		"""Yield (cutoff, scores, pairs) for each chunk, deleted documents included."""
+		for (cutoff, paths) in self.files_by_cutoff():
+			for path in paths:
+				compressed = open(path).read()
+				if compressed:
+					uncompressed = lz4.uncompress(compressed)
+					yield (cutoff, self.codec.scores(uncompressed), numpy.fromstring(self.codec.decode(uncompressed), numpy.uint32).reshape(-1, 2))
+
+def read_chunk_files(corpus_id, level, names, root=DATA_DIR):
+	"""Return the pairs of the named chunk files of STORED_SIMILARITY_CUTOFFS[level], as one (k, 2) uint32 array."""
+	dir = chunk_dir(corpus_id, level, root)
+	codec = STORE_FORMATS[store_format(corpus_id, root) or 'lz4'][1].codec
+	chunks = [numpy.zeros(0, numpy.uint32)]
+	for name in names:
+		compressed = open(os.path.join(dir, name)).read()
+		if compressed:
+			uncompressed = lz4.uncompress(compressed)
+			chunks.append(numpy.fromstring(codec.decode(uncompressed) if codec else uncompressed, numpy.uint32))
+	return numpy.concatenate(chunks).reshape(-1, 2)
+
+def read_scored_chunk_files(corpus_id, level, names, root=DATA_DIR):
+	"""Return the (scores, pairs) of the named chunk files of a scored store's STORED_SIMILARITY_CUTOFFS[level].
+
+	Scores are uint8 numbers of SCORE_STEP, as stored."""
+	dir = chunk_dir(corpus_id, level, root)
+	(scores, pairs) = ([numpy.zeros(0, numpy.uint8)], [numpy.zeros(0, numpy.uint32)])
+	for name in names:
+		compressed = open(os.path.join(dir, name)).read()
+		if compressed:
+			uncompressed = lz4.uncompress(compressed)
+			scores.append(ScoredPairCodec.scores(uncompressed))
+			pairs.append(numpy.fromstring(ScoredPairCodec.decode(uncompressed), numpy.uint32))
+	return (numpy.concatenate(scores), numpy.concatenate(pairs).reshape(-1, 2))
+
+class PairsSimilarityReader(SimilarityReader):
+	"""Reads .pairs files through memory maps, so chunks are views of the page cache."""
+
+	def _stored_chunks(self, doc_ids=None):
+		for i in range(len(STORED_SIMILARITY_CUTOFFS)):
+			for pairs in self._file_chunks(os.path.join(self.dir, "%s.pairs" % str(9-i))):
+				yield (STORED_SIMILARITY_CUTOFFS[i], pairs)
+
+	def _file_chunks(self, filename):
+		pairs = read_pairs_file(filename)
+		chunk_size = SIMILARITY_IO_BUFFER_SIZE / 8
+		for start in range(0, len(pairs), chunk_size):
+			yield pairs[start:start + chunk_size]
+
+def read_pairs_file(filename):
+	"""Return a read-only (k, 2) uint32 memory map of a .pairs file's pairs."""
+	size = os.path.getsize(filename) if os.path.exists(filename) else 0
+	# a pair may be half written by a concurrent writer
+	count = max(0, size - len(PAIRS_HEADER)) / 8
+	if count == 0:
+		return numpy.zeros((0, 2), numpy.uint32)
+
+	with open(filename, 'rb') as f:
+		if f.read(len(PAIRS_HEADER)) != PAIRS_HEADER:
+			raise ValueError("%s is not a similarity pairs file." % filename)
+	return numpy.memmap(filename, numpy.uint32, 'r', len(PAIRS_HEADER), (count, 2))
+
+# (writer, reader) for each format
+STORE_FORMATS = {
+	'zlib': (SimilarityWriter, SimilarityReader),
+	'lz4': (LZ4SimilarityWriter, LZ4SimilarityReader),
+	'delta': (DeltaLZ4SimilarityWriter, DeltaLZ4SimilarityReader),
+	'scored': (ScoredLZ4SimilarityWriter, ScoredLZ4SimilarityReader),
+	'pairs': (PairsSimilarityWriter, PairsSimilarityReader),
+}
+
 def get_similarity_reader(corpus_id, root=DATA_DIR):
-	dir = os.path.join(root, str(corpus_id))
-	if os.path.exists(dir) and os.path.exists(os.path.join(dir, "5.sims")):
-		return SimilarityReader(corpus_id, root)
-	else:
+	format = store_format(corpus_id, root) or 'lz4'
+	if format == 'lz4':
 		print "using lz4"
-		return LZ4SimilarityReader(corpus_id, root)
+	return STORE_FORMATS[format][1](corpus_id, root)
 
-def remove_documents(corpus_id, doc_ids):
-	"""Remove any similarity containing the given doc_ids."""
-	existing_dir = os.path.join(DATA_DIR, str(corpus_id))
+def store_size(corpus_id, root=DATA_DIR):
+	"""Return (cutoff, pairs, bytes) for each cutoff of the store, without reading the similarities.
+
+	Pairs of deleted documents are counted. The number of pairs is None where it's unknown,
+	in zlib stores and LZ4 chunk directories written before manifests."""
+	dir = os.path.join(root, str(corpus_id))
+	format = store_format(corpus_id, root)
+	sizes = []
+	for (i, cutoff) in enumerate(STORED_SIMILARITY_CUTOFFS):
+		if format == 'zlib':
+			path = os.path.join(dir, "%s.sims" % str(9-i))
+			sizes.append((cutoff, None, os.path.getsize(path) if os.path.exists(path) else 0))
+		elif format == 'pairs':
+			path = os.path.join(dir, "%s.pairs" % str(9-i))
+			sizes.append((cutoff, len(read_pairs_file(path)), os.path.getsize(path) if os.path.exists(path) else 0))
+		else:
+			chunks_dir = chunk_dir(corpus_id, i, root)
+			manifest = read_manifest(chunks_dir)
+			if manifest is None:
+				names = chunk_names(chunks_dir)
+				sizes.append((cutoff, None, sum(os.path.getsize(os.path.join(chunks_dir, name)) for name in names)))
+			else:
+				sizes.append((cutoff, sum(c['pairs'] for c in manifest['chunks']), sum(c['bytes'] for c in manifest['chunks'])))
+	return sizes
+
+def remove_documents(corpus_id, doc_ids, root=DATA_DIR, num_docs=None):
+	"""Remove any similarity containing the given doc_ids.
+
+	The documents are only marked deleted, and readers skip their
+	similarities. If num_docs, the number of documents left in the corpus,
+	is given and the deleted documents make up more than COMPACTION_RATIO
+	of the store's documents, the store is compacted in the background."""
+	existing_dir = os.path.join(root, str(corpus_id))
 	if not os.path.isdir(existing_dir):
 		# only n-gram parsed corpora have similarity data. If no directory, then skip.
 		print "skipping, couldn't find %s" % existing_dir
 		return
 
-	temp_dir = tempfile.mkdtemp()
-
-	deletion_set = set(doc_ids) # set could be faster than large list
-	reader = get_similarity_reader(corpus_id)
-	Writer = LZ4SimilarityWriter if type(reader) == LZ4SimilarityReader else SimilarityWriter
-	with Writer(corpus_id, temp_dir) as w:
-		i = 0
-		for (x, y, s) in reader:
-			if x not in deletion_set and y not in deletion_set:
-				w.write(x, y, s)
-				
-				i += 1
-				if i % 10000000 == 0:
-					w.flush()
-					sys.stdout.write('.')
-					sys.stdout.flush()
-
-	shutil.rmtree(existing_dir)
-	shutil.move(os.path.join(temp_dir, str(corpus_id)), existing_dir)
+	with store_lock(corpus_id, root):
+		add_tombstones(corpus_id, doc_ids, root)
+		tombstones = read_tombstones(corpus_id, root)
+
+	deleted = numpy.unpackbits(tombstones).sum() if tombstones is not None else 0
+	if num_docs is not None and deleted > COMPACTION_RATIO * (deleted + num_docs):
+		print "Compacting similarities of corpus %s in the background..." % corpus_id
+		compact_in_background(corpus_id, root)
+
+def _pair_keys(pairs):
+	"""Return each pair as one uint64, smaller document ID in the high half, so keys sort by document."""
+	low = numpy.minimum(pairs[:, 0], pairs[:, 1]).astype(numpy.uint64)
+	high = numpy.maximum(pairs[:, 0], pairs[:, 1]).astype(numpy.uint64)
+	return (low << numpy.uint64(32)) | high
+
+def _key_pairs(keys):
+	return numpy.column_stack([keys >> numpy.uint64(32), keys & numpy.uint64(0xffffffff)]).astype(numpy.uint32)
+
+def _sorted_runs(chunks, run_pairs, temp_dir):
+	"""Write the pairs of chunks to files of at most run_pairs sorted, distinct keys; return their memory maps."""
+	runs = []
+	buffered = []
+	def spill():
+		keys = numpy.unique(numpy.concatenate(buffered))
+		del buffered[:]
+		if len(keys):
+			path = os.path.join(temp_dir, "%s.run" % len(runs))
+			keys.tofile(path)
+			runs.append(numpy.memmap(path, numpy.uint64, 'r'))
+
+	for pairs in chunks:
+		for start in range(0, len(pairs), run_pairs):
+			buffered.append(_pair_keys(pairs[start:start + run_pairs]))
+			if sum(len(keys) for keys in buffered) >= run_pairs:
+				spill()
+	if buffered:
+		spill()
+	return runs
+
+def _merge_runs(runs, block_pairs):
+	"""Yield the distinct keys of sorted runs in order, reading at most block_pairs of each run at a time."""
+	positions = [0] * len(runs)
+	while any(position < len(run) for (run, position) in zip(runs, positions)):
+		blocks = [run[position:position + block_pairs] for (run, position) in zip(runs, positions)]
+		# every key up to the smallest last key of an unfinished block is in the blocks
+		ends = [block[-1] for (run, position, block) in zip(runs, positions, blocks) if position + len(block) < len(run)]
+		taken = [numpy.searchsorted(block, min(ends), 'right') if ends else len(block) for block in blocks]
+
+		yield numpy.unique(numpy.concatenate([block[:n] for (block, n) in zip(blocks, taken)]))
+		positions = [position + n for (position, n) in zip(positions, taken)]
+
+def _distinct_keys(chunks, temp_dir):
+	"""Yield the distinct pairs of chunks as ascending blocks of keys."""
+	runs = _sorted_runs(chunks, max(1, COMPACTION_MEMORY / 32), temp_dir)
+	for keys in _merge_runs(runs, max(1, COMPACTION_MEMORY / (32 * max(1, len(runs))))):
+		yield keys
+
+	for run in runs:
+		os.unlink(run.filename)
+
+def _rechunked(blocks, size):
+	"""Yield the concatenation of blocks, arrays of any length, in arrays of size elements and a shorter last one."""
+	pending = []
+	for block in blocks:
+		pending.append(block)
+		while sum(len(block) for block in pending) >= size:
+			joined = numpy.concatenate(pending)
+			yield joined[:size]
+			pending = [joined[size:]]
+	if sum(len(block) for block in pending):
+		yield numpy.concatenate(pending)
+
+def _write_sorted(writer, cutoff, chunks, temp_dir):
+	"""Write the distinct pairs of chunks in order of document, in chunks of COMPACTED_CHUNK_PAIRS."""
+	for keys in _rechunked(_distinct_keys(chunks, temp_dir), COMPACTED_CHUNK_PAIRS):
+		writer.write_pairs(cutoff, _key_pairs(keys))
+		writer.flush()
+
+def _write_sorted_scored(writer, cutoff, chunks, temp_dir):
+	"""Write the distinct scored pairs of (scores, pairs) chunks, highest score first, in chunks of COMPACTED_CHUNK_PAIRS.
+
+	The pairs are spread over a temporary file per score, and each file is
+	then sorted like in _write_sorted()."""
+	paths = {}
+	for (scores, pairs) in chunks:
+		for score in numpy.unique(scores).tolist():
+			paths[score] = os.path.join(temp_dir, "%s.scored" % score)
+			with open(paths[score], 'ab') as f:
+				pairs[scores == score].tofile(f)
+
+	def blocks():
+		for score in sorted(paths, reverse=True):
+			pairs = numpy.memmap(paths[score], numpy.uint32, 'r').reshape(-1, 2)
+			for keys in _distinct_keys([pairs], temp_dir):
+				block = numpy.empty(len(keys), [('key', numpy.uint64), ('score', numpy.uint8)])
+				block['key'] = keys
+				block['score'] = score
+				yield block
+			del pairs
+			os.unlink(paths[score])
+
+	for block in _rechunked(blocks(), COMPACTED_CHUNK_PAIRS):
+		writer.write_scored(cutoff, _key_pairs(block['key']), block['score'])
+		writer.flush()
+
+def _live_scored(chunks, tombstones):
+	"""Yield (scores, pairs) of (cutoff, scores, pairs) chunks without deleted documents' pairs."""
+	for (_, scores, pairs) in chunks:
+		if tombstones is not None and len(pairs):
+			keep = _live_mask(pairs, tombstones)
+			(scores, pairs) = (scores[keep], pairs[keep])
+		yield (scores, pairs)
+
+def _rewrite(corpus_id, format, root=DATA_DIR, sort=False):
+	"""Copy the store's live pairs to a new store in the given format and swap it in.
+
+	With sort, duplicate pairs are dropped, and the rest are written with
+	the smaller document ID first, in order of document, in large chunks.
+	Scored stores are ordered by score first, and keep their scores; other
+	conversions to the scored format store every pair at its cutoff.
+	Memory use is bounded by COMPACTION_MEMORY. The caller must hold the
+	exclusive store_lock()."""
+	existing_dir = os.path.join(root, str(corpus_id))
+	reader = STORE_FORMATS[store_format(corpus_id, root) or 'lz4'][1](corpus_id, root)
+	tombstones = read_tombstones(corpus_id, root)
+
+	temp_dir = tempfile.mkdtemp(dir=root)
+	with STORE_FORMATS[format][0](corpus_id, temp_dir) as w:
+		if sort and isinstance(reader, ScoredLZ4SimilarityReader) and isinstance(w, ScoredLZ4SimilarityWriter):
+			for (cutoff, chunks) in groupby(reader._stored_scored_chunks(), lambda chunk: chunk[0]):
+				_write_sorted_scored(w, cutoff, _live_scored(chunks, tombstones), temp_dir)
+		elif sort:
+			for (cutoff, chunks) in groupby(reader._stored_chunks(), lambda chunk: chunk[0]):
+				_write_sorted(w, cutoff, (live_pairs(pairs, tombstones) for (_, pairs) in chunks), temp_dir)
+		else:
+			for (cutoff, pairs) in reader._stored_chunks():
+				w.write_pairs(cutoff, live_pairs(pairs, tombstones))
+				w.flush()
+	with open(os.path.join(temp_dir, str(corpus_id), "generation"), 'w') as f:
+		f.write(os.urandom(8).encode('hex'))
+
+	os.rename(existing_dir, os.path.join(temp_dir, 'old'))
+	os.rename(os.path.join(temp_dir, str(corpus_id)), existing_dir)
 	shutil.rmtree(temp_dir)
 
+def needs_compaction(corpus_id, root=DATA_DIR):
+	"""Return whether the store has deleted documents' pairs, or LZ4 directories of more than MAX_CHUNKS chunks."""
+	if read_tombstones(corpus_id, root) is not None:
+		return True
+	if store_format(corpus_id, root) not in ('lz4', 'delta', 'scored'):
+		return False
+	return any(len(chunk_names(chunk_dir(corpus_id, i, root))) > MAX_CHUNKS
+			   for i in range(len(STORED_SIMILARITY_CUTOFFS)))
+
+def compact(corpus_id, root=DATA_DIR):
+	"""Rewrite the store without the pairs of deleted documents or duplicates, sorted into few large chunks.
+
+	Return False, doing nothing, if the store is in use."""
+	if not os.path.isdir(os.path.join(root, str(corpus_id))):
+		return False
+
+	with store_lock(corpus_id, root, exclusive=True, blocking=False) as locked:
+		if not locked:
+			print "Similarities of corpus %s are in use, not compacting." % corpus_id
+			return False
+		_rewrite(corpus_id, store_format(corpus_id, root) or 'lz4', root, sort=True)
+	return True
+
+def compact_in_background(corpus_id, root=DATA_DIR):
+	import multiprocessing
+	p = multiprocessing.Process(target=compact, args=[corpus_id, root])
+	p.start()
+	return p
+
 def convert_to_lz4(corpus_id, preserve_zlib=False, dest_data_dir=DATA_DIR):
 	"""Convert a zlib corpus to an LZ4 corpus."""
 	existing_dir = os.path.join(DATA_DIR, str(corpus_id))
@@ -171,19 +766,39 @@ def convert_to_lz4(corpus_id, preserve_zlib=False, dest_data_dir=DATA_DIR):
 		return
 
 	with LZ4SimilarityWriter(corpus_id, root=dest_data_dir) as w:
-		i = 0
-		for (x, y, s) in SimilarityReader(corpus_id):
-			w.write(x, y, s)
-			
-			i += 1
-			if i % 10000000 == 0:
-				w.flush()
-				sys.stdout.write('.')
-				sys.stdout.flush()
+		for (cutoff, pairs) in SimilarityReader(corpus_id).iter_chunks():
+			w.write_pairs(cutoff, pairs)
+			w.flush()
+			sys.stdout.write('.')
+			sys.stdout.flush()
 
 	if not preserve_zlib:
 		for sims_file in [fname for fname in os.listdir(existing_dir) if fname.endswith(".sims")]:
-			os.unlink(sims_file)
+			os.unlink(os.path.join(existing_dir, sims_file))
+
+def convert(corpus_id, format, root=DATA_DIR):
+	"""Rewrite the corpus' similarity store in the given format, one of STORE_FORMATS."""
+	existing_dir = os.path.join(root, str(corpus_id))
+	if not os.path.isdir(existing_dir) or store_format(corpus_id, root) == format:
+		return
+
+	with store_lock(corpus_id, root, exclusive=True):
+		_rewrite(corpus_id, format, root)
+
+def stored_corpora(root=DATA_DIR):
+	"""Return the IDs of the corpora with similarity stores."""
+	return sorted(int(name) for name in os.listdir(root) if name.isdigit() and os.path.isdir(os.path.join(root, name)))
+
+def bulk_compact(corpus_ids, root=DATA_DIR, force=False):
+	"""Compact the stores that need it, each in a separate process to prevent memory runaway."""
+	import multiprocessing
+	for corpus_id in corpus_ids:
+		if not force and not needs_compaction(corpus_id, root):
+			continue
+		print "Compacting similarities of corpus %s..." % corpus_id
+		p = multiprocessing.Process(target=compact, args=[corpus_id, root])
+		p.start()
+		p.join()
 
 def bulk_convert(corpus_ids, dest_data_dir):
 	"""Convert a bunch of corpora to LZ4, in a separate process to prevent memory runaway."""
@@ -202,5 +817,3 @@ def remove_all(corpus_id):
 
 def exists(corpus_id):
 	return os.path.isdir(os.path.join(DATA_DIR, str(corpus_id)))
-
-
@@ -1,24 +1,23 @@
-import itertools
+import csv
 import random
-from collections import defaultdict
+import tempfile
 
 import psycopg2.extras
 from django.db import connection
-from django.core.cache import cache
 
 from django.conf import settings
-if getattr(settings, "USE_C_PARTITION", False):
-    print "Using C partition"
-    from cpartition import cPartition as Partition
-else:
-    from partition import Partition
 
 try:
     import numpypy as numpy
 except ImportError:
     import numpy
 
-from utils import profile, wirth_n_largest
+from utils import profile, cluster_top_phrases
+from summaries import ClusterSummaries, cluster_key
+from phrases import remove_phrases, remove_phrase_dictionary
+from hierarchy import HierarchyState, CompactHierarchy, replay_similarities
+from hiercache import hierarchy_cache
+from similarity import DocumentPhrases
 import bsims
 
 # Django connection is a wrappers around psycopg2 connection,
@@ -93,6 +92,11 @@ class Corpus(object):
         self.cursor.execute("select max(document_id) from documents where corpus_id = %s", [self.id])
         result = self.cursor.fetchone()
         
+        # IDs of deleted documents can't be reused until their similarities are compacted away
+        max_deleted = bsims.max_deleted_id(self.id)
+        if max_deleted is not None:
+            return max(result[0], max_deleted) if result and result[0] is not None else max_deleted
+
         return result[0] if result else None
         
     def max_phrase_id(self):
@@ -103,6 +107,15 @@ class Corpus(object):
         
     def upload_csv(self, file, tablename):
         self.cursor.copy_expert("copy %s from STDIN csv" % tablename, file)
+
+    def upload_binary(self, file, tablename):
+        self.cursor.copy_expert("copy %s from STDIN binary" % tablename, file)
+
+    def type_oid(self, type_name):
+        """Return the OID of a type, which binary COPY needs for array elements."""
+
+        self.cursor.execute("select %s::regtype::oid", [type_name])
+        return self.cursor.fetchone()[0]
     
     def all_docs(self):
         """Return the phrases in all non-empty documents."""
@@ -116,11 +129,80 @@ class Corpus(object):
         """, dict(corpus_id=self.id))
         
         return dict(self.cursor.fetchall())
-    
+
+    def all_docs_csr(self, chunk_size=16 * 1024 * 1024):
+        """Return the same mapping as all_docs(), as a DocumentPhrases.
+
+        Occurrences are streamed through COPY and parsed a chunk at a time,
+        so there's never a Python object per phrase occurrence.
+        """
+
+        pairs = self._copy_int_pairs("""
+            select document_id, phrase_id
+            from phrase_occurrences
+            where corpus_id = %d
+            order by document_id, phrase_id
+        """ % self.id, chunk_size)
+        return DocumentPhrases.from_pairs(pairs[:, 0], pairs[:, 1])
+
+    def _copy_int_pairs(self, query, chunk_size=16 * 1024 * 1024):
+        """Return the rows of a query selecting two integer columns, as a (k, 2) int32 array."""
+
+        occurrence_file = tempfile.TemporaryFile()
+        self.cursor.copy_expert("copy (%s) to STDOUT" % query, occurrence_file)
+        occurrence_file.seek(0)
+
+        chunks = [numpy.zeros(0, numpy.int32)]
+        remainder = ''
+        while True:
+            data = occurrence_file.read(chunk_size)
+            if not data:
+                break
+            data = remainder + data
+            end = data.rfind('\n') + 1
+            (data, remainder) = (data[:end], data[end:])
+            chunks.append(numpy.fromstring(data, numpy.int32, sep=' '))
+        occurrence_file.close()
+
+        return numpy.concatenate(chunks).reshape(-1, 2)
+
     def all_phrases(self):
         self.cursor.execute("select phrase_text, phrase_id from phrases where corpus_id = %s", [self.id])
         return dict(self.cursor.fetchall())
-    
+
+    def iter_phrases(self):
+        """Yield (phrase_id, phrase_text) for every phrase, without holding them all in memory."""
+
+        phrase_file = tempfile.TemporaryFile()
+        self.cursor.copy_expert("copy (select phrase_id, phrase_text from phrases where corpus_id = %d) to STDOUT csv" % self.id, phrase_file)
+        phrase_file.seek(0)
+
+        for (phrase_id, phrase_text) in csv.reader(phrase_file):
+            yield (int(phrase_id), phrase_text)
+
+        phrase_file.close()
+
+    def phrase_id(self, phrase_text):
+        self.cursor.execute("select phrase_id from phrases where corpus_id = %s and phrase_text = %s", [self.id, phrase_text])
+        result = self.cursor.fetchone()
+
+        return result[0] if result else None
+
+    def phrase_dictionary_token(self):
+        self.cursor.execute("select phrase_dictionary from corpora where corpus_id = %s", [self.id])
+        return self.cursor.fetchone()[0]
+
+    def set_phrase_dictionary_token(self, token):
+        """Record the version of the phrase dictionary matching the phrases table.
+
+        Set in the same transaction as the phrase changes, so a rollback
+        invalidates the dictionary. Kept in its own column rather than in
+        metadata, which is the user's. Databases created before the column
+        was added need add_phrase_dictionary.sql.
+        """
+
+        self.cursor.execute("update corpora set phrase_dictionary = %s where corpus_id = %s", [token, self.id])
+
     def delete(self, doc_ids):
         """Remove all data associated with given doc IDs."""
 
@@ -145,7 +227,9 @@ class Corpus(object):
                     where
                         corpus_id = %(corpus_id)s
                 )
+            returning phrase_id
         """, dict(corpus_id=self.id, doc_ids=doc_ids))
+        remove_phrases(self, [id for (id,) in self.cursor.fetchall()])
 
         self.cursor.execute("""
             delete from documents
@@ -155,7 +239,10 @@ class Corpus(object):
         """, dict(corpus_id=self.id, doc_ids=doc_ids))
 
         # remove from the similarities file store
-        bsims.remove_documents(self.id, doc_ids)
+        bsims.remove_documents(self.id, doc_ids, num_docs=self.num_docs())
+        HierarchyState.remove(self.id)
+        CompactHierarchy.remove(self.id)
+        ClusterSummaries.remove(self.id)
 
     def delete_corpus(self):
         """Remove all data associated with given doc IDs."""
@@ -189,6 +276,11 @@ class Corpus(object):
 
         # remove from the similarities file store
         bsims.remove_all(self.id)
+        for corpus_id in ids:
+            remove_phrase_dictionary(corpus_id)
+            HierarchyState.remove(corpus_id)
+            CompactHierarchy.remove(corpus_id)
+            ClusterSummaries.remove(corpus_id)
 
     def delete_by_metadata(self, key, values):
         """Remove all documents where a given key is in the given values."""
@@ -253,57 +345,117 @@ class Corpus(object):
     ### methods returning information about clustering ###
 
     @profile
-    def _add_representative_phrases(self, hierarchy, limit=10):
-        # flatten hierarhcy        
+    def _add_representative_phrases(self, hierarchy, limit=10, refresh=False):
+        """Set the phrases of each cluster without them to its limit most representative ones.
+
+        Summaries are looked up in the corpus' ClusterSummaries, and only the
+        missing ones are computed, then saved there. With refresh, phrase
+        counts are brought up to date even if nothing is missing, and the
+        summaries of clusters no longer in the hierarchy are dropped.
+
+        Phrases are scored against the counts of the whole corpus, so when
+        the counts change, the summaries of all clusters are computed again,
+        not only those of new clusters.
+        """
+
+        # flatten hierarhcy, skipping clusters reused with their summaries
         clusters = []
+        all_clusters = []
         def walk_clusters(h):
             for cluster in h:
-                clusters.append(("%s_%s" % (int(100*cluster['cutoff']), cluster['name']), cluster))
+                all_clusters.append(cluster)
+                if cluster['phrases'] is None:
+                    clusters.append(cluster)
                 walk_clusters(cluster['children'])
         walk_clusters(hierarchy)
 
-        # make a list of clusters for each document
-        doc_clusters = defaultdict(list)
-        for i, (cluster_id, cluster) in enumerate(clusters):
-            for doc in cluster['members']:
-                doc_clusters[doc].append(i)
+        summaries = ClusterSummaries.load(self.id)
+        if summaries is None or summaries.limit != limit:
+            summaries = ClusterSummaries.empty(limit)
 
-        # grab all the phrases in the corpus and map them to an index
-        phrase_dict = {}
-        phrases = []
-        self.cursor.execute("""
-            select phrase_id from phrases where corpus_id = %(corpus_id)s
-        """, dict(corpus_id=self.sentence_corpus_id))
-        for i, (phrase,) in enumerate(self.cursor):
-            phrases.append(phrase)
-            phrase_dict[phrase] = i
+        missing = []
+        for cluster in clusters:
+            cluster['phrases'] = summaries.phrases(cluster)
+            if cluster['phrases'] is None:
+                missing.append(cluster)
+        if not missing and not refresh:
+            return hierarchy
 
-        # build the tracking array
-        cluster_counts = numpy.zeros((len(clusters), len(phrases)), 'f')
-        total_counts = numpy.zeros(len(phrases), 'f')
+        counted = summaries.doc_ids
+        summaries = self._count_phrases(summaries)
+        if not numpy.array_equal(counted, summaries.doc_ids):
+            # the phrase counts changed, so every summary's scores did too
+            missing = all_clusters
+
+        if missing:
+            # only the members' occurrences are needed, unless that's most of them
+            members = numpy.unique(numpy.concatenate([cluster['members'] for cluster in missing]))
+            occurrences = self._sentence_occurrences(members if len(members) < len(summaries.doc_ids) / 2 else None)
+            occurrences[:, 1] = summaries.phrase_indexes(occurrences[:, 1])
+
+            top_indexes = cluster_top_phrases([cluster['members'] for cluster in missing], occurrences, len(summaries.phrase_ids), limit, summaries.doc_freqs)
+            for (cluster, indexes) in zip(missing, top_indexes):
+                summaries.set_phrases(cluster, summaries.phrase_ids[indexes].tolist())
+
+            new_phrase_ids = set(phrase_id for cluster in missing for phrase_id in summaries.clusters[cluster_key(cluster)]['phrases'])
+            summaries.phrase_text.update(self._phrase_text(new_phrase_ids - set(summaries.phrase_text)))
+
+            for cluster in missing:
+                cluster['phrases'] = summaries.phrases(cluster)
+
+        if refresh:
+            summaries.retain(all_clusters)
+        summaries.save(self.id)
+
+        return hierarchy
+
+    def _count_phrases(self, summaries):
+        """Return summaries with the phrases of documents added since counted.
+
+        If documents were removed, counting starts over."""
+
+        self.cursor.execute("select document_id from documents where corpus_id = %s order by document_id", [self.sentence_corpus_id])
+        doc_ids = numpy.array([d for (d,) in self.cursor.fetchall()], numpy.int32)
+
+        if not numpy.in1d(summaries.doc_ids, doc_ids).all():
+            summaries = ClusterSummaries.empty(summaries.limit)
+
+        new_doc_ids = numpy.setdiff1d(doc_ids, summaries.doc_ids)
+        if len(new_doc_ids):
+            summaries.add_documents(new_doc_ids, self._sentence_occurrences(new_doc_ids if len(summaries.doc_ids) else None))
+        return summaries
+
+    def _sentence_occurrences(self, doc_ids=None):
+        """Return the distinct (document ID, phrase ID) rows of the sentence corpus, only of doc_ids if given."""
+
+        if doc_ids is None:
+            return self._copy_int_pairs("""
+                select distinct document_id, phrase_id from phrase_occurrences where corpus_id = %d
+            """ % self.sentence_corpus_id)
+
+        # up to half the corpus' IDs, so they're uploaded to a temporary table rather than spelled out in the query
+        id_file = tempfile.TemporaryFile()
+        id_file.write("".join("%d\n" % d for d in doc_ids))
+        id_file.seek(0)
+        self.cursor.execute("create temporary table occurrence_documents (document_id integer primary key)")
+        self.upload_csv(id_file, 'occurrence_documents')
+        id_file.close()
+
+        occurrences = self._copy_int_pairs("""
+            select distinct document_id, phrase_id
+            from phrase_occurrences
+            join occurrence_documents using (document_id)
+            where corpus_id = %d
+        """ % self.sentence_corpus_id)
+        self.cursor.execute("drop table occurrence_documents")
+        return occurrences
+
+    def _phrase_text(self, phrase_ids):
+        """Return the text of an occurrence of each phrase, by phrase ID."""
+
+        if not phrase_ids:
+            return {}
 
-        # grab all the occurrences
-        self.cursor.execute("""
-            select distinct document_id, phrase_id from phrase_occurrences where corpus_id = %(corpus_id)s
-        """, dict(corpus_id=self.sentence_corpus_id))
-
-        # iterate over them and do the counting
-        empty = []
-        for document_id, phrase_id in self.cursor:
-            affected_clusters = doc_clusters.get(document_id, empty)
-            phrase_offset = phrase_dict[phrase_id]
-            total_counts[phrase_offset] += 1.0
-            for cluster in affected_clusters:
-                cluster_counts[cluster,phrase_offset] += 1.0
-
-        # convert counts into scores
-        top_phrases = []
-        for i in xrange(len(clusters)):
-            scores = cluster_counts[i] / (float(len(clusters[i][1]['members'])) + total_counts - cluster_counts[i])
-            phrase_idxs = wirth_n_largest(scores, limit)
-            top_phrases.append([phrases[idx] for idx in phrase_idxs])
-
-        all_phrase_ids = tuple(set(itertools.chain.from_iterable(top_phrases)))
         self.cursor.execute("""
             select p.phrase_id, substring(text for (p.indexes[1].end - p.indexes[1].start) from p.indexes[1].start + 1)
             from (
@@ -314,14 +466,9 @@ class Corpus(object):
                         and phrase_id in %(phrase_ids)s
                 ) p
             inner join documents d on d.corpus_id = %(corpus_id)s and d.document_id = p.document_id
-        """, dict(corpus_id=self.sentence_corpus_id, phrase_ids=all_phrase_ids))
-
-        phrase_text = dict(self.cursor.fetchall())
-
-        for i, (cluster_id, cluster) in enumerate(clusters):
-            cluster['phrases'] = [phrase_text.get(j, "") for j in top_phrases[i]]
+        """, dict(corpus_id=self.sentence_corpus_id, phrase_ids=tuple(phrase_ids)))
 
-        return hierarchy
+        return dict(self.cursor.fetchall())
 
     @profile
     def get_similarities(self):
@@ -337,32 +484,69 @@ class Corpus(object):
 
 
     @profile
-    def hierarchy(self, require_summaries=False):
-        h = cache.get(self._hierarchy_cache_key())
-        if not h:
-            h = self._compute_hierarchy(require_summaries)
-            cache.set(self._hierarchy_cache_key(), h)
-            return h
-            
-        if require_summaries and h[0]['phrases'] == None:
+    def hierarchy(self, require_summaries=False, cutoffs=None):
+        """Return the hierarchy of clusters at the given cutoffs, by default hierarchy_cutoffs.
+
+        Only the hierarchy at the default cutoffs is cached. Others are cut
+        from the corpus' saved dendrogram on each call, see HierarchyState,
+        or replayed from the stored scores of scored similarity stores.
+        """
+
+        if cutoffs is not None and sorted(cutoffs, reverse=True) != list(self.hierarchy_cutoffs):
+            return self._compute_hierarchy(require_summaries, cutoffs=sorted(cutoffs, reverse=True))
+
+        (generation, h) = hierarchy_cache.fetch(self.id, self.hierarchy_cutoffs, lambda: self._compute_hierarchy(require_summaries))
+
+        if require_summaries and h and h[0]['phrases'] == None:
             self._compute_hierarchy_summaries(h)
-            cache.set(self._hierarchy_cache_key(), h)
-            
+            hierarchy_cache.set(self.id, self.hierarchy_cutoffs, generation, h)
+
         return h
 
     def update_hierarchy_cache(self):
-        """If corpus' hierarchy is already cached, then recompute."""
-        h = cache.get(self._hierarchy_cache_key())
-        if h:
-            new_h = self._compute_hierarchy(True)
-            cache.set(self._hierarchy_cache_key(), new_h)
-    
-    def delete_hierarchy_cache(self):
-        """Delete hierarchy cache if it exists."""
-        cache.delete(self._hierarchy_cache_key())
+        """If corpus' hierarchy is already cached, then recompute.
+
+        Clusters that haven't changed since the cached hierarchy was computed
+        are kept as they are, summaries included.
+        """
+        latest = hierarchy_cache.latest(self.id, self.hierarchy_cutoffs)
+        if latest:
+            new_h = self._compute_hierarchy(True, previous=latest[1])
+            self._publish_hierarchy(new_h)
+
+    def refresh_summaries(self):
+        """Bring the cached hierarchy and the saved cluster summaries up to date.
+
+        Run after ingestion, so requests for summaries only look them up.
+        Clusters that haven't changed keep their summaries, as in
+        update_hierarchy_cache().
+        """
+        latest = hierarchy_cache.latest(self.id, self.hierarchy_cutoffs)
+        h = self._compute_hierarchy(False, previous=latest[1] if latest else None)
+        self._add_representative_phrases(h, limit=5, refresh=True)
+        self._publish_hierarchy(h)
 
-    def _hierarchy_cache_key(self):
-        return 'analysis.corpus.hierarchy-%s-%s' % (self.id, ",".join([str(cutoff) for cutoff in self.hierarchy_cutoffs]))
+    def compact_hierarchy(self):
+        """Return the summarized hierarchy at hierarchy_cutoffs as a CompactHierarchy.
+
+        It's memory mapped from the file saved by ingestion, see
+        refresh_summaries(), so web workers share it. to_d3() gives the
+        format hierarchy() returns.
+        """
+        compact = CompactHierarchy.load(self.id)
+        if compact is None:
+            CompactHierarchy.from_hierarchy(self.hierarchy(True)).save(self.id)
+            compact = CompactHierarchy.load(self.id)
+        return compact
+
+    def _publish_hierarchy(self, h):
+        CompactHierarchy.from_hierarchy(h).save(self.id)
+        hierarchy_cache.publish(self.id, self.hierarchy_cutoffs, h)
+
+    def delete_hierarchy_cache(self):
+        """Invalidate the corpus' cached hierarchies."""
+        CompactHierarchy.remove(self.id)
+        hierarchy_cache.invalidate(self.id, keep_stale=False)
 
     
     @profile
@@ -370,106 +554,48 @@ class Corpus(object):
         return self._add_representative_phrases(h, limit=5)
 
     @profile
-    def _compute_hierarchy(self, compute_summaries):
+    def _compute_hierarchy(self, compute_summaries, previous=None, cutoffs=None):
         """Return the hierarchy of clusters, in the format d3 expects.
                 
         See https://github.com/mbostock/d3/wiki/Partition-Layout for result format.
     
         The functions find_doc_in_hierarchy() and trace_doc_in_hierarchy() can return
         more information about the output of _compute_hierarchy().
-        """
-        
-        self.cursor.execute("select document_id from documents where corpus_id = %s", [self.id])
-        all_docs = set([d for (d,) in self.cursor.fetchall()])
-        partition = Partition(all_docs)
-
-        pruning_size = max(2, len(all_docs) / 100);
-        hierarchy = {}
-
-        similarity_reader = bsims.get_similarity_reader(self.id)
-        # short-circuit the python-side computation if everything lines up right
-        if isinstance(similarity_reader, bsims.LZ4SimilarityReader) and hasattr(partition, "merge_lz4"):
-            # we can use the C stuff
-            out = self._compute_hierarchy_fast(compute_summaries, similarity_reader, partition, pruning_size)
-            partition.free()
-            return out
-
-        cutoffs_remaining = list(self.hierarchy_cutoffs)
-        # note: (-1,-1,0) terminator is necessary so that hierarchy building
-        # code has a chance to run one more time after last sim is read.
-        for (x, y, sim) in itertools.chain(similarity_reader, [(-1,-1,0)]):
-            while cutoffs_remaining and sim < cutoffs_remaining[0]:
-                new_hierarchy = [
-                    {'name':partition.representative(doc_ids[0]),
-                     'size': len(doc_ids),
-                     'members': doc_ids,
-                     'children': [],
-                     'cutoff': cutoffs_remaining[0],
-                     'phrases': None
-                    }
-                    for doc_ids in partition.sets()
-                    if len(doc_ids) > pruning_size
-                ]
-                
-                for prev_cluster in hierarchy:
-                    for cluster in new_hierarchy:
-                        if partition.representative(prev_cluster['name']) == cluster['name']:
-                            cluster['children'].append(prev_cluster)
-                
-                for cluster in new_hierarchy:
-                    _order_members(cluster)
 
-                hierarchy = new_hierarchy
-                cutoffs_remaining.pop(0)
-            
-            if not cutoffs_remaining:
-                break
+        If the corpus has a saved HierarchyState and has only had documents
+        added since, only the new similarities are merged. Otherwise all
+        similarities are replayed. previous is an older hierarchy whose
+        unchanged clusters should be reused, see HierarchyState.hierarchy().
 
-            partition.merge(x, y)
+        cutoffs must be in descending order, and default to hierarchy_cutoffs.
+        The state of a scored store has a level per score step, so any
+        cutoffs are cut from it. Other stores' states only have the stored
+        cutoffs' levels.
+        """
+        
+        self.cursor.execute("select document_id from documents where corpus_id = %s order by document_id", [self.id])
+        doc_ids = numpy.array([d for (d,) in self.cursor.fetchall()], numpy.int32)
 
-        partition.free()
+        state = HierarchyState.load(self.id)
+        if state is not None:
+            state = state.updated(self.id, doc_ids)
 
-        if compute_summaries:
-            self._add_representative_phrases(hierarchy, limit=5)
+        if state is not None:
+            print "Updating hierarchy incrementally"
+        else:
+            state = replay_similarities(self.id, doc_ids)
 
-        return hierarchy
+        # zlib stores can't be updated incrementally
+        if state.applied is not None:
+            state.save(self.id)
 
-    def _compute_hierarchy_fast(self, compute_summaries, similarity_reader, partition, pruning_size):
-        print "Using fast hierarchy"
-        hierarchy = {}
-        for cutoff, files in similarity_reader.files_by_cutoff():
-            for cfile in files:
-                partition.merge_lz4(cfile)
-
-            new_hierarchy = [
-                {'name':partition.representative(doc_ids[0]),
-                 'size': len(doc_ids),
-                 'members': doc_ids,
-                 'children': [],
-                 'cutoff': cutoff,
-                 'phrases': None
-                }
-                for doc_ids in partition.sets()
-                if len(doc_ids) > pruning_size
-            ]
-            
-            for prev_cluster in hierarchy:
-                for cluster in new_hierarchy:
-                    if partition.representative(prev_cluster['name']) == cluster['name']:
-                        cluster['children'].append(prev_cluster)
-            
-            for cluster in new_hierarchy:
-                _order_members(cluster)
-
-            hierarchy = new_hierarchy
+        hierarchy = state.hierarchy(cutoffs or self.hierarchy_cutoffs, previous)
 
         if compute_summaries:
             self._add_representative_phrases(hierarchy, limit=5)
 
         return hierarchy
 
-
-
     def phrase_overlap(self, target_doc_id, doc_set):
         """Return the number of times each phrase in the given document
         is used in a sample of the document set.
@@ -508,19 +634,6 @@ class Corpus(object):
                     for (id, indexes, count) in self.cursor.fetchall()])
 
 
-def _order_members(cluster):
-
-    child_lists = [child['members'] for child in cluster['children']]
-    child_lists.sort(key=lambda l: len(l), reverse=True)
-    ordered_children = reduce(lambda x, y: x + y, child_lists, [])
-
-    all_members = set(cluster['members'])
-    child_set = set(ordered_children)
-    new_members = [m for m in all_members if m not in child_set]
-
-    cluster['members'] = ordered_children + new_members
-
-
 def find_doc_in_hierarchy(hierarchy, doc_id, cutoff):
     """ Return the members of the cluster where doc_id is found at given cutoff.
 
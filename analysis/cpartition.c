@@ -100,4 +100,48 @@ void cpartition_merge(cpartition_ptr part, int x, int y) {
         part->parent[y_root] = x_root;
         part->rank[x_root] += 1;
     }
-}
\ No newline at end of file
+}
+
+void cpartition_merge_pairs(cpartition_ptr part, int* xs, int* ys, int count) {
+    int i;
+    for (i = 0; i < count; i++) {
+        cpartition_merge(part, xs[i], ys[i]);
+    }
+}
+
+void cpartition_merge_pair_array(cpartition_ptr part, unsigned int* pairs, int count) {
+    int i;
+    for (i = 0; i < count; i++) {
+        cpartition_merge(part, pairs[2 * i], pairs[2 * i + 1]);
+    }
+}
+
+void cpartition_find_all(cpartition_ptr part, int* roots) {
+    int i;
+    for (i = 0; i < part->length; i++) {
+        roots[i] = _inl_cpartition_find(part, i);
+    }
+}
+
+int cpartition_sets_overview(cpartition_ptr part, int* representatives, int* sizes) {
+    int i, root, count;
+    int* root_sizes;
+
+    root_sizes = (int*)(calloc(part->length, sizeof(int)));
+    for (i = 0; i < part->length; i++) {
+        root = _inl_cpartition_find(part, i);
+        root_sizes[root] += 1;
+    }
+
+    count = 0;
+    for (i = 0; i < part->length; i++) {
+        if (root_sizes[i] > 0) {
+            representatives[count] = part->values[i];
+            sizes[count] = root_sizes[i];
+            count++;
+        }
+    }
+
+    free(root_sizes);
+    return count;
+}
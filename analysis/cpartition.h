@@ -27,5 +27,11 @@ static inline int _inl_cpartition_find(cpartition_ptr part, int x);
 static inline int _inl_cpartition_find_by_value(cpartition_ptr part, int x);
 
 void cpartition_merge(cpartition_ptr part, int x, int y);
+void cpartition_merge_pairs(cpartition_ptr part, int* xs, int* ys, int count);
+void cpartition_merge_pair_array(cpartition_ptr part, unsigned int* pairs, int count);
+
+/* bulk queries, writing into arrays of the partition's length */
+void cpartition_find_all(cpartition_ptr part, int* roots);
+int cpartition_sets_overview(cpartition_ptr part, int* representatives, int* sizes);
 
 #endif
\ No newline at end of file
@@ -1,8 +1,12 @@
 import cffi, os, platform
-from collections import defaultdict
 from partition import Partition
 import array
 
+try:
+    import numpypy as numpy
+except ImportError:
+    import numpy
+
 libtype = "dylib" if platform.uname()[0] == "Darwin" else "so"
 
 ffi = cffi.FFI()
@@ -13,16 +17,30 @@ ffi.cdef("int cpartition_find(void* part, int x);")
 ffi.cdef("int cpartition_find_by_value(void* part, int x);")
 ffi.cdef("void cpartition_merge(void* part, int x, int y);")
 ffi.cdef("void merge_lz4_file(void* part, char* file_name);")
+ffi.cdef("void merge_lz4_file_filtered(void* part, char* file_name, unsigned char* deleted, int deleted_length);")
+ffi.cdef("void merge_scored_lz4_file(void* part, char* file_name, int min_score, int max_score, unsigned char* deleted, int deleted_length);")
+ffi.cdef("void cpartition_merge_pairs(void* part, int* xs, int* ys, int count);")
+ffi.cdef("void cpartition_merge_pair_array(void* part, unsigned int* pairs, int count);")
+ffi.cdef("void cpartition_find_all(void* part, int* roots);")
+ffi.cdef("int cpartition_sets_overview(void* part, int* representatives, int* sizes);")
 libcpartition = ffi.dlopen(os.path.join(os.path.dirname(os.path.abspath(__file__)), "libcpartition.%s" % libtype))
 
+def _int_pointer(a):
+    """Return an int* to the data of an int32 array, which must outlive the pointer."""
+
+    return ffi.cast("int*", ffi.from_buffer(a))
+
+
 class cPartition(Partition):
     def __init__(self, values):
+        """Create a partition of the given values.
+
+        An int32 NumPy array of values is used in place, without copying.
+        """
+
         self.count = len(values)
-        _values = ffi.new("int[]", self.count)
-        for k, v in enumerate(values):
-            _values[k] = v
-        self.values = _values
-        self.part = libcpartition.create_cpartition(_values, self.count)
+        self.values = numpy.ascontiguousarray(values, numpy.int32)
+        self.part = libcpartition.create_cpartition(_int_pointer(self.values), self.count)
 
     def __del__(self):
         if self.part is not None:
@@ -34,37 +52,76 @@ class cPartition(Partition):
     def merge(self, x, y):
         libcpartition.cpartition_merge(self.part, x, y)
 
-    def merge_lz4(self, lz4_file):
-        libcpartition.merge_lz4_file(self.part, lz4_file)
+    def merge_many(self, xs, ys):
+        """Combine the set containing xs[i] with the set containing ys[i], for every i."""
+
+        xs = numpy.ascontiguousarray(xs, numpy.int32)
+        ys = numpy.ascontiguousarray(ys, numpy.int32)
+        libcpartition.cpartition_merge_pairs(self.part, _int_pointer(xs), _int_pointer(ys), len(xs))
+
+    def merge_pairs(self, pairs):
+        """Combine the sets of each row of a (k, 2) uint32 array, such as a memory-mapped .pairs file.
+
+        C-contiguous arrays are read in place.
+        """
+
+        pairs = numpy.ascontiguousarray(pairs, numpy.uint32)
+        libcpartition.cpartition_merge_pair_array(self.part, ffi.cast("unsigned int*", ffi.from_buffer(pairs)), len(pairs))
+
+    def merge_lz4(self, lz4_file, tombstones=None):
+        """Merge the pairs of an LZ4 chunk file, skipping those of documents set in the tombstones bitmap."""
+
+        if tombstones is None:
+            libcpartition.merge_lz4_file(self.part, lz4_file)
+        else:
+            tombstones = numpy.ascontiguousarray(tombstones, numpy.uint8)
+            libcpartition.merge_lz4_file_filtered(self.part, lz4_file, ffi.cast("unsigned char*", ffi.from_buffer(tombstones)), len(tombstones))
+
+    def merge_scored_lz4(self, lz4_file, min_score, max_score, tombstones=None):
+        """Merge the pairs of a scored LZ4 chunk file with min_score <= score < max_score, reading no further than needed."""
+
+        tombstones = numpy.ascontiguousarray(tombstones if tombstones is not None else [], numpy.uint8)
+        libcpartition.merge_scored_lz4_file(self.part, lz4_file, min_score, max_score,
+                                            ffi.cast("unsigned char*", ffi.from_buffer(tombstones)), len(tombstones))
+
+    def find_all(self):
+        """Return the root position of every position, as an array."""
+
+        roots = numpy.empty(self.count, numpy.int32)
+        libcpartition.cpartition_find_all(self.part, _int_pointer(roots))
+        return roots
 
     def sets(self):
-        sets = defaultdict(list)
-        for position in xrange(self.count):
-            sets[libcpartition.cpartition_find(self.part, position)].append(self.values[position])
+        """Return the grouped values as (offsets, members) arrays, as NumpyPartition does.
+
+        The values of set i are members[offsets[i]:offsets[i + 1]].
+        """
 
-        return sets.values()
+        roots = self.find_all()
+        order = numpy.argsort(roots, kind='mergesort')
+        sizes = numpy.bincount(roots, minlength=self.count)
+        offsets = numpy.concatenate([[0], numpy.cumsum(sizes[sizes > 0])]).astype(numpy.int32)
+        return (offsets, self.values[order])
 
     def sets_overview(self):
-        sets = defaultdict(int)
-        for position in xrange(self.count):
-            sets[libcpartition.cpartition_find(self.part, position)] += 1
+        """Return the representative and size of each set, as two arrays, as NumpyPartition does."""
 
-        return sets
+        representatives = numpy.empty(self.count, numpy.int32)
+        sizes = numpy.empty(self.count, numpy.int32)
+        n = libcpartition.cpartition_sets_overview(self.part, _int_pointer(representatives), _int_pointer(sizes))
+
+        return (representatives[:n], sizes[:n])
 
     def group(self, x):
-        result = set()
+        roots = self.find_all()
         xRoot = libcpartition.cpartition_find_by_value(self.part, x)
-        for position in xrange(self.count):
-            if libcpartition.cpartition_find(self.part, position) == xRoot:
-                result.add(self.values[position])
-
-        return result
+        return set(self.values[roots == xRoot].tolist())
 
     def representative(self, x):
-        return self.values[libcpartition.cpartition_find_by_value(self.part, x)]
+        return int(self.values[libcpartition.cpartition_find_by_value(self.part, x)])
 
     def free(self):
         if self.part is not None:
             libcpartition.free_cpartition(self.part)
             self.part = None
-        self.values = None
\ No newline at end of file
+        self.values = None
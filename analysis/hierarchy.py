@@ -0,0 +1,641 @@
+"""Cluster hierarchy built from per-cutoff union-find labels.
+
+Computing the hierarchy means merging every stored similarity into a
+partition of the corpus' documents, one cutoff at a time. The result is
+saved as a HierarchyState, the dendrogram of the merges plus a mark of how
+much of the store was merged: the names of the LZ4 chunk files, or the
+number of pairs in each .pairs file. Hierarchies for any cutoffs are cut
+from the dendrogram without reading the similarities again.
+
+Ingestion only appends documents and similarities, so a saved state can
+be brought up to date by merging just the pairs stored since, and the
+clusters that didn't change can be reused as they are. Deleting documents
+removes the state, and the next hierarchy is computed from scratch.
+
+Hierarchies themselves can be kept as a CompactHierarchy, a few arrays
+that list each document once, saved to a file web workers map and share.
+"""
+
+import itertools
+import json
+import os
+import shutil
+import struct
+import tempfile
+
+try:
+    import numpypy as numpy
+except ImportError:
+    import numpy
+
+from django.conf import settings
+if getattr(settings, "USE_C_PARTITION", False):
+    print "Using C partition"
+    from cpartition import cPartition as Partition
+else:
+    from npartition import NumpyPartition as Partition
+
+import bsims
+from bsims import DATA_DIR
+from utils import chunk_names
+
+
+def _order_members(cluster):
+
+    child_lists = [child['members'] for child in cluster['children']]
+    child_lists.sort(key=lambda l: len(l), reverse=True)
+    ordered_children = reduce(lambda x, y: x + y, child_lists, [])
+
+    all_members = set(cluster['members'])
+    child_set = set(ordered_children)
+    new_members = [m for m in all_members if m not in child_set]
+
+    cluster['members'] = ordered_children + new_members
+
+
+def pruning_size(num_docs):
+    """Clusters of this many documents or fewer are left out of the hierarchy."""
+
+    return max(2, num_docs / 100)
+
+
+def chunk_files(corpus_id, root=DATA_DIR):
+    """Return how much of each cutoff's similarities the store holds, or None for zlib stores.
+
+    For LZ4 and delta stores that's the list of chunk file names in each cutoff
+    directory, for .pairs stores the number of pairs in each file. They're
+    returned with the store's generation, which changes when the store is
+    rewritten, e.g. by compaction, rather than appended to.
+    """
+
+    format = bsims.store_format(corpus_id, root)
+    if format == 'zlib':
+        return None
+
+    files = []
+    for i in range(len(bsims.STORED_SIMILARITY_CUTOFFS)):
+        if format == 'pairs':
+            files.append(len(bsims.read_pairs_file(os.path.join(root, str(corpus_id), "%s.pairs" % (9 - i)))))
+            continue
+        files.append(chunk_names(bsims.chunk_dir(corpus_id, i, root)))
+    applied = {'generation': bsims.store_generation(corpus_id, root), 'chunks': files}
+    if format == 'scored':
+        # states of scored stores have a level per score step, see _replay_score_steps()
+        applied['levels'] = 'score_steps'
+    return applied
+
+
+def _new_pairs(corpus_id, level, applied, present, root=DATA_DIR):
+    """Return the (heights, pairs) of cutoff level stored after applied, or None if the store was rewritten since.
+
+    Pairs are at the level's cutoff, except in scored stores, where they're
+    at their score. Pairs of deleted documents are included.
+    """
+
+    cutoff = bsims.STORED_SIMILARITY_CUTOFFS[level]
+    if isinstance(present, int):
+        if not isinstance(applied, int) or applied > present:
+            return None
+        pairs = bsims.read_pairs_file(os.path.join(root, str(corpus_id), "%s.pairs" % (9 - level)))[applied:present]
+        return (numpy.repeat(numpy.float32(cutoff), len(pairs)), pairs)
+
+    if not isinstance(applied, list) or not set(applied).issubset(present):
+        return None
+    names = sorted(set(present) - set(applied))
+    if bsims.store_format(corpus_id, root) == 'scored':
+        (scores, pairs) = bsims.read_scored_chunk_files(corpus_id, level, names, root)
+        return (_score_heights(scores), pairs)
+    pairs = bsims.read_chunk_files(corpus_id, level, names, root)
+    return (numpy.repeat(numpy.float32(cutoff), len(pairs)), pairs)
+
+
+def _score_heights(scores):
+    """Return the heights of uint8 numbers of SCORE_STEPs, equal to the float32 of the cutoffs they stand for."""
+
+    return (numpy.asarray(scores, numpy.float64) / bsims.SCORE_STEPS).astype(numpy.float32)
+
+
+def _flatten(parent):
+    """Point every position of a union-find parent array straight at its root."""
+
+    while True:
+        grandparent = parent[parent]
+        if (grandparent == parent).all():
+            return parent
+        parent = grandparent
+
+
+def _smallest_member_labels(labels):
+    """Relabel each cluster by its smallest position, given labels by any position in the cluster."""
+
+    smallest = numpy.empty(len(labels), labels.dtype)
+    smallest.fill(len(labels))
+    numpy.minimum.at(smallest, labels, numpy.arange(len(labels), dtype=labels.dtype))
+    return smallest[labels]
+
+
+class HierarchyState(object):
+    """Single-linkage dendrogram of a corpus' documents.
+
+    doc_ids is the ascending array of document IDs. Documents are referred
+    to by their position in doc_ids, and each cluster by its smallest
+    position, its root. When a cluster was merged into a larger one at
+    similarity h, parent holds the larger cluster's root at the old root's
+    position, and height holds h. Roots of the whole corpus are their own
+    parent, with a height of 0.
+
+    Heights decrease along each path to the root, so the clusters at any
+    cutoff are found by following parents only while height >= cutoff, see
+    labels(). Stored similarities are bucketed, so every height is one of
+    STORED_SIMILARITY_CUTOFFS, and paths are at most that many steps long.
+    Scored stores keep each similarity to a SCORE_STEP, and their states
+    have a height per step, so any cutoff can be cut from them.
+
+    applied is how much of the similarity store has been merged, see
+    chunk_files().
+    """
+
+    def __init__(self, doc_ids, parent, height, applied):
+        self.doc_ids = doc_ids
+        self.parent = parent
+        self.height = height
+        self.applied = applied
+
+    @classmethod
+    def from_labels(cls, doc_ids, labels, applied, cutoffs=bsims.STORED_SIMILARITY_CUTOFFS):
+        """Return the dendrogram of nested partitions.
+
+        labels[k] gives the root of each document's cluster after merging all
+        pairs at or above cutoffs[k], which are in descending order. Any
+        position in the cluster can serve as its root.
+        """
+
+        return cls.from_levels(doc_ids, itertools.izip(cutoffs, labels), applied)
+
+    @classmethod
+    def from_levels(cls, doc_ids, levels, applied):
+        """Return the dendrogram of (cutoff, labels) levels, in descending order of cutoff.
+
+        levels may be a generator, so that only one level's labels are held
+        at a time.
+        """
+
+        parent = numpy.arange(len(doc_ids), dtype=numpy.int32)
+        height = numpy.zeros(len(doc_ids), numpy.float32)
+
+        previous = parent.copy()
+        for (cutoff, labels) in levels:
+            labels = _smallest_member_labels(labels)
+            # roots of the previous level that stopped being roots
+            merged = numpy.flatnonzero((previous == numpy.arange(len(doc_ids))) & (labels != previous))
+            parent[merged] = labels[merged]
+            height[merged] = cutoff
+            previous = labels
+
+        return cls(doc_ids, parent, height, applied)
+
+    def labels(self, cutoff):
+        """Return the root of each document's cluster at the given cutoff."""
+
+        n = len(self.doc_ids)
+        parent = numpy.where(self.height >= numpy.float32(cutoff), self.parent, numpy.arange(n, dtype=numpy.int32))
+        return _flatten(parent)
+
+    @staticmethod
+    def path(corpus_id, root=DATA_DIR):
+        return os.path.join(root, "%s.hierarchy.npz" % corpus_id)
+
+    @classmethod
+    def load(cls, corpus_id, root=DATA_DIR):
+        """Return the saved state, or None if there isn't one."""
+
+        path = cls.path(corpus_id, root)
+        if not os.path.exists(path):
+            return None
+
+        saved = numpy.load(path)
+        return cls(saved['doc_ids'], saved['parent'], saved['height'], json.loads(str(saved['applied'])))
+
+    def save(self, corpus_id, root=DATA_DIR):
+        # written to a temporary file first, so readers never see part of a state
+        with tempfile.NamedTemporaryFile(dir=root, suffix='.hierarchy.new', delete=False) as f:
+            numpy.savez(f, doc_ids=self.doc_ids, parent=self.parent, height=self.height, applied=numpy.array(json.dumps(self.applied)))
+        os.rename(f.name, self.path(corpus_id, root))
+
+    @staticmethod
+    def remove(corpus_id, root=DATA_DIR):
+        path = HierarchyState.path(corpus_id, root)
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def updated(self, corpus_id, doc_ids, root=DATA_DIR):
+        """Return the state with new documents and new chunk files merged in.
+
+        Return None if the corpus has changed in any other way, e.g. documents
+        or chunk files were removed, in which case the state must be rebuilt.
+        """
+
+        n = len(self.doc_ids)
+        if len(doc_ids) < n or (doc_ids[:n] != self.doc_ids).any():
+            return None
+
+        with bsims.store_lock(corpus_id, root):
+            files = chunk_files(corpus_id, root)
+            if files is None or not isinstance(self.applied, dict) or self.applied['generation'] != files['generation'] \
+                    or self.applied.get('levels') != files.get('levels'):
+                return None
+            new_pairs = [_new_pairs(corpus_id, k, applied, present, root) for (k, (applied, present)) in enumerate(zip(self.applied['chunks'], files['chunks']))]
+            if any(pairs is None for pairs in new_pairs):
+                return None
+            tombstones = bsims.read_tombstones(corpus_id, root)
+
+        heights = [numpy.zeros(0, numpy.float32)]
+        pairs = [numpy.zeros((0, 2), numpy.int64)]
+        for (new_heights, new) in new_pairs:
+            if tombstones is not None and len(new):
+                keep = ~bsims.deleted_mask(tombstones, new).any(axis=1)
+                (new_heights, new) = (new_heights[keep], new[keep])
+            positions = numpy.searchsorted(doc_ids, new.ravel()).reshape(-1, 2)
+            if len(new) and ((positions >= len(doc_ids)).any() or (doc_ids[positions.clip(0, len(doc_ids) - 1)] != new).any()):
+                # similarities refer to documents that don't exist
+                return None
+            heights.append(new_heights)
+            pairs.append(positions)
+
+        # the old dendrogram's links join the same clusters at each height as
+        # the pairs merged into it, so they're merged again with the new pairs.
+        # New documents start as singletons.
+        links = numpy.flatnonzero(self.parent != numpy.arange(n))
+        heights.append(self.height[links])
+        pairs.append(numpy.column_stack([links, self.parent[links]]))
+
+        return _replay_levels(doc_ids, numpy.concatenate(heights), numpy.concatenate(pairs), files)
+
+    def hierarchy(self, cutoffs, previous=None):
+        """Return the hierarchy of clusters at the given descending cutoffs, in the format d3 expects.
+
+        previous is an older hierarchy of the same corpus. Its clusters are
+        reused, keeping their member order and summaries, wherever the
+        cluster and everything below it is unchanged. Documents may have
+        been deleted since, so a cluster with the same root and size isn't
+        necessarily the same.
+        """
+
+        pruning = pruning_size(len(self.doc_ids))
+
+        reusable = {}
+        def walk_clusters(h):
+            for cluster in h:
+                reusable[(cluster['cutoff'], cluster['name'])] = cluster
+                walk_clusters(cluster['children'])
+        walk_clusters(previous or [])
+
+        hierarchy = []
+        for cutoff in cutoffs:
+            labels = self.labels(cutoff)
+            counts = numpy.bincount(labels, minlength=len(labels))
+            roots = numpy.flatnonzero(counts > pruning)
+
+            children = dict((root, []) for root in roots)
+            for prev_cluster in hierarchy:
+                position = numpy.searchsorted(self.doc_ids, prev_cluster['name'])
+                children[labels[position]].append(prev_cluster)
+
+            order = numpy.argsort(labels, kind='mergesort')
+            starts = numpy.searchsorted(labels[order], roots)
+
+            new_hierarchy = []
+            for (root, start) in zip(roots, starts):
+                name = int(self.doc_ids[root])
+                cluster = reusable.get((cutoff, name))
+                # in ascending order, as doc_ids are
+                members = self.doc_ids[order[start:start + counts[root]]]
+                if cluster is None or cluster['size'] != counts[root] \
+                        or set(map(id, cluster['children'])) != set(map(id, children[root])) \
+                        or (numpy.sort(cluster['members']) != members).any():
+                    cluster = {'name': name,
+                               'size': int(counts[root]),
+                               'members': members.tolist(),
+                               'children': children[root],
+                               'cutoff': cutoff,
+                               'phrases': None
+                              }
+                    _order_members(cluster)
+                new_hierarchy.append(cluster)
+
+            hierarchy = new_hierarchy
+
+        return hierarchy
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+class CompactHierarchy(object):
+    """Hierarchy of clusters as a handful of arrays.
+
+    Each cluster's members are ordered with its children's first, see
+    _order_members(), so they are a contiguous slice of its parent's. All
+    members are kept once, in members, ordered as the top clusters' are
+    concatenated, and cluster i's are members[offset[i]:offset[i] + length[i]].
+    Clusters are listed depth first. parent[i] is the index of cluster i's
+    parent, or -1 for the top clusters, and name[i], cutoff[i] and
+    phrases[i] are as in the hierarchy's dicts.
+
+    Saved files are memory mapped by load(), so the arrays of processes
+    that load the same file share their memory.
+    """
+
+    _HEADER = struct.Struct('<I')
+    _ARRAYS = [('cutoff', numpy.float64), ('members', numpy.int32), ('offset', numpy.int32),
+               ('length', numpy.int32), ('parent', numpy.int32), ('name', numpy.int32)]
+
+    def __init__(self, members, offset, length, cutoff, parent, name, phrases):
+        self.members = members
+        self.offset = offset
+        self.length = length
+        self.cutoff = cutoff
+        self.parent = parent
+        self.name = name
+        self.phrases = phrases
+
+    @classmethod
+    def from_hierarchy(cls, hierarchy):
+        """Return the compact form of a hierarchy in the format d3 expects, as returned by HierarchyState.hierarchy()."""
+
+        clusters = []
+        parents = []
+        offsets = []
+        members = numpy.array([m for cluster in hierarchy for m in cluster['members']], numpy.int32)
+
+        def walk(h, parent):
+            start = 0
+            for cluster in h:
+                if parent < 0:
+                    offset = start
+                    start += cluster['size']
+                else:
+                    # the child's slice starts where its first member is in the parent's
+                    parent_members = members[offsets[parent]:offsets[parent] + clusters[parent]['size']]
+                    offset = offsets[parent] + int(numpy.flatnonzero(parent_members == cluster['members'][0])[0])
+                if members[offset:offset + cluster['size']].tolist() != list(cluster['members']):
+                    raise ValueError("Members of cluster %s at %s aren't a slice of its parent's." % (cluster['name'], cluster['cutoff']))
+                clusters.append(cluster)
+                parents.append(parent)
+                offsets.append(offset)
+                walk(cluster['children'], len(clusters) - 1)
+        walk(hierarchy, -1)
+
+        return cls(members,
+                   numpy.array(offsets, numpy.int32),
+                   numpy.array([cluster['size'] for cluster in clusters], numpy.int32),
+                   numpy.array([cluster['cutoff'] for cluster in clusters], numpy.float64),
+                   numpy.array(parents, numpy.int32),
+                   numpy.array([cluster['name'] for cluster in clusters], numpy.int32),
+                   [cluster['phrases'] for cluster in clusters])
+
+    def cluster_members(self, i):
+        return self.members[self.offset[i]:self.offset[i] + self.length[i]]
+
+    def to_d3(self):
+        """Return the hierarchy in the format d3 expects, as HierarchyState.hierarchy() does."""
+
+        (offsets, lengths, cutoffs, parents, names) = (self.offset.tolist(), self.length.tolist(), self.cutoff.tolist(), self.parent.tolist(), self.name.tolist())
+
+        hierarchy = []
+        clusters = []
+        for i in range(len(names)):
+            cluster = {'name': names[i],
+                       'size': lengths[i],
+                       'members': self.members[offsets[i]:offsets[i] + lengths[i]].tolist(),
+                       'children': [],
+                       'cutoff': cutoffs[i],
+                       'phrases': self.phrases[i]
+                      }
+            clusters.append(cluster)
+            (clusters[parents[i]]['children'] if parents[i] >= 0 else hierarchy).append(cluster)
+
+        return hierarchy
+
+    def tostring(self):
+        """Return the arrays and phrases as a string, a JSON header followed by the arrays.
+
+        Arrays start at multiples of 8 bytes, so they can be used in place
+        by fromstring() or a memory map.
+        """
+
+        header = json.dumps(dict(num_members=len(self.members), num_clusters=len(self.name), phrases=self.phrases))
+        parts = [self._HEADER.pack(len(header)), header]
+        size = self._HEADER.size + len(header)
+        for (field, dtype) in self._ARRAYS:
+            parts.append('\0' * (_align(size) - size))
+            data = numpy.asarray(getattr(self, field), dtype).tostring()
+            parts.append(data)
+            size = _align(size) + len(data)
+        return ''.join(parts)
+
+    @classmethod
+    def fromstring(cls, data):
+        """Return the hierarchy of a string or uint8 array written by tostring(), without copying its arrays."""
+
+        buf = numpy.frombuffer(data, numpy.uint8) if isinstance(data, str) else data
+        (header_size,) = cls._HEADER.unpack(buf[:cls._HEADER.size].tostring())
+        header = json.loads(buf[cls._HEADER.size:cls._HEADER.size + header_size].tostring())
+
+        arrays = {}
+        size = cls._HEADER.size + header_size
+        for (field, dtype) in cls._ARRAYS:
+            count = header['num_members'] if field == 'members' else header['num_clusters']
+            start = _align(size)
+            size = start + count * numpy.dtype(dtype).itemsize
+            arrays[field] = buf[start:size].view(dtype)
+
+        return cls(phrases=header['phrases'], **arrays)
+
+    @staticmethod
+    def path(corpus_id, root=DATA_DIR):
+        return os.path.join(root, "%s.clusters" % corpus_id)
+
+    @classmethod
+    def load(cls, corpus_id, root=DATA_DIR):
+        """Return the saved hierarchy, memory mapped read only, or None if there isn't one."""
+
+        path = cls.path(corpus_id, root)
+        if not os.path.exists(path):
+            return None
+        return cls.fromstring(numpy.memmap(path, numpy.uint8, mode='r'))
+
+    def save(self, corpus_id, root=DATA_DIR):
+        # renamed over the old file, which processes that mapped it keep seeing
+        with tempfile.NamedTemporaryFile(dir=root, suffix='.clusters.new', delete=False) as f:
+            f.write(self.tostring())
+        os.rename(f.name, self.path(corpus_id, root))
+
+    @staticmethod
+    def remove(corpus_id, root=DATA_DIR):
+        path = CompactHierarchy.path(corpus_id, root)
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def _partition_labels(partition, count):
+    """Return the root position of each of a partition's count positions."""
+
+    if hasattr(partition, 'find_all'):
+        return partition.find_all().copy()
+    return numpy.array([partition._find(i) for i in xrange(count)], numpy.int32)
+
+
+def _merge_into(partition, pairs):
+    if hasattr(partition, "merge_pairs"):
+        partition.merge_pairs(pairs)
+    else:
+        for (x, y) in pairs.tolist():
+            partition.merge(x, y)
+
+
+def _replay_levels(doc_ids, heights, positions, applied):
+    """Return the HierarchyState of merging (k, 2) pairs of positions at the given heights."""
+
+    partition = Partition(doc_ids)
+    order = numpy.argsort(-heights, kind='mergesort')
+    (heights, pairs) = (heights[order], doc_ids[positions[order]])
+    starts = numpy.flatnonzero(numpy.concatenate([[True], heights[1:] != heights[:-1]])) if len(heights) else []
+
+    def levels():
+        for (start, end) in zip(starts, list(starts[1:]) + [len(heights)]):
+            _merge_into(partition, pairs[start:end])
+            yield (heights[start], _partition_labels(partition, len(doc_ids)))
+
+    state = HierarchyState.from_levels(doc_ids, levels(), applied)
+    partition.free()
+    return state
+
+
+def replay_similarities(corpus_id, doc_ids, root=DATA_DIR, cutoffs=None):
+    """Return the HierarchyState of merging all of a corpus' stored similarities.
+
+    doc_ids is the ascending array of the corpus' document IDs. cutoffs,
+    in descending order, default to STORED_SIMILARITY_CUTOFFS, except for
+    scored stores, which by default get a level per score step, see
+    _replay_score_steps(). Only scored stores can be replayed at other
+    cutoffs, see _replay_scored().
+    """
+
+    if cutoffs is not None and list(cutoffs) != bsims.STORED_SIMILARITY_CUTOFFS:
+        return _replay_scored(corpus_id, doc_ids, cutoffs, root)
+    if cutoffs is None and bsims.store_format(corpus_id, root) == 'scored':
+        return _replay_score_steps(corpus_id, doc_ids, root)
+
+    partition = Partition(doc_ids)
+    labels = []
+
+    def snapshot():
+        labels.append(_partition_labels(partition, len(doc_ids)))
+
+    # held so the store isn't compacted while it's read
+    with bsims.store_lock(corpus_id, root):
+        # listed before reading, so that chunks written meanwhile are merged
+        # again by the next update, which is harmless
+        applied = chunk_files(corpus_id, root)
+
+        similarity_reader = bsims.get_similarity_reader(corpus_id, root)
+        # short-circuit the python-side computation if everything lines up right
+        if isinstance(similarity_reader, bsims.LZ4SimilarityReader) and similarity_reader.codec is None and hasattr(partition, "merge_lz4"):
+            # we can use the C stuff
+            print "Using fast hierarchy"
+            tombstones = bsims.read_tombstones(corpus_id, root)
+            for cutoff, files in similarity_reader.files_by_cutoff():
+                for cfile in files:
+                    partition.merge_lz4(cfile, tombstones)
+                snapshot()
+        else:
+            cutoffs_remaining = list(bsims.STORED_SIMILARITY_CUTOFFS)
+            for (cutoff, pairs) in similarity_reader.iter_chunks():
+                while cutoff < cutoffs_remaining[0]:
+                    snapshot()
+                    cutoffs_remaining.pop(0)
+
+                _merge_into(partition, pairs)
+
+            for _ in cutoffs_remaining:
+                snapshot()
+
+    partition.free()
+
+    return HierarchyState.from_labels(doc_ids, labels, applied)
+
+
+def _replay_score_steps(corpus_id, doc_ids, root=DATA_DIR):
+    """Return the HierarchyState of a scored store, with a height for each score step that merged something.
+
+    Every chunk is read once. Its pairs are spread over a temporary file per
+    score, as in bsims.compact(), and the files are then merged highest
+    score first, so memory use doesn't grow with the store.
+    """
+
+    partition = Partition(doc_ids)
+    temp_dir = tempfile.mkdtemp(dir=root)
+    try:
+        with bsims.store_lock(corpus_id, root):
+            applied = chunk_files(corpus_id, root)
+            reader = bsims.get_similarity_reader(corpus_id, root)
+
+            paths = {}
+            for (similarities, pairs) in reader.iter_scored_chunks(bsims.STORED_SIMILARITY_CUTOFFS[-1]):
+                scores = numpy.rint(similarities * bsims.SCORE_STEPS).astype(numpy.uint8)
+                for score in numpy.unique(scores).tolist():
+                    paths[score] = os.path.join(temp_dir, "%s.scored" % score)
+                    with open(paths[score], 'ab') as f:
+                        pairs[scores == score].tofile(f)
+
+        def levels():
+            for score in sorted(paths, reverse=True):
+                pairs = numpy.memmap(paths[score], numpy.uint32, 'r').reshape(-1, 2)
+                _merge_into(partition, pairs)
+                del pairs
+                yield (_score_heights(score), _partition_labels(partition, len(doc_ids)))
+
+        state = HierarchyState.from_levels(doc_ids, levels(), applied)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    partition.free()
+    return state
+
+
+def _replay_scored(corpus_id, doc_ids, cutoffs, root=DATA_DIR):
+    """Return the HierarchyState of a scored store's similarities, with the given descending cutoffs as heights.
+
+    Cutoffs are rounded down to multiples of bsims.SCORE_STEP. Each cutoff
+    only merges the pairs between it and the one before, and nothing below
+    the last cutoff is read. The state records no applied chunks, so it's
+    neither saved nor updated.
+    """
+
+    reader = bsims.get_similarity_reader(corpus_id, root)
+    if not isinstance(reader, bsims.ScoredLZ4SimilarityReader):
+        raise ValueError("Only scored similarity stores can be replayed at cutoffs other than %s." % bsims.STORED_SIMILARITY_CUTOFFS)
+
+    partition = Partition(doc_ids)
+    labels = []
+
+    with bsims.store_lock(corpus_id, root):
+        tombstones = bsims.read_tombstones(corpus_id, root)
+        previous = None
+        for cutoff in cutoffs:
+            if hasattr(partition, 'merge_scored_lz4'):
+                (low, high) = bsims.score_range(cutoff, previous)
+                for cfile in reader.scored_files(cutoff, previous):
+                    partition.merge_scored_lz4(cfile, low, high, tombstones)
+            else:
+                for (_, pairs) in reader.iter_scored_chunks(cutoff, previous):
+                    _merge_into(partition, pairs)
+            labels.append(_partition_labels(partition, len(doc_ids)))
+            previous = cutoff
+
+    partition.free()
+
+    return HierarchyState.from_labels(doc_ids, labels, None, cutoffs)
+
@@ -0,0 +1,184 @@
+"""Two-level cache of corpus hierarchies.
+
+Hierarchies are kept in Django's cache, shared by all web workers, and the
+most recently used ones also in each process, so most requests neither
+compute nor unpickle one. They're stored as CompactHierarchy strings, with
+each document once, instead of as nested dicts with a list of members per
+cluster.
+
+Entries are never deleted. Each corpus has a generation number, part of
+its entries' keys, and invalidating the corpus' hierarchies increments it.
+Entries of old generations are left to expire, and the latest one is
+served while a new one is computed, unless it was invalidated as wrong.
+
+Only one worker computes a missing hierarchy: the one that takes its lock.
+The others serve the latest older hierarchy, or wait for the new one if
+there isn't any, see HierarchyCache.fetch().
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from hierarchy import CompactHierarchy
+
+
+def serialize(hierarchy):
+    """Return a hierarchy as a string, see CompactHierarchy."""
+
+    return CompactHierarchy.from_hierarchy(hierarchy).tostring()
+
+
+def deserialize(data):
+    """Return the hierarchy saved in a string by serialize()."""
+
+    return CompactHierarchy.fromstring(data).to_d3()
+
+
+class HierarchyCache(object):
+    """Hierarchies of corpora by corpus ID and cutoffs, see the module docstring.
+
+    Hierarchies returned are shared with other requests of the process, so
+    changes made to them must be stored with set() as well.
+    """
+
+    def __init__(self, backend=cache, lru_size=None, timeout=None, lock_timeout=None, poll_interval=0.5):
+        self.backend = backend
+        self.lru_size = lru_size if lru_size is not None else getattr(settings, 'HIERARCHY_CACHE_LRU_SIZE', 8)
+        # long enough for the memcached backend to treat as relative
+        self.timeout = timeout if timeout is not None else getattr(settings, 'HIERARCHY_CACHE_TIMEOUT', 30 * 24 * 3600)
+        # the longest a hierarchy should take to compute, after which its lock is taken over
+        self.lock_timeout = lock_timeout if lock_timeout is not None else getattr(settings, 'HIERARCHY_LOCK_TIMEOUT', 15 * 60)
+        self.poll_interval = poll_interval
+
+        self._lru = OrderedDict()
+        self._lru_lock = threading.Lock()
+
+    def _key(self, kind, corpus_id, cutoffs=None, generation=None):
+        key = 'analysis.corpus.hierarchy-%s-%s' % (kind, corpus_id)
+        if cutoffs is not None:
+            key += '-' + ",".join([str(cutoff) for cutoff in cutoffs])
+        if generation is not None:
+            key += '-%s' % generation
+        return key
+
+    def generation(self, corpus_id):
+        key = self._key('generation', corpus_id)
+        # starting from the time, rather than 0, so that an evicted generation
+        # doesn't come back and find the entries it had
+        self.backend.add(key, int(time.time()), self.timeout)
+        generation = self.backend.get(key)
+        return generation if generation is not None else self.invalidate(corpus_id)
+
+    def invalidate(self, corpus_id, keep_stale=True):
+        """Start a new generation of the corpus' hierarchies, and return it.
+
+        Unless keep_stale is False, the latest older hierarchies are still
+        served while the new ones are computed.
+        """
+
+        key = self._key('generation', corpus_id)
+        self.backend.add(key, int(time.time()), self.timeout)
+        try:
+            generation = self.backend.incr(key)
+        except ValueError:
+            # evicted in between
+            generation = int(time.time())
+            self.backend.set(key, generation, self.timeout)
+        if not keep_stale:
+            self.backend.delete_many([self._key('latest', corpus_id, cutoffs) for cutoffs in self._cached_cutoffs(corpus_id)])
+        return generation
+
+    def _cached_cutoffs(self, corpus_id):
+        return self.backend.get(self._key('cutoffs', corpus_id)) or []
+
+    def get(self, corpus_id, cutoffs, generation):
+        """Return the hierarchy of the given generation, or None if it isn't cached."""
+
+        key = self._key('entry', corpus_id, cutoffs, generation)
+        with self._lru_lock:
+            hierarchy = self._lru.pop(key, None)
+            if hierarchy is not None:
+                self._lru[key] = hierarchy
+                return hierarchy
+
+        data = self.backend.get(key)
+        if data is None:
+            return None
+        hierarchy = deserialize(data)
+        self._remember(key, hierarchy)
+        return hierarchy
+
+    def latest(self, corpus_id, cutoffs):
+        """Return the (generation, hierarchy) most recently stored, or None if there isn't one."""
+
+        generation = self.backend.get(self._key('latest', corpus_id, cutoffs))
+        if generation is None:
+            return None
+        hierarchy = self.get(corpus_id, cutoffs, generation)
+        return (generation, hierarchy) if hierarchy is not None else None
+
+    def set(self, corpus_id, cutoffs, generation, hierarchy):
+        key = self._key('entry', corpus_id, cutoffs, generation)
+        self.backend.set(key, serialize(hierarchy), self.timeout)
+        self._remember(key, hierarchy)
+
+        latest = self.backend.get(self._key('latest', corpus_id, cutoffs))
+        if latest is None or latest <= generation:
+            self.backend.set(self._key('latest', corpus_id, cutoffs), generation, self.timeout)
+        cached = self._cached_cutoffs(corpus_id)
+        if list(cutoffs) not in cached:
+            self.backend.set(self._key('cutoffs', corpus_id), cached + [list(cutoffs)], self.timeout)
+
+    def publish(self, corpus_id, cutoffs, hierarchy):
+        """Store a hierarchy as the corpus' new generation, keeping older ones to fall back on."""
+
+        generation = self.invalidate(corpus_id)
+        self.set(corpus_id, cutoffs, generation, hierarchy)
+        return generation
+
+    def fetch(self, corpus_id, cutoffs, compute):
+        """Return the (generation, hierarchy) of the corpus, computing the hierarchy if needed.
+
+        compute() is called by one worker at a time. Others meanwhile get
+        the latest older hierarchy, or wait for the new one if there isn't
+        any.
+        """
+
+        generation = self.generation(corpus_id)
+        hierarchy = self.get(corpus_id, cutoffs, generation)
+        if hierarchy is not None:
+            return (generation, hierarchy)
+
+        lock = self._key('lock', corpus_id, cutoffs, generation)
+        # add() only succeeds for one worker, until the lock is deleted or times out
+        while not self.backend.add(lock, 1, self.lock_timeout):
+            latest = self.latest(corpus_id, cutoffs)
+            if latest is not None:
+                return latest
+            time.sleep(self.poll_interval)
+            hierarchy = self.get(corpus_id, cutoffs, generation)
+            if hierarchy is not None:
+                return (generation, hierarchy)
+
+        try:
+            # stored under the generation read before computing, so that an
+            # invalidation meanwhile isn't missed
+            hierarchy = compute()
+            self.set(corpus_id, cutoffs, generation, hierarchy)
+        finally:
+            self.backend.delete(lock)
+        return (generation, hierarchy)
+
+    def _remember(self, key, hierarchy):
+        with self._lru_lock:
+            self._lru.pop(key, None)
+            self._lru[key] = hierarchy
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+
+
+hierarchy_cache = HierarchyCache()
@@ -1,19 +1,240 @@
 
 import tempfile
-import csv
-import sys
+import itertools
+import multiprocessing
 
 from parser import sentence_parse
 from phrases import PhraseSequencer
-from utils import jaccard, UnicodeWriter
-from bsims import get_similarity_writer
+from utils import UnicodeWriter
+import pgcopy
+from bsims import get_similarity_writer, uses_zlib, DATA_DIR
+from similarity import exhaustive, pairs_for_comparison
+
+
+def next_doc_id(corpora):
+    """Return the lowest document ID that's free in all of the given corpora.
+
+    The sentence and 4-gram parses of a docket must number their documents
+    alike, since summaries look up 4-gram clusters' documents in the sentence
+    corpus, but only the 4-gram corpus has similarities, and so reserves the
+    IDs of deleted documents, see Corpus.max_doc_id().
+    """
+
+    max_ids = [id for id in [corpus.max_doc_id() for corpus in corpora] if id is not None]
+    return max(max_ids) + 1 if max_ids else 0
+
+
+def _write_similarities(corpus_id, probe, new_doc_ids, root):
+    with get_similarity_writer(corpus_id, root) as writer:
+        i = 0
+        for (x, y, similarity) in probe(new_doc_ids):
+            writer.write(x, y, similarity)
+
+            i += 1
+            if i % 10000000 == 0:
+                writer.flush()
+
+    return i
+
+def _probe(engine, docs, min_similarity):
+    """Return a probe(new_doc_ids) for the engine, building its index now if it has one."""
+
+    if hasattr(engine, 'prepare'):
+        return engine.prepare(docs, min_similarity)
+    return lambda new_doc_ids: engine(docs, new_doc_ids, min_similarity)
+
+# set just before the similarity workers are forked, so that they share the
+# parent's documents and engine index copy-on-write instead of rebuilding them.
+_worker_state = None
+
+def _similarity_worker(shard):
+    (corpus_id, probe, root) = _worker_state
+    return _write_similarities(corpus_id, probe, shard, root)
+
+def shard_new_ids(new_doc_ids, shards):
+    """Split new_doc_ids into shards of equal work.
+
+    A new document is compared with every document below it, so the work
+    grows with the ID. Dealing IDs out in turn gives every shard the same
+    mix of cheap and expensive documents.
+    """
+
+    new_doc_ids = sorted(new_doc_ids)
+    return [new_doc_ids[i::shards] for i in range(shards) if new_doc_ids[i::shards]]
+
+def write_similarities(corpus_id, docs, new_doc_ids, min_similarity=0.5, engine=exhaustive, processes=1, root=DATA_DIR):
+    """Compute similarities of new documents against docs, and add them to the corpus' store.
+
+    With processes > 1 the new documents are split into shards and run in a
+    process pool. The engine's index is built once, before the workers are
+    forked, and each worker only probes it with its shard. Every worker writes
+    its own LZ4 chunks into the store, so the stored pairs are the same as a
+    single process run. Old zlib stores can't take concurrent writes and are
+    always done in one process.
+
+    Returns the number of pairs written.
+    """
+
+    global _worker_state
+
+    if processes <= 1 or uses_zlib(corpus_id, root):
+        return _write_similarities(corpus_id, _probe(engine, docs, min_similarity), new_doc_ids, root)
+
+    _worker_state = (corpus_id, _probe(engine, docs, min_similarity), root)
+    pool = multiprocessing.Pool(processes)
+    try:
+        # a few shards per worker, so one slow shard doesn't hold up the rest
+        written = sum(pool.imap_unordered(_similarity_worker, shard_new_ids(new_doc_ids, processes * 4)))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _worker_state = None
+
+    return written
+
+
+class _PhraseRecorder(object):
+    """Stands in for the PhraseSequencer in parse workers.
+
+    Phrases are numbered in the order the parser first asks for them. The
+    parent replays them through the real sequencer in that order, which is
+    the order a serial parse would have used, so phrase IDs come out the same.
+    """
+
+    def __init__(self):
+        self.phrases = []
+        self.phrase_ids = {}
+
+    def sequence(self, phrase):
+        phrase_id = self.phrase_ids.get(phrase, None)
+        if phrase_id is None:
+            phrase_id = self.phrase_ids[phrase] = len(self.phrases)
+            self.phrases.append(phrase)
+        return phrase_id
+
+# the parser, set just before the parse workers are forked.
+# parsers are usually lambdas, which can't be pickled.
+_parser = None
+
+def _parse_pool(parser, processes):
+    global _parser
+    _parser = parser
+    return multiprocessing.Pool(processes)
+
+def _parse_worker(text):
+    recorder = _PhraseRecorder()
+    phrases = _parser.__call__(text, recorder)
+    return (recorder.phrases, phrases)
+
+def parse_texts(texts, parser, sequencer, pool=None, processes=1):
+    """Return the parsed phrases of each text, in a pool from _parse_pool() if given."""
+
+    if pool is None:
+        return [parser.__call__(text, sequencer) for text in texts]
+
+    parsed = []
+    chunksize = max(1, len(texts) / (4 * processes))
+    for (phrase_texts, phrases) in pool.imap(_parse_worker, texts, chunksize):
+        phrase_ids = [sequencer.sequence(phrase) for phrase in phrase_texts]
+        parsed.append(sorted([(phrase_ids[i], indexes) for (i, indexes) in phrases]))
+
+    return parsed
+
+
+# bytes of parsed documents, phrases and occurrences to spill to disk before uploading
+UPLOAD_THRESHOLD = 256 * 1024 * 1024
+
+COPY_FORMATS = ('csv', 'binary')
+
+
+class CSVDocumentFiles(object):
+    """Document and phrase occurrence rows waiting to be uploaded as CSV."""
+
+    def __init__(self, corpus_id):
+        self.corpus_id = corpus_id
+
+        self.document_file = tempfile.TemporaryFile()
+        self.document_writer = UnicodeWriter(self.document_file)
+
+        self.occurrence_file = tempfile.TemporaryFile()
+
+    def write(self, doc_id, text, phrases, metadata):
+        formatted_metadata = ",".join([('"%s"=>"%s"' % (key, value.replace('\\', '\\\\').replace('"', '\\"'))) for (key, value) in metadata.items()])
+        self.document_writer.writerow([str(self.corpus_id), str(doc_id), text, formatted_metadata])
+        
+        for (phrase_id, indexes) in phrases:
+            formatted_indexes = '"{%s}"' % ", ".join(['""(%s, %s)""' % (start, end) for (start, end) in indexes])
+            self.occurrence_file.write("%s,%s,%s,%s\n" % (self.corpus_id, doc_id, phrase_id, formatted_indexes))
+
+    def size(self):
+        return self.document_file.tell() + self.occurrence_file.tell()
+
+    def upload(self, corpus):
+        for (f, tablename) in [(self.document_file, 'documents'), (self.occurrence_file, 'phrase_occurrences')]:
+            f.flush()
+            f.seek(0)
+            corpus.upload_csv(f, tablename)
+            f.close()
+
+
+class BinaryDocumentFiles(object):
+    """Document and phrase occurrence rows waiting to be uploaded with binary COPY."""
+
+    def __init__(self, corpus_id, int_bounds_oid):
+        self.corpus_id = corpus_id
+
+        self.document_file = tempfile.TemporaryFile()
+        self.document_writer = pgcopy.document_writer(self.document_file)
+
+        self.occurrence_file = tempfile.TemporaryFile()
+        self.occurrence_writer = pgcopy.occurrence_writer(self.occurrence_file, int_bounds_oid)
+
+    def write(self, doc_id, text, phrases, metadata):
+        self.document_writer.writerow((self.corpus_id, doc_id, text, metadata))
+
+        for (phrase_id, indexes) in phrases:
+            self.occurrence_writer.writerow((self.corpus_id, doc_id, phrase_id, indexes))
+
+    def size(self):
+        return self.document_file.tell() + self.occurrence_file.tell()
+
+    def upload(self, corpus):
+        for (f, writer, tablename) in [(self.document_file, self.document_writer, 'documents'),
+                                       (self.occurrence_file, self.occurrence_writer, 'phrase_occurrences')]:
+            writer.close()
+            f.flush()
+            f.seek(0)
+            corpus.upload_binary(f, tablename)
+            f.close()
+
 
 class DocumentIngester(object):
     
-    def __init__(self, corpus, parser=sentence_parse, compute_similarities=True):
+    def __init__(self, corpus, parser=sentence_parse, compute_similarities=True, similarity_engine=exhaustive, processes=1,
+                 batch_size=1000, upload_threshold=UPLOAD_THRESHOLD, copy_format='csv', next_id=None):
         """Return a new ingester for the corpus.
         
         parser may be sentence_parse or ngram_parser(n)
+
+        similarity_engine may be any engine from the similarity module,
+        e.g. exhaustive or minhash_lsh(recall)
+
+        processes is the number of worker processes used to parse
+        documents and to compute similarities
+
+        ingest() parses documents batch_size at a time, and uploads
+        whenever upload_threshold bytes of parsed data are waiting
+
+        copy_format is 'csv' to upload with CSV COPY, or 'binary'. Binary
+        isn't the default: its files are about twice the size, and it hasn't
+        uploaded faster, see 'benchmark copy --upload'
+
+        next_id is the ID of the first new document, by default the one
+        after corpus.max_doc_id(). Parses of the same documents take it
+        from next_doc_id(), so that they number the documents alike.
         
         Client must insure that no other ingester is running
         concurrently on the same corpus.
@@ -22,28 +243,33 @@ class DocumentIngester(object):
         self.corpus = corpus
         self.parser = parser
         self.should_compute_similarities = compute_similarities
+        self.similarity_engine = similarity_engine
+        self.processes = processes
+        self.batch_size = batch_size
+        self.upload_threshold = upload_threshold
+
+        if copy_format not in COPY_FORMATS:
+            raise ValueError("copy_format must be one of %s. Got '%s'." % (", ".join(COPY_FORMATS), copy_format))
+        self.copy_format = copy_format
+        self.int_bounds_oid = corpus.type_oid('int_bounds') if copy_format == 'binary' else None
         
-        max_doc_id = corpus.max_doc_id()
-        self.next_id = max_doc_id + 1 if max_doc_id is not None else 0
+        self.next_id = next_id if next_id is not None else next_doc_id([corpus])
         
-        self.document_file = tempfile.TemporaryFile()
-        self.document_writer = UnicodeWriter(self.document_file)
-
-        self.occurrence_file = tempfile.TemporaryFile()
+        self.document_files = self._new_document_files()
         
-        self.sequencer = PhraseSequencer(corpus)
+        self.sequencer = PhraseSequencer(corpus, copy_format=copy_format)
         
     
+    def _new_document_files(self):
+        if self.copy_format == 'binary':
+            return BinaryDocumentFiles(self.corpus.id, self.int_bounds_oid)
+        return CSVDocumentFiles(self.corpus.id)
+
     def _record_document(self, text, phrases, metadata):
         doc_id = self.next_id
         self.next_id += 1
         
-        formatted_metadata = ",".join([('"%s"=>"%s"' % (key, value.replace('\\', '\\\\').replace('"', '\\"'))) for (key, value) in metadata.items()])
-        self.document_writer.writerow([str(self.corpus.id), str(doc_id), text, formatted_metadata])
-        
-        for (phrase_id, indexes) in phrases:
-            formatted_indexes = '"{%s}"' % ", ".join(['""(%s, %s)""' % (start, end) for (start, end) in indexes])
-            self.occurrence_file.write("%s,%s,%s,%s\n" % (self.corpus.id, doc_id, phrase_id, formatted_indexes))
+        self.document_files.write(doc_id, text, phrases, metadata)
 
         return doc_id 
         
@@ -55,82 +281,74 @@ class DocumentIngester(object):
         
         """
         
-        self.document_file.flush()
-        self.document_file.seek(0)
-        self.corpus.upload_csv(self.document_file, 'documents')
-        self.document_file.close()
-        self.document_file = tempfile.TemporaryFile()
-        self.document_writer = csv.writer(self.document_file)
+        self.document_files.upload(self.corpus)
+        self.document_files = self._new_document_files()
 
-        self.occurrence_file.flush()
-        self.occurrence_file.seek(0)
-        self.corpus.upload_csv(self.occurrence_file, 'phrase_occurrences')
-        self.occurrence_file.close()
-        self.occurrence_file = tempfile.TemporaryFile()
 
+    def _pending_upload_bytes(self):
+        return self.document_files.size() + self.sequencer.new_phrase_file.tell()
+
+    def _upload(self):
+        self.sequencer.upload_new_phrases()
+        self._upload_new_documents()
 
     def ingest(self, docs):
-        """Ingest set of new documents"""
+        """Ingest new documents from any iterable, e.g. a generator.
+
+        Documents are parsed in batches and spilled to the COPY temp files,
+        which are uploaded once they pass the upload threshold. Memory use
+        doesn't depend on the number of documents.
+
+        Return the list of new document IDs.
+        """
         
         new_doc_ids = list()
-        
-        print "parsing %s documents..." % len(docs)
-    
-        for doc in docs:
-            if isinstance(doc, basestring):
-                text = doc
-                metadata = {}
-            else:
-                text = doc['text']
-                metadata = doc['metadata']
-
-            phrases = self.parser.__call__(text, self.sequencer)
-            id = self._record_document(text, phrases, metadata)
-            new_doc_ids.append(id)
+        docs = iter(docs)
+
+        pool = _parse_pool(self.parser, self.processes) if self.processes > 1 else None
+
+        try:
+            for batch_number in itertools.count(1):
+                batch = list(itertools.islice(docs, self.batch_size))
+                if not batch:
+                    break
+
+                texts = [doc if isinstance(doc, basestring) else doc['text'] for doc in batch]
+                for (doc, text, phrases) in zip(batch, texts, parse_texts(texts, self.parser, self.sequencer, pool, self.processes)):
+                    metadata = {} if isinstance(doc, basestring) else doc['metadata']
+                    id = self._record_document(text, phrases, metadata)
+                    new_doc_ids.append(id)
+                
+                print "parsed batch %s: %s documents, %s total" % (batch_number, len(batch), len(new_doc_ids))
+
+                if self._pending_upload_bytes() >= self.upload_threshold:
+                    print "uploading documents..."
+                    self._upload()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
             
         print "uploading documents..."
-        
-        self.sequencer.upload_new_phrases()
-        self._upload_new_documents()
+        self._upload()
         
         if self.should_compute_similarities:
             print "computing similarities..."
             self.compute_similarities(new_doc_ids)
 
-    @staticmethod
-    def _pairs_for_comparison(all_ids, new_ids):
-        allowed_ids = set(all_ids)
-        all_ids = list(all_ids)
-        all_ids.sort()
-    
-        new_ids = list(new_ids)
-        new_ids.sort(reverse=True)
-    
-        for x in all_ids:
-            for y in new_ids:
-                if x >= y:
-                    break
-                if y in allowed_ids:
-                    yield (x, y)
+        return new_doc_ids
+
+    _pairs_for_comparison = staticmethod(pairs_for_comparison)
 
     def compute_similarities(self, new_doc_ids=None, min_similarity=0.5):
-        docs = self.corpus.all_docs()
+        if getattr(self.similarity_engine, 'compact', False):
+            docs = self.corpus.all_docs_csr()
+        else:
+            docs = self.corpus.all_docs()
 
         # new_doc_ids is used to keep from recomputing already known similarities.
         # None is special signal to compute on all doc pairs.
         if new_doc_ids is None:
             new_doc_ids = docs.keys()
-    
-        with get_similarity_writer(self.corpus.id) as writer:
-            i = 0
-            for (x, y) in self._pairs_for_comparison(docs.keys(), new_doc_ids):
-                similarity = jaccard(docs[x], docs[y])
-                if similarity >= min_similarity:
-                    writer.write(x, y, similarity)
-                
-                i += 1
-                if i % 10000000 == 0:
-                    writer.flush()
-                    sys.stdout.write('.')
-                    sys.stdout.flush()
 
+        write_similarities(self.corpus.id, docs, new_doc_ids, min_similarity, self.similarity_engine, self.processes)
@@ -5,8 +5,9 @@ from django.db import transaction
 from django.core.management.base import BaseCommand
 
 from analysis.corpus import Corpus, get_corpora_by_metadata, get_dual_corpora_by_metadata
-from analysis.ingestion import DocumentIngester
+from analysis.ingestion import DocumentIngester, next_doc_id
 from analysis.parser import ngram_parser, sentence_parse
+from analysis.similarity import engine_by_name
 from analysis import bsims
 
 from regs_models import Docket, Doc
@@ -46,14 +47,14 @@ def print_stats(docket_id):
         print "Corpus %s (%s) has %s documents." % (corpus.id, corpus.metadata, corpus.num_docs())
 
 
-def ingest_docket(docket_id):
+def ingest_docket(docket_id, similarity_options={}):
     print "Loading docket %s at %s..." % (docket_id, datetime.now())
 
     deletions = list(Doc.objects(docket_id=docket_id, deleted=True, in_cluster_db=True, type='public_submission').scalar('id'))
 
-    insertions = [
-        dict(text=doc_text(d), metadata=doc_metadata(d))
-        for d in Doc.objects(docket_id=docket_id, deleted=False, in_cluster_db=False, type='public_submission')]
+    # only the IDs are held in memory. Documents are streamed from MongoDB
+    # during each parse, in this order, see iter_insertions().
+    insertions = list(Doc.objects(docket_id=docket_id, deleted=False, in_cluster_db=False, type='public_submission').scalar('id'))
 
     
     print "Found %s documents for deletion, %s documents for insertion or update." % (len(deletions), len(insertions))
@@ -62,21 +63,68 @@ def ingest_docket(docket_id):
         return
 
     with transaction.commit_on_success():
-        ingest_single_parse(docket_id, deletions, insertions, 'sentence')
-        ingest_single_parse(docket_id, deletions, insertions, '4-gram')
+        # taken before either parse deletes anything, so both give new documents the same IDs
+        next_id = next_doc_id(get_corpora_by_metadata('docket_id', docket_id))
+
+        # the 4-gram parse is given exactly the documents the sentence parse found,
+        # in the same order, so that both number them alike
+        found = []
+        sentence_ids = ingest_single_parse(docket_id, deletions, insertions, 'sentence', dict(processes=similarity_options.get('processes', 1)), next_id,
+                                           iter_insertions(insertions, found))
+        if len(found) != len(insertions):
+            print "%s documents were no longer in MongoDB and were skipped." % (len(insertions) - len(found))
+        refound = []
+        ngram_ids = ingest_single_parse(docket_id, deletions, insertions, '4-gram', similarity_options, next_id,
+                                        iter_insertions(found, refound))
+        if sentence_ids != ngram_ids or refound != found:
+            raise Exception("Sentence and 4-gram parses of docket %s got different documents (%s and %s). Rolling back." % (docket_id, len(sentence_ids), len(ngram_ids)))
+
+        # the cached hierarchy is the 4-gram corpus', summarized from the sentence corpus.
+        # Without deletions only the new similarities need to be merged into it. New
+        # documents change the phrase counts, so every cluster's summary is scored again.
+        print "Updating hierarchy and summaries at %s..." % datetime.now()
+        c = get_dual_corpora_by_metadata('docket_id', docket_id)
+        if c:
+            c.refresh_summaries()
 
     print "Marking MongoDB documents as analyzed at %s..." % datetime.now()
-    update_count = Doc.objects(id__in=[d['metadata']['document_id'] for d in insertions]) \
+    update_count = Doc.objects(id__in=found) \
                       .update(set__in_cluster_db=True)
-    if update_count != len(insertions):
-        print "ERROR: %s documents inserted into Postgres, but only %s documents marked as analyzed in MongoDB." % (len(insertions), update_count)
+    if update_count != len(found):
+        print "ERROR: %s documents inserted into Postgres, but only %s documents marked as analyzed in MongoDB." % (len(found), update_count)
     update_count = Doc.objects(id__in=deletions) \
                       .update(set__in_cluster_db=False)
     if update_count != len(deletions):
         print "ERROR: %s documents deleted in Postgres, but only %s documents marked as deleted in MongoDB." % (len(deletions), update_count)
 
 
-def ingest_single_parse(docket_id, deletions, insertions, parser):
+# documents fetched from MongoDB per query while parsing
+INSERTION_BATCH_SIZE = 1000
+
+def iter_insertions(insertions, found):
+    """Yield the ingester input for each of the given document IDs, in their order.
+
+    Documents are fetched a batch at a time, since MongoDB doesn't promise
+    any order. Documents no longer in MongoDB are skipped, and the IDs of
+    the others are appended to found as they're yielded.
+    """
+
+    for start in range(0, len(insertions), INSERTION_BATCH_SIZE):
+        batch = insertions[start:start + INSERTION_BATCH_SIZE]
+        docs = dict((d.id, d) for d in Doc.objects(id__in=batch))
+        for id in batch:
+            if id in docs:
+                found.append(id)
+                yield dict(text=doc_text(docs[id]), metadata=doc_metadata(docs[id]))
+
+
+def ingest_single_parse(docket_id, deletions, insertions, parser, similarity_options={}, next_id=None, docs=None):
+    """Replace the docket's deleted and inserted documents in the given parse.
+
+    docs are the ingester inputs of the insertions, by default read with
+    iter_insertions(). Returns the new document IDs.
+    """
+
     if parser not in ('sentence', '4-gram'):
         raise "Parser must be one of 'sentence' or '4-gram'. Got '%s'." % parser
 
@@ -95,23 +143,20 @@ def ingest_single_parse(docket_id, deletions, insertions, parser):
         print "Updating existing corpus #%s for %s parse." % (c.id, parser)
         
         print "Deleting documents at %s..." % datetime.now()
-        c.delete_by_metadata('document_id', deletions + [d['metadata']['document_id'] for d in insertions])
+        c.delete_by_metadata('document_id', deletions + insertions)
     
     else:
         raise "More than one sentence parse for docket %s found. Shouldn't happen--will need ot manually remove extra corpora." % docket_id
     
     print "Inserting documents at %s..." % datetime.now()
     if parser == 'sentence':
-        i = DocumentIngester(c, parser=sentence_parse, compute_similarities=False)
+        i = DocumentIngester(c, parser=sentence_parse, compute_similarities=False, next_id=next_id, **similarity_options)
     elif parser == '4-gram':
-        i = DocumentIngester(c, parser=ngram_parser(4), compute_similarities=True)
-    i.ingest(insertions)
+        i = DocumentIngester(c, parser=ngram_parser(4), compute_similarities=True, next_id=next_id, **similarity_options)
+    return i.ingest(docs if docs is not None else iter_insertions(insertions, []))
 
-    print "Removing hierarchy, if cached, at %s..." % datetime.now()
-    c.delete_hierarchy_cache()
 
-
-def repair_missing_docket(docket_id):
+def repair_missing_docket(docket_id, similarity_options={}):
     """Recreate any dockets that Mongo thinks are analyzed already but aren't in Postgres.
 
     Note that this is a very limited form or repair, corresponding to the particular
@@ -131,14 +176,14 @@ def repair_missing_docket(docket_id):
         # neither parse exists, mark as unclustered in Mongo
         update_count = Doc.objects(docket_id=docket_id, in_cluster_db=True).update(set__in_cluster_db=False)
         print "Docket %s missing in Postgres. Marked %s documents with in_cluster_db=False." % (docket_id, update_count)
-        ingest_docket(docket_id)
+        ingest_docket(docket_id, similarity_options)
     elif len(corpora) == 1 or len(corpora) > 2:
         # we have a single or multiple parses...that's something unexpected that we can't fix automatically
         raise "Found %s corpora for docket %s. Expected either 0 or 2 corpora. Must fix by hand." % (len(corpora), docket_id)
 
     # both parses exist, everything's fine
 
-def repair_missing_sims(docket_id):
+def repair_missing_sims(docket_id, similarity_options={}):
     """Repair the situation where a docket is correct in Mongo and Postgres,
     but the similarity directory is missing."""
 
@@ -146,7 +191,7 @@ def repair_missing_sims(docket_id):
         c = get_dual_corpora_by_metadata('docket_id', docket_id)
         if c and not bsims.exists(c.id):
                 print "Docket %s (id=%s) missing similarities. Starting recomputation at %s..." % (docket_id, c.id, datetime.now())
-                i = DocumentIngester(c)
+                i = DocumentIngester(c, **similarity_options)
                 i.compute_similarities()
 
 
@@ -161,15 +206,22 @@ def delete_analysis(docket_id):
         Doc.objects(docket_id=docket_id).update(set__in_cluster_db=False)
 
 def process_docket(docket_id, options):
+    # keyword arguments for the 4-gram DocumentIngester. The sentence
+    # ingester only uses the process count, for parsing.
+    similarity_options = dict(
+        similarity_engine=engine_by_name(options.get('similarity') or 'exhaustive'),
+        processes=int(options.get('processes') or 1),
+    )
+
     with transaction.commit_manually():
         if options.get('repair'):
-            repair_missing_docket(docket_id)
+            repair_missing_docket(docket_id, similarity_options)
         elif options.get('delete'):
             delete_analysis(docket_id)
         elif options.get('repair_sims'):
-            repair_missing_sims(docket_id)
+            repair_missing_sims(docket_id, similarity_options)
         else:
-            ingest_docket(docket_id)
+            ingest_docket(docket_id, similarity_options)
 
 class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
@@ -178,6 +230,8 @@ class Command(BaseCommand):
         make_option('-r', "--repair", dest='repair', action="store_true"),
         make_option("--delete", dest='delete', action='store_true'),
         make_option("--repair_sims", dest='repair_sims', action='store_true'),
+        make_option("--similarity", dest='similarity', default='exhaustive'),
+        make_option('-p', "--processes", dest='processes', default=1),
         make_option('-F', "--fork", dest="fork", action="store_true"),
         make_option("--parsable", dest="parsable", action="store_true")
     )
@@ -0,0 +1,22 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    args = '<%s>' % '|'.join(sorted(BENCHMARKS))
+    option_list = BaseCommand.option_list + (
+        make_option('-c', "--corpus", dest="corpus"),
+        make_option('-n', "--docs", dest="docs"),
+        make_option("--min_similarity", dest="min_similarity"),
+        make_option('-p', "--processes", dest="processes"),
+        make_option("--upload", dest="upload", action="store_true"),
+    )
+
+    def handle(self, name=None, **options):
+        if name not in BENCHMARKS:
+            raise CommandError("Benchmark must be one of %s." % ", ".join(sorted(BENCHMARKS)))
+
+        BENCHMARKS[name](options)
@@ -0,0 +1,22 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis import bsims
+
+
+class Command(BaseCommand):
+    help = "Compact the similarity stores of the given corpora, or of all corpora, that need it."
+    args = '<corpus_id corpus_id ...>'
+    option_list = BaseCommand.option_list + (
+        make_option('-a', "--all", dest="all", action="store_true", help="Compact every corpus with a similarity store."),
+        make_option('-f', "--force", dest="force", action="store_true", help="Compact even stores that don't need it."),
+    )
+
+    def handle(self, *corpus_ids, **options):
+        if options.get('all'):
+            corpus_ids = bsims.stored_corpora()
+        elif not corpus_ids:
+            raise CommandError("Give corpus IDs, or --all.")
+
+        bsims.bulk_compact([int(id) for id in corpus_ids], force=options.get('force'))
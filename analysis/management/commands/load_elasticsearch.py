@@ -13,18 +13,20 @@ from analysis.parser import ngram_parser
 
 
 def load_docket(es_endpoint, docket):
-    docs = list()
-    
+    """Yield the documents of a docket, ready for DocumentIngester.ingest()."""
+
     query = {'size':1000000, 'filter': { 'term': { 'docket_id': docket } } }
     request = urllib2.urlopen(es_endpoint, json.dumps(query))
     results = json.load(request)
 
-    for r in results['hits']['hits']:
+    # hand off and drop one hit at a time, so the texts aren't held twice
+    hits = results['hits']['hits']
+    hits.reverse()
+    while hits:
+        r = hits.pop()
         text = "\n".join([file['text'] for file in r['_source']['files'] if len(file['text']) > 0])
         metadata = dict([(key, unicode(value)) for (key, value) in r['_source'].items() if key != 'files' and value is not None])
-        docs.append(dict(text=text, metadata=metadata))
-    
-    return docs
+        yield dict(text=text, metadata=metadata)
 
 def ingest_docket(agency, docket, docs, ngrams=None):
     print "Beginning processing %s at %s" % (docket, datetime.now())
@@ -36,10 +38,10 @@ def ingest_docket(agency, docket, docs, ngrams=None):
         i = DocumentIngester(c, parser=ngram_parser(int(ngrams)))
     else:
         i = DocumentIngester(c)
-    i.ingest(docs)
+    doc_ids = i.ingest(docs)
     
     print "Finished processing at %s" % datetime.now()
-    print "Added %d documents in corpus %d" % (len(docs), c.id)
+    print "Added %d documents in corpus %d" % (len(doc_ids), c.id)
 
 def get_dockets(es_endpoint, agency):
 
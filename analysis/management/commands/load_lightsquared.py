@@ -14,11 +14,10 @@ class Command(BaseCommand):
     option_list = BaseCommand.option_list + (make_option("-n", "--ngrams", dest="ngrams"),)
     
     def handle(self, ls_docs_path, **options):
-        docs = list()
-        for doc in json.load(open(ls_docs_path, 'r')):
-            docs += [d['text'] for d in doc['documents'] if d.get('text')]
-
-        cleaned_docs = [d.encode('ascii', 'replace') for d in docs]
+        cleaned_docs = (
+            d['text'].encode('ascii', 'replace')
+            for doc in json.load(open(ls_docs_path, 'r'))
+            for d in doc['documents'] if d.get('text'))
 
         print "Beginning processing at %s" % datetime.now()
 
@@ -28,10 +27,10 @@ class Command(BaseCommand):
                 i = DocumentIngester(c, parser=ngram_parser(int(options['ngrams'])))
             else:
                 i = DocumentIngester(c)
-            i.ingest(cleaned_docs)
+            doc_ids = i.ingest(cleaned_docs)
 
         print "Finished processing at %s" % datetime.now()
         
-        print "Added %d documents in corpus %d" % (len(cleaned_docs), c.id)
+        print "Added %d documents in corpus %d" % (len(doc_ids), c.id)
 
 
@@ -0,0 +1,168 @@
+try:
+    import numpypy as numpy
+except ImportError:
+    import numpy
+
+from partition import Partition
+
+
+class NumpyPartition(Partition):
+    """Union/find over NumPy arrays, merging whole arrays of pairs at once.
+
+    A drop-in for Partition where merging one pair at a time is the
+    bottleneck: merge_many() joins a chunk of pairs in a few vectorized
+    rounds, and find_all() returns every root in one call. sets() and
+    sets_overview() return arrays rather than lists and dicts, as
+    cPartition's do, so the two can replace each other.
+    """
+
+    def __init__(self, values):
+        """Create a partition of the given values.
+
+        Elements of values must be unique integers, or behavior will be undefined.
+        """
+
+        self.values = numpy.array(values, numpy.int32)
+
+        # document IDs are mostly dense, so positions are normally looked up
+        # in a table indexed by value. Otherwise they're searched for.
+        low = self.values.min() if len(self.values) else 0
+        span = self.values.max() - low + 1 if len(self.values) else 0
+        if span <= 4 * len(self.values) + 1024:
+            self._low = low
+            self._table = numpy.zeros(span, numpy.int32)
+            self._table[self.values - low] = numpy.arange(len(self.values), dtype=numpy.int32)
+        else:
+            self._table = None
+            self._value_order = numpy.argsort(self.values, kind='mergesort').astype(numpy.int32)
+            self._sorted_values = self.values[self._value_order]
+
+        self.parent = numpy.arange(len(self.values), dtype=numpy.int32)
+        self.rank = numpy.zeros(len(self.values), numpy.int32)
+
+    def positions(self, values):
+        """Return the positions of an array of values.
+
+        Raises KeyError if any of them isn't in the partition, as Partition does.
+        """
+
+        values = numpy.asarray(values)
+        if not len(self.values):
+            if values.size:
+                raise KeyError(values.flat[0].item())
+            return values.astype(numpy.int32)
+
+        if self._table is not None:
+            offsets = values.astype(numpy.int64) - self._low
+            known = (offsets >= 0) & (offsets < len(self._table))
+            positions = self._table[numpy.where(known, offsets, 0)]
+        else:
+            positions = self._value_order[numpy.searchsorted(self._sorted_values, values).clip(0, len(self.values) - 1)]
+            known = numpy.ones(values.shape, bool)
+
+        # values missing from the table, or between the sorted values, land on another value
+        known &= self.values[positions] == values
+        if not known.all():
+            raise KeyError(numpy.atleast_1d(values)[~numpy.atleast_1d(known)][0].item())
+        return positions
+
+    def _find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return int(x)
+
+    def merge(self, x, y):
+        """Combine the set containing x with the set containing y."""
+
+        xRoot = self._find(self.positions(x))
+        yRoot = self._find(self.positions(y))
+        if xRoot == yRoot:
+            return
+
+        if self.rank[xRoot] < self.rank[yRoot]:
+            self.parent[xRoot] = yRoot
+        elif self.rank[xRoot] > self.rank[yRoot]:
+            self.parent[yRoot] = xRoot
+        else:
+            self.parent[yRoot] = xRoot
+            self.rank[xRoot] += 1
+
+    def merge_many(self, xs, ys):
+        """Combine the set containing xs[i] with the set containing ys[i], for every i.
+
+        Each round hooks the larger of every pair of distinct roots under
+        the smallest root it's paired with, then points every position
+        straight at its root. Pairs joined by a round are dropped from the
+        next.
+        """
+
+        roots = self.find_all()
+        xs = roots[self.positions(numpy.asarray(xs))]
+        ys = roots[self.positions(numpy.asarray(ys))]
+
+        while True:
+            unmerged = xs != ys
+            if not unmerged.any():
+                return
+            (xs, ys) = (xs[unmerged], ys[unmerged])
+
+            # sorting high * n + low puts the smallest low first for each high
+            n = len(self.parent)
+            keys = numpy.maximum(xs, ys).astype(numpy.int64) * n + numpy.minimum(xs, ys)
+            keys.sort()
+            (high, low) = (keys // n, keys % n)
+            first = numpy.concatenate([[True], high[1:] != high[:-1]])
+            self.parent[high[first]] = low[first]
+
+            roots = self.find_all()
+            (xs, ys) = (roots[xs], roots[ys])
+
+    def merge_pairs(self, pairs):
+        """Combine the sets of each row of a (k, 2) array of values."""
+
+        self.merge_many(pairs[:, 0], pairs[:, 1])
+
+    def find_all(self):
+        """Return the root position of every position, compressing all paths."""
+
+        parent = self.parent
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+
+        self.parent = parent
+        return parent
+
+    def sets(self):
+        """Return the grouped values as (offsets, members) arrays.
+
+        The values of set i are members[offsets[i]:offsets[i + 1]].
+        """
+
+        roots = self.find_all()
+        order = numpy.argsort(roots, kind='mergesort')
+        sizes = numpy.bincount(roots, minlength=len(roots))
+        offsets = numpy.concatenate([[0], numpy.cumsum(sizes[sizes > 0])]).astype(numpy.int32)
+        return (offsets, self.values[order])
+
+    def sets_overview(self):
+        """Return the representative and size of each set, as two arrays."""
+
+        sizes = numpy.bincount(self.find_all(), minlength=len(self.values))
+        roots = numpy.flatnonzero(sizes)
+        return (self.values[roots], sizes[roots])
+
+    def group(self, x):
+        """Return set of all items grouped with x."""
+
+        roots = self.find_all()
+        return set(self.values[roots == roots[self.positions(x)]].tolist())
+
+    def representative(self, x):
+        """Return the value that represents the set containing x."""
+
+        return int(self.values[self._find(self.positions(x))])
@@ -0,0 +1,166 @@
+"""Compact encodings of arrays of uint32 document pairs.
+
+Pairs are sorted by their first document, x. Each distinct x is stored
+once, as the difference from the previous one, with the number of pairs
+it has. The second documents, y, are stored as differences too: the first
+y of each x as its zigzag encoded difference from x, the rest as the
+difference from the y before. Similar documents tend to have nearby IDs,
+so most numbers are small, and all are written as LEB128 varints, one to
+five bytes each.
+
+Encoding and decoding are vectorized with NumPy. Pair order isn't kept.
+
+ScoredPairCodec instead stores pairs with a one-byte score each, highest
+score first.
+"""
+
+import struct
+
+try:
+    import numpypy as numpy
+except ImportError:
+    import numpy
+
+
+_HEADER = struct.Struct('<II')
+
+# a pair and its score, as given to ScoredPairCodec.encode()
+SCORED_PAIR = numpy.dtype([('pair', '<u4', (2,)), ('score', 'u1')])
+
+# a zigzag encoded uint32 difference needs up to 33 bits
+_MAX_VARINT_BYTES = 5
+
+
+def encode_varints(values):
+    """Return the LEB128 encoding of an array of non-negative integers below 2 ** 35."""
+
+    values = numpy.asarray(values, numpy.uint64)
+    lengths = numpy.ones(len(values), numpy.int64)
+    for k in range(1, _MAX_VARINT_BYTES):
+        lengths += values >= numpy.uint64(1 << (7 * k))
+
+    starts = numpy.cumsum(lengths) - lengths
+    encoded = numpy.zeros(int(lengths.sum()), numpy.uint8)
+    for k in range(_MAX_VARINT_BYTES):
+        has_byte = lengths > k
+        byte = (values[has_byte] >> numpy.uint64(7 * k)) & numpy.uint64(0x7f)
+        more = (lengths[has_byte] > k + 1).astype(numpy.uint64) << numpy.uint64(7)
+        encoded[starts[has_byte] + k] = byte | more
+    return encoded
+
+
+def decode_varints(encoded):
+    """Return the uint64 array of the LEB128 varints in a uint8 array."""
+
+    encoded = numpy.asarray(encoded, numpy.uint8)
+    # each varint ends with its most significant byte, the only one below 0x80
+    ends = numpy.flatnonzero(encoded < 0x80)
+    lengths = numpy.diff(numpy.concatenate([[-1], ends]))
+
+    values = encoded[ends].astype(numpy.uint64)
+    longer = numpy.flatnonzero(lengths > 1)
+    for k in range(1, _MAX_VARINT_BYTES):
+        longer = longer[lengths[longer] > k]
+        if not len(longer):
+            break
+        lower = (encoded[ends[longer] - k] & 0x7f).astype(numpy.uint64)
+        values[longer] = (values[longer] << numpy.uint64(7)) | lower
+    return values
+
+
+def encode_pairs(pairs):
+    """Return the encoding of a (k, 2) array of uint32 pairs as a string."""
+
+    pairs = numpy.asarray(pairs, numpy.int64).reshape(-1, 2)
+    order = numpy.lexsort((pairs[:, 1], pairs[:, 0]))
+    (xs, ys) = (pairs[order, 0], pairs[order, 1])
+
+    first = numpy.concatenate([[True], xs[1:] != xs[:-1]]) if len(xs) else numpy.zeros(0, bool)
+    group_xs = xs[first]
+    counts = numpy.diff(numpy.append(numpy.flatnonzero(first), len(xs)))
+
+    y_deltas = numpy.empty(len(ys), numpy.int64)
+    y_deltas[1:] = ys[1:] - ys[:-1]
+    first_deltas = ys[first] - group_xs
+    y_deltas[first] = (first_deltas << 1) ^ (first_deltas >> 63)
+
+    x_deltas = numpy.diff(numpy.concatenate([[0], group_xs]))
+    body = encode_varints(numpy.concatenate([x_deltas, counts, y_deltas]))
+    return _HEADER.pack(len(group_xs), len(xs)) + body.tostring()
+
+
+def decode_pairs(data):
+    """Return the (k, 2) uint32 array of pairs encoded in a string by encode_pairs()."""
+
+    (num_groups, num_pairs) = _HEADER.unpack_from(data)
+    values = decode_varints(numpy.fromstring(data[_HEADER.size:], numpy.uint8)).astype(numpy.int64)
+    (x_deltas, counts, y_deltas) = (values[:num_groups], values[num_groups:2 * num_groups], values[2 * num_groups:])
+
+    group_xs = numpy.cumsum(x_deltas)
+    xs = numpy.repeat(group_xs, counts)
+
+    starts = numpy.cumsum(counts) - counts
+    zigzag = y_deltas[starts]
+    deltas = y_deltas.copy()
+    deltas[starts] = group_xs + ((zigzag >> 1) ^ -(zigzag & 1))
+    # running sums restarted at each group's first y
+    sums = numpy.cumsum(deltas)
+    ys = sums - numpy.repeat(sums[starts] - deltas[starts], counts)
+
+    pairs = numpy.empty((num_pairs, 2), numpy.uint32)
+    pairs[:, 0] = xs
+    pairs[:, 1] = ys
+    return pairs
+
+
+class PairCodec(object):
+    """Codec for LZ4CompressedWriter and LZ4CompressedReader, between raw uint32 pair bytes and their encoding."""
+
+    @staticmethod
+    def encode(data):
+        return encode_pairs(numpy.fromstring(data, numpy.uint32))
+
+    @staticmethod
+    def decode(data):
+        return decode_pairs(data).tostring()
+
+
+def scored_records(pairs, scores):
+    """Return a (k, 2) array of pairs and their uint8 scores as a string of SCORED_PAIR records."""
+
+    pairs = numpy.asarray(pairs, numpy.uint32).reshape(-1, 2)
+    records = numpy.empty(len(pairs), SCORED_PAIR)
+    records['pair'] = pairs
+    records['score'] = scores
+    return records.tostring()
+
+
+class ScoredPairCodec(object):
+    """Codec for LZ4CompressedWriter and LZ4CompressedReader, between SCORED_PAIR records and pairs.
+
+    Encoded chunks hold the pairs, highest score first, followed by their
+    scores. Decoding returns just the pairs, and the pairs at or above any
+    score are a prefix of them.
+    """
+
+    @staticmethod
+    def encode(data):
+        records = numpy.fromstring(data, SCORED_PAIR)
+        records = records[numpy.argsort(-records['score'].astype(numpy.int16), kind='mergesort')]
+        return records['pair'].tostring() + records['score'].tostring()
+
+    @staticmethod
+    def decode(data):
+        return data[:len(data) / SCORED_PAIR.itemsize * 8]
+
+    @staticmethod
+    def scores(data):
+        """Return the descending uint8 scores of an encoded chunk."""
+        return numpy.fromstring(data[len(data) / SCORED_PAIR.itemsize * 8:], numpy.uint8)
+
+    @staticmethod
+    def describe(data):
+        """Return the manifest fields of an encoded chunk, its highest and lowest score."""
+        scores = ScoredPairCodec.scores(data)
+        return dict(max_score=int(scores[0]) if len(scores) else None,
+                    min_score=int(scores[-1]) if len(scores) else None)
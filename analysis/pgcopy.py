@@ -0,0 +1,138 @@
+"""Writer for PostgreSQL's binary COPY format.
+
+Binary COPY skips the text parsing Postgres does for CSV, and lets arrays
+and composite values be sent without building their text literals. See
+http://www.postgresql.org/docs/current/static/sql-copy.html for the file
+format, and the *_send functions in the Postgres source for the encoding
+of each type.
+
+Every value is written with its length, so nothing needs escaping.
+"""
+
+import struct
+
+from utils import UnicodeWriter
+
+
+HEADER = 'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+TRAILER = struct.pack('>h', -1)
+NULL = struct.pack('>i', -1)
+
+INT4_OID = 23
+
+
+def encode_integer(value):
+    return struct.pack('>i', value)
+
+def encode_text(value):
+    if isinstance(value, unicode):
+        data = value.encode('utf8')
+        # every UTF-8 encoded surrogate starts with \xed
+        if '\xed' not in data:
+            return data
+    return UnicodeWriter._encode(value)
+
+def encode_hstore(mapping):
+    parts = [struct.pack('>i', len(mapping))]
+    for (key, value) in mapping.iteritems():
+        key = encode_text(key)
+        parts.append(struct.pack('>i', len(key)))
+        parts.append(key)
+        if value is None:
+            parts.append(NULL)
+        else:
+            value = encode_text(value)
+            parts.append(struct.pack('>i', len(value)))
+            parts.append(value)
+    return ''.join(parts)
+
+def int_bounds_array_encoder(int_bounds_oid):
+    """Return an encoder of int_bounds[] values from lists of (start, end) pairs.
+
+    Arrays carry the OID of their element type, which is looked up per
+    database, see Corpus.type_oid().
+    """
+
+    # each element is its length, then a record of two int4 columns,
+    # each column its type, length and value.
+    element_format = 'iiiiiiii'
+    element_length = 4 + 2 * 12
+
+    def encode(bounds):
+        if not bounds:
+            return struct.pack('>iii', 0, 0, int_bounds_oid)
+
+        header = struct.pack('>iiiii', 1, 0, int_bounds_oid, len(bounds), 1)
+        elements = [v for (start, end) in bounds for v in (element_length, 2, INT4_OID, 4, start, INT4_OID, 4, end)]
+        return header + struct.pack('>' + element_format * len(bounds), *elements)
+
+    return encode
+
+
+class BinaryCopyWriter(object):
+    """Write rows to a file in binary COPY format, encoding column i with encoders[i].
+
+    close() must be called before the file is uploaded.
+    """
+
+    def __init__(self, f, encoders):
+        self.file = f
+        self.encoders = encoders
+        self.field_count = struct.pack('>h', len(encoders))
+
+        self.file.write(HEADER)
+
+    def writerow(self, row):
+        parts = [self.field_count]
+        for (encode, value) in zip(self.encoders, row):
+            if value is None:
+                parts.append(NULL)
+            else:
+                data = encode(value)
+                parts.append(struct.pack('>i', len(data)))
+                parts.append(data)
+        self.file.write(''.join(parts))
+
+    def close(self):
+        self.file.write(TRAILER)
+
+
+class OccurrenceWriter(BinaryCopyWriter):
+    """BinaryCopyWriter for phrase_occurrences rows, which are by far the most numerous.
+
+    Rows are packed with precompiled structs rather than column by column.
+    """
+
+    _header = struct.Struct('>h' + 'ii' * 3 + 'i' + 'iiiii')
+    _element = struct.Struct('>iiiiiiii')
+
+    def __init__(self, f, int_bounds_oid):
+        BinaryCopyWriter.__init__(self, f, [encode_integer, encode_integer, encode_integer, int_bounds_array_encoder(int_bounds_oid)])
+        self.int_bounds_oid = int_bounds_oid
+
+    def writerow(self, row):
+        (corpus_id, doc_id, phrase_id, bounds) = row
+        n = len(bounds)
+        if n == 0:
+            return BinaryCopyWriter.writerow(self, row)
+
+        parts = [self._header.pack(4, 4, corpus_id, 4, doc_id, 4, phrase_id, 20 + 32 * n, 1, 0, self.int_bounds_oid, n, 1)]
+        for (start, end) in bounds:
+            parts.append(self._element.pack(28, 2, INT4_OID, 4, start, INT4_OID, 4, end))
+        self.file.write(''.join(parts))
+
+
+def document_writer(f):
+    """Writer for rows of the documents table: (corpus_id, document_id, text, metadata dict)."""
+
+    return BinaryCopyWriter(f, [encode_integer, encode_integer, encode_text, encode_hstore])
+
+def phrase_writer(f):
+    """Writer for rows of the phrases table: (corpus_id, phrase_id, phrase_text)."""
+
+    return BinaryCopyWriter(f, [encode_integer, encode_integer, encode_text])
+
+def occurrence_writer(f, int_bounds_oid):
+    """Writer for rows of the phrase_occurrences table: (corpus_id, document_id, phrase_id, [(start, end), ...])."""
+
+    return OccurrenceWriter(f, int_bounds_oid)
@@ -1,52 +1,250 @@
 
 import tempfile
 import csv
+import hashlib
+import itertools
+import os
+import shutil
+import struct
+import uuid
+
+try:
+    import numpypy as numpy
+except ImportError:
+    import numpy
+
+from bsims import DATA_DIR
+import pgcopy
+
+
+def phrase_hash(phrase):
+    """Return the (key, check) pair of 64-bit halves of the phrase's MD5."""
+
+    if isinstance(phrase, unicode):
+        phrase = phrase.encode('utf-8')
+    return struct.unpack('<QQ', hashlib.md5(phrase).digest())
+
+
+class PhraseDictionary(object):
+    """Map from phrase text to phrase ID that doesn't hold the phrase text.
+
+    Phrases are stored as three parallel arrays sorted by key: the two
+    halves of each phrase's MD5 and its phrase ID, 20 bytes per phrase.
+    Saved dictionaries are memory mapped when loaded, so opening one costs
+    next to nothing however large the corpus is.
+
+    Phrases are found by key and confirmed by check. If the key matches
+    but the check doesn't, the phrase may or may not be in the corpus,
+    and get() asks the fallback, normally a lookup in the phrases table.
+
+    Each version of a dictionary has a random token. The corpus records the
+    token of the version matching its phrases table in the phrase_dictionary
+    column of corpora, see open_phrase_dictionary().
+    """
+
+    def __init__(self, keys, checks, ids, token=None):
+        self.keys = keys
+        self.checks = checks
+        self.ids = ids
+        self.token = token or uuid.uuid4().hex
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_phrases(cls, phrases):
+        """Return a dictionary of (phrase_id, phrase_text) pairs."""
+
+        d = cls(numpy.zeros(0, numpy.uint64), numpy.zeros(0, numpy.uint64), numpy.zeros(0, numpy.int32))
+        return d.merged(phrases)
+
+    def get(self, phrase, fallback):
+        (key, check) = phrase_hash(phrase)
+        key = numpy.uint64(key)
+        check = numpy.uint64(check)
+
+        start = self.keys.searchsorted(key, 'left')
+        end = self.keys.searchsorted(key, 'right')
+        if start == end:
+            return None
+
+        for i in xrange(start, end):
+            if self.checks[i] == check:
+                return int(self.ids[i])
+
+        # key collided with a different phrase's
+        return fallback(phrase)
+
+    def merged(self, phrases, chunk_size=100000):
+        """Return a new version of the dictionary with the given (phrase_id, phrase_text) pairs added."""
+
+        (keys, checks, ids) = ([self.keys], [self.checks], [self.ids])
+
+        phrases = iter(phrases)
+        for chunk in iter(lambda: list(itertools.islice(phrases, chunk_size)), []):
+            hashes = numpy.array([phrase_hash(text) for (_, text) in chunk], numpy.uint64).reshape(-1, 2)
+            keys.append(hashes[:, 0])
+            checks.append(hashes[:, 1])
+            ids.append(numpy.array([phrase_id for (phrase_id, _) in chunk], numpy.int32))
+
+        keys = numpy.concatenate(keys)
+        order = keys.argsort(kind='mergesort')
+        return PhraseDictionary(keys[order], numpy.concatenate(checks)[order], numpy.concatenate(ids)[order])
+
+    def without(self, phrase_ids):
+        """Return a new version of the dictionary with the given phrase IDs removed."""
+
+        keep = ~numpy.in1d(self.ids, numpy.array(list(phrase_ids), numpy.int32))
+        return PhraseDictionary(self.keys[keep], self.checks[keep], self.ids[keep])
+
+    @staticmethod
+    def path(corpus_id, root=DATA_DIR):
+        return os.path.join(root, "%s.phrases" % corpus_id)
+
+    @classmethod
+    def load(cls, corpus_id, root=DATA_DIR):
+        """Return the saved dictionary for the corpus, or None if there isn't one."""
+
+        path = cls.path(corpus_id, root)
+        if not os.path.isdir(path):
+            return None
+
+        token = open(os.path.join(path, 'token')).read()
+        arrays = [numpy.load(os.path.join(path, '%s.npy' % name), mmap_mode='r') for name in ('keys', 'checks', 'ids')]
+        return cls(*arrays, token=token)
+
+    def save(self, corpus_id, root=DATA_DIR):
+        """Replace the saved dictionary for the corpus with this version."""
+
+        path = self.path(corpus_id, root)
+        new_path = "%s.%s.new" % (path, self.token)
+        old_path = "%s.%s.old" % (path, self.token)
+
+        os.mkdir(new_path)
+        for (name, array) in (('keys', self.keys), ('checks', self.checks), ('ids', self.ids)):
+            numpy.save(os.path.join(new_path, '%s.npy' % name), array)
+        with open(os.path.join(new_path, 'token'), 'w') as f:
+            f.write(self.token)
+
+        if os.path.isdir(path):
+            os.rename(path, old_path)
+        os.rename(new_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+
+def open_phrase_dictionary(corpus, root=DATA_DIR):
+    """Return the corpus' saved phrase dictionary.
+
+    The dictionary is rebuilt from the phrases table if it's missing, or if
+    its token isn't the one recorded on the corpus, e.g. because the
+    transaction that last changed the phrases was rolled back.
+    """
+
+    d = PhraseDictionary.load(corpus.id, root)
+    if d is None or d.token != corpus.phrase_dictionary_token():
+        d = PhraseDictionary.from_phrases(corpus.iter_phrases())
+        _save(corpus, d, root)
+        d = PhraseDictionary.load(corpus.id, root)
+    return d
+
+
+def remove_phrases(corpus, phrase_ids, root=DATA_DIR):
+    """Remove deleted phrases from the corpus' saved phrase dictionary."""
+
+    d = PhraseDictionary.load(corpus.id, root)
+    # an out of date dictionary will be rebuilt when next opened
+    if not phrase_ids or d is None or d.token != corpus.phrase_dictionary_token():
+        return
+
+    _save(corpus, d.without(phrase_ids), root)
+
+
+def remove_phrase_dictionary(corpus_id, root=DATA_DIR):
+    shutil.rmtree(PhraseDictionary.path(corpus_id, root), ignore_errors=True)
+
+
+def _save(corpus, d, root):
+    d.save(corpus.id, root)
+    corpus.set_phrase_dictionary_token(d.token)
 
 
 class PhraseSequencer(object):
 
-    def __init__(self, corpus):
-        """Initialize the sequencer from stored phrases"""
+    def __init__(self, corpus, root=DATA_DIR, copy_format='csv'):
+        """Initialize the sequencer from stored phrases
+
+        New phrases are uploaded as CSV, or with binary COPY if copy_format is 'binary'.
+        """
 
         self.corpus = corpus
-        
+        self.root = root
+        self.copy_format = copy_format
+
         max_phrase_id = self.corpus.max_phrase_id()
         self.next_id = max_phrase_id + 1 if max_phrase_id is not None else 0
-        
-        self.phrase_map = self.corpus.all_phrases()
-        
+
+        self.dictionary = open_phrase_dictionary(corpus, root)
+
+        # phrases seen since the last upload, and the new ones among them
+        self.phrase_map = {}
+        self.new_phrases = []
+
+        self._open_phrase_file()
+
+    def _open_phrase_file(self):
         self.new_phrase_file = tempfile.TemporaryFile()
+        self.new_phrase_writer = pgcopy.phrase_writer(self.new_phrase_file) if self.copy_format == 'binary' else None
 
     def sequence(self, phrase):
         """Return a unique integer for the phrase
-        
+
         If phrase is new, record for later upload to database.
-        
+
         WARNING: For performance reasons (CSV lib is very slow under pypy),
-        no escaping is done in CSV upload to database. Therefore phrase
-        must not contain any control characters--newlines, quotes or commas.
-        
+        no escaping is done in CSV upload to database. Therefore with the
+        CSV copy_format, phrase must not contain any control characters--
+        newlines, quotes or commas.
+
         """
 
         phrase_id = self.phrase_map.get(phrase, None)
         if phrase_id is not None:
             return phrase_id
-        
-        phrase_id = self.next_id
-        self.next_id += 1
+
+        phrase_id = self.dictionary.get(phrase, self.corpus.phrase_id)
+        if phrase_id is None:
+            phrase_id = self.next_id
+            self.next_id += 1
+
+            self.new_phrases.append((phrase_id, phrase))
+            if self.new_phrase_writer is not None:
+                self.new_phrase_writer.writerow((self.corpus.id, phrase_id, phrase))
+            else:
+                self.new_phrase_file.write("%s,%s,%s\n" % (self.corpus.id, phrase_id, phrase))
 
         self.phrase_map[phrase] = phrase_id
-        self.new_phrase_file.write("%s,%s,%s\n" % (self.corpus.id, phrase_id, phrase))
-        
-        return phrase_id 
+
+        return phrase_id
 
     def upload_new_phrases(self):
         """Upload phrases created during use of sequencer"""
-        
+
+        if self.new_phrase_writer is not None:
+            self.new_phrase_writer.close()
         self.new_phrase_file.flush()
         self.new_phrase_file.seek(0)
-        
-        self.corpus.upload_csv(self.new_phrase_file, 'phrases')
-        
+
+        if self.copy_format == 'binary':
+            self.corpus.upload_binary(self.new_phrase_file, 'phrases')
+        else:
+            self.corpus.upload_csv(self.new_phrase_file, 'phrases')
+
         self.new_phrase_file.close()
-        self.new_phrase_file = tempfile.TemporaryFile()
+        self._open_phrase_file()
+
+        if self.new_phrases:
+            _save(self.corpus, self.dictionary.merged(self.new_phrases), self.root)
+            self.dictionary = PhraseDictionary.load(self.corpus.id, self.root)
+
+        self.phrase_map = {}
+        self.new_phrases = []
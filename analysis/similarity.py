@@ -0,0 +1,524 @@
+"""Similarity engines used by DocumentIngester.compute_similarities().
+
+An engine is a callable taking (docs, new_doc_ids, min_similarity), where docs
+maps document IDs to sorted lists of phrase IDs. It yields (x, y, similarity)
+for pairs with x < y, y in new_doc_ids and similarity >= min_similarity.
+
+docs may also be a DocumentPhrases, which holds the same mapping in two
+arrays. Engines that work on whole arrays rather than single documents are
+marked compact, and are given a DocumentPhrases by the ingester.
+
+Engines that index the whole corpus also have a prepare(docs, min_similarity)
+that builds the index and returns a probe(new_doc_ids) yielding the same
+pairs. The ingester prepares once and probes each shard of new documents.
+
+Engines with tuning knobs are built by factory functions, the same way
+parser.ngram_parser(n) builds a parser.
+"""
+
+import itertools
+import math
+import sys
+from collections import defaultdict
+from functools import wraps
+
+try:
+    import numpypy as numpy
+except ImportError:
+    import numpy
+
+from utils import jaccard, overlap
+
+
+def pairs_for_comparison(all_ids, new_ids):
+    allowed_ids = set(all_ids)
+    all_ids = list(all_ids)
+    all_ids.sort()
+
+    new_ids = list(new_ids)
+    new_ids.sort(reverse=True)
+
+    for x in all_ids:
+        for y in new_ids:
+            if x >= y:
+                break
+            if y in allowed_ids:
+                yield (x, y)
+
+
+class DocumentPhrases(object):
+    """Read-only mapping from document ID to sorted phrase IDs, stored as a CSR matrix.
+
+    The phrases of the document at position i of the sorted doc_ids array
+    are phrases[offsets[i]:offsets[i + 1]]. Lookups return views into
+    phrases, so no per-document lists are built.
+    """
+
+    def __init__(self, doc_ids, offsets, phrases):
+        self.doc_ids = doc_ids
+        self.offsets = offsets
+        self.phrases = phrases
+
+    @classmethod
+    def from_dict(cls, docs):
+        doc_ids = numpy.array(sorted(docs.keys()), numpy.int32)
+        offsets = numpy.zeros(len(doc_ids) + 1, numpy.int64)
+        numpy.cumsum([len(docs[id]) for id in doc_ids], out=offsets[1:])
+        phrases = numpy.fromiter(itertools.chain.from_iterable(docs[id] for id in doc_ids), numpy.int32, offsets[-1])
+        return cls(doc_ids, offsets, phrases)
+
+    @classmethod
+    def from_pairs(cls, doc_column, phrase_column):
+        """Build from parallel (document ID, phrase ID) arrays, sorted by document then phrase."""
+
+        (doc_ids, starts) = numpy.unique(doc_column, return_index=True)
+        offsets = numpy.append(starts, len(doc_column)).astype(numpy.int64)
+        return cls(doc_ids.astype(numpy.int32), offsets, numpy.asarray(phrase_column, numpy.int32))
+
+    def _position(self, doc_id):
+        i = self.doc_ids.searchsorted(doc_id)
+        if i == len(self.doc_ids) or self.doc_ids[i] != doc_id:
+            raise KeyError(doc_id)
+        return i
+
+    def __getitem__(self, doc_id):
+        i = self._position(doc_id)
+        return self.phrases[self.offsets[i]:self.offsets[i + 1]]
+
+    def __contains__(self, doc_id):
+        try:
+            self._position(doc_id)
+            return True
+        except KeyError:
+            return False
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return self.doc_ids.tolist()
+
+    def sizes(self):
+        return numpy.diff(self.offsets)
+
+    def itervalues(self):
+        for i in xrange(len(self.doc_ids)):
+            yield self.phrases[self.offsets[i]:self.offsets[i + 1]]
+
+    def iteritems(self):
+        return itertools.izip(self.keys(), self.itervalues())
+
+    def overlaps(self, positions, phrases):
+        """Return how many of a sorted array of phrases each document at the given positions has."""
+
+        starts = self.offsets[positions]
+        lengths = self.offsets[positions + 1] - starts
+        if not len(phrases):
+            return numpy.zeros(len(positions), numpy.int64)
+
+        # the documents' phrases, one document after the other
+        found = self.phrases[numpy.arange(lengths.sum()) + numpy.repeat(starts - (numpy.cumsum(lengths) - lengths), lengths)]
+        phrases = numpy.asarray(phrases)
+        hits = phrases[numpy.searchsorted(phrases, found).clip(0, len(phrases) - 1)] == found
+        return numpy.bincount(numpy.repeat(numpy.arange(len(positions)), lengths), weights=hits, minlength=len(positions)).astype(numpy.int64)
+
+    def phrase_frequencies(self):
+        """Return a dict of the number of documents containing each phrase."""
+
+        (phrases, counts) = numpy.unique(self.phrases, return_counts=True)
+        return dict(itertools.izip(phrases.tolist(), counts.tolist()))
+
+
+def exhaustive(docs, new_doc_ids, min_similarity):
+    """Compare every pair of documents. Quadratic, but exact for any cutoff."""
+
+    i = 0
+    for (x, y) in pairs_for_comparison(docs.keys(), new_doc_ids):
+        similarity = jaccard(docs[x], docs[y])
+        if similarity >= min_similarity:
+            yield (x, y, similarity)
+
+        i += 1
+        if i % 10000000 == 0:
+            sys.stdout.write('.')
+            sys.stdout.flush()
+
+
+def _indexed(prepare):
+    """Build an engine from prepare(docs, min_similarity), which indexes the whole corpus.
+
+    prepare returns a probe(new_doc_ids) yielding the engine's pairs for
+    those new documents. It's also kept as engine.prepare, so the index can
+    be built once and probed shard by shard, see write_similarities().
+
+    With min_similarity <= 0 every pair qualifies, so there's nothing to
+    prune, and exhaustive's pair loop is used instead.
+    """
+
+    def prepare_or_exhaustive(docs, min_similarity):
+        if min_similarity <= 0:
+            return lambda new_doc_ids: exhaustive(docs, new_doc_ids, min_similarity)
+        return prepare(docs, min_similarity)
+
+    @wraps(prepare)
+    def engine(docs, new_doc_ids, min_similarity):
+        return prepare_or_exhaustive(docs, min_similarity)(new_doc_ids)
+
+    engine.prepare = prepare_or_exhaustive
+    return engine
+
+
+### MinHash / locality sensitive hashing ###
+
+# hash functions are (a * x + b) mod p. phrase IDs are postgres integers,
+# so a * x stays well inside 64 bits.
+_MINHASH_PRIME = (1 << 31) - 1
+
+
+class MinHasher(object):
+
+    def __init__(self, num_permutations=128, seed=0):
+        random = numpy.random.RandomState(seed)
+        self.num_permutations = num_permutations
+        self.a = random.randint(1, _MINHASH_PRIME, num_permutations).astype(numpy.uint64)
+        self.b = random.randint(0, _MINHASH_PRIME, num_permutations).astype(numpy.uint64)
+
+    def signature(self, phrases):
+        """Return the MinHash signature of a set of phrase IDs."""
+
+        if len(phrases) == 0:
+            return numpy.zeros(self.num_permutations, numpy.uint32) + _MINHASH_PRIME
+
+        x = numpy.asarray(phrases, numpy.uint64)
+        hashes = (numpy.outer(self.a, x) + self.b[:, numpy.newaxis]) % _MINHASH_PRIME
+        return hashes.min(axis=1).astype(numpy.uint32)
+
+    def signatures(self, docs, doc_ids):
+        """Return an array with one signature row per document, in doc_ids order."""
+
+        result = numpy.empty((len(doc_ids), self.num_permutations), numpy.uint32)
+        for (i, doc_id) in enumerate(doc_ids):
+            result[i] = self.signature(docs[doc_id])
+        return result
+
+
+def lsh_bands(num_permutations, min_similarity, recall):
+    """Return the (bands, rows) banding to use for the given cutoff.
+
+    A pair with similarity s becomes a candidate with probability
+    1 - (1 - s^rows)^bands. More rows per band means fewer false candidates,
+    so pick the most rows that still find a pair at min_similarity with
+    at least the requested probability.
+    """
+
+    for rows in range(num_permutations, 0, -1):
+        bands = num_permutations / rows
+        if 1 - (1 - min_similarity ** rows) ** bands >= recall:
+            return (bands, rows)
+
+    return (num_permutations, 1)
+
+
+def _band_keys(signatures, bands, rows):
+    """Collapse each band of each signature into a single 64 bit bucket key.
+
+    Colliding keys only add candidates, which are filtered by the exact check.
+    """
+
+    keys = []
+    for band in range(bands):
+        block = signatures[:, band * rows:(band + 1) * rows].astype(numpy.uint64)
+        key = block[:, 0].copy()
+        for r in range(1, rows):
+            key = key * numpy.uint64(1000003) + block[:, r]
+        keys.append(key)
+    return keys
+
+
+def minhash_lsh(recall=0.95, num_permutations=128, seed=0):
+    """Return an engine that only compares pairs sharing a MinHash band.
+
+    recall is the probability that a pair exactly at min_similarity is
+    found. Pairs above the cutoff are found with higher probability. Lowering
+    recall trades missed pairs for fewer exact comparisons, and more
+    permutations sharpen the cutoff at the cost of hashing time.
+    """
+
+    hasher = MinHasher(num_permutations, seed)
+
+    @_indexed
+    def engine(docs, min_similarity):
+        (bands, rows) = lsh_bands(num_permutations, min_similarity, recall)
+
+        if not isinstance(docs, DocumentPhrases):
+            docs = DocumentPhrases.from_dict(docs)
+        doc_ids = docs.doc_ids
+        sizes = docs.sizes()
+        signatures = hasher.signatures(docs, doc_ids)
+
+        buckets = []
+        for keys in _band_keys(signatures, bands, rows):
+            order = numpy.argsort(keys, kind='mergesort')
+            buckets.append((keys, keys[order], order))
+        del signatures
+
+        def probe(new_doc_ids):
+            for i in numpy.searchsorted(doc_ids, sorted(set(new_doc_ids).intersection(docs))):
+                # positions are in ascending doc ID order, and the stable sort keeps
+                # them ascending inside a bucket, so x < y is a prefix of each bucket.
+                candidates = []
+                for (keys, sorted_keys, order) in buckets:
+                    lo = numpy.searchsorted(sorted_keys, keys[i], 'left')
+                    hi = numpy.searchsorted(sorted_keys, keys[i], 'right')
+                    members = order[lo:hi]
+                    candidates.append(members[:numpy.searchsorted(members, i)])
+
+                # the exact check, for all candidates at once
+                candidates = numpy.unique(numpy.concatenate(candidates))
+                intersections = docs.overlaps(candidates, docs.phrases[docs.offsets[i]:docs.offsets[i + 1]])
+                unions = sizes[candidates] + sizes[i] - intersections
+                similarities = intersections / numpy.maximum(unions, 1).astype(numpy.float64)
+                keep = similarities >= min_similarity
+                for (j, similarity) in itertools.izip(candidates[keep], similarities[keep]):
+                    yield (int(doc_ids[j]), int(doc_ids[i]), float(similarity))
+
+        return probe
+
+    engine.compact = True
+    return engine
+
+
+### inverted index ###
+
+def phrase_postings(max_postings=1000):
+    """Return an engine that only visits pairs sharing at least one phrase.
+
+    Each new document walks the phrase -> document postings of its phrases
+    to count overlaps, so pairs with no phrases in common cost nothing.
+
+    Phrases in more than max_postings documents (boilerplate, mostly) are
+    left out of the walk. Their overlap is added back when a pair is scored.
+    A pair that shares only common phrases can still reach min_similarity
+    if both documents are mostly boilerplate. Those documents are matched
+    through a prefix of their common phrases, rarest first: a pair above
+    the cutoff has to share one of them.
+    """
+
+    @_indexed
+    def engine(docs, min_similarity):
+        frequency = _phrase_frequencies(docs)
+        common = set(phrase for (phrase, count) in frequency.iteritems() if count > max_postings)
+
+        # postings are appended in ascending doc ID order, so the documents
+        # below y are a prefix of each list.
+        postings = defaultdict(list)
+        common_postings = defaultdict(list)
+        common_phrases = {}
+        prefixes = {}
+
+        for y in sorted(docs.keys()):
+            phrases = docs[y]
+            common_phrases[y] = [p for p in phrases if p in common] if common else []
+
+            # a document can only match on common phrases alone if at least
+            # min_similarity of it is common phrases.
+            required = int(math.ceil(min_similarity * len(phrases) - 1e-9))
+            if common_phrases[y] and len(common_phrases[y]) >= required:
+                by_rarity = sorted(common_phrases[y], key=lambda p: (frequency[p], p))
+                prefixes[y] = by_rarity[:len(by_rarity) - required + 1]
+
+            for p in phrases:
+                if p not in common:
+                    postings[p].append(y)
+            for p in prefixes.get(y, ()):
+                common_postings[p].append(y)
+
+        def probe(new_doc_ids):
+            for y in sorted(set(new_doc_ids).intersection(docs)):
+                phrases = docs[y]
+                counts = defaultdict(int)
+                for p in phrases:
+                    if p in common:
+                        continue
+                    for x in postings[p]:
+                        if x >= y:
+                            break
+                        counts[x] += 1
+
+                for (x, count) in counts.iteritems():
+                    intersection = count + overlap(common_phrases[x], common_phrases[y])
+                    similarity = float(intersection) / (len(docs[x]) + len(phrases) - intersection)
+                    if similarity >= min_similarity:
+                        yield (x, y, similarity)
+
+                candidates = set()
+                for p in prefixes.get(y, ()):
+                    candidates.update(itertools.takewhile(lambda x: x < y, common_postings[p]))
+                for x in sorted(candidates):
+                    if x not in counts:
+                        similarity = jaccard(docs[x], phrases)
+                        if similarity >= min_similarity:
+                            yield (x, y, similarity)
+
+        return probe
+
+    return engine
+
+
+### prefix filtering ###
+
+def _phrase_frequencies(docs):
+    if isinstance(docs, DocumentPhrases):
+        return docs.phrase_frequencies()
+
+    frequency = defaultdict(int)
+    for phrases in docs.itervalues():
+        for phrase in phrases:
+            frequency[phrase] += 1
+    return frequency
+
+
+@_indexed
+def prefix_filtered(docs, min_similarity):
+    """Exact threshold join using size, prefix and positional filters (PPJoin).
+
+    With phrases ordered rarest first, two documents with Jaccard >= t must
+    share a phrase among the first |d| - ceil(t * |d|) + 1 of each. Only those
+    prefixes are indexed and probed. Candidates are dropped when the sizes
+    can't reach t, or when the overlap still possible after the current
+    positions can't reach the required minimum. Survivors get the exact
+    jaccard() check, so the output is the same as exhaustive's.
+    """
+
+    t = min_similarity
+    frequency = _phrase_frequencies(docs)
+    ordering = sorted((count, phrase) for (phrase, count) in frequency.iteritems())
+    rank = dict((phrase, i) for (i, (_, phrase)) in enumerate(ordering))
+    del frequency, ordering
+
+    # entries are appended in ascending doc ID order, so the documents
+    # below y are a prefix of each list.
+    index = defaultdict(list)
+    sizes = {}
+    prefixes = {}
+
+    for y in sorted(docs.keys()):
+        ranked = sorted(rank[p] for p in docs[y])
+        ly = len(ranked)
+        sizes[y] = ly
+        prefixes[y] = ranked[:ly - int(math.ceil(t * ly - 1e-9)) + 1]
+        for (j, token) in enumerate(prefixes[y]):
+            index[token].append((y, j))
+
+    def probe(new_doc_ids):
+        for y in sorted(set(new_doc_ids).intersection(docs)):
+            ly = sizes[y]
+            overlaps = {}
+            for (i, token) in enumerate(prefixes[y]):
+                for (x, j) in index[token]:
+                    if x >= y:
+                        break
+                    lx = sizes[x]
+                    # size filter
+                    if lx * (1 + 1e-9) < t * ly or t * lx > ly * (1 + 1e-9):
+                        continue
+
+                    seen = overlaps.get(x, 0)
+                    if seen < 0:
+                        continue
+
+                    # positional filter
+                    required = int(math.ceil(t / (1 + t) * (lx + ly) - 1e-9))
+                    if seen + 1 + min(lx - j - 1, ly - i - 1) >= required:
+                        overlaps[x] = seen + 1
+                    else:
+                        overlaps[x] = -1
+
+            for x in sorted(overlaps):
+                if overlaps[x] > 0:
+                    similarity = jaccard(docs[x], docs[y])
+                    if similarity >= min_similarity:
+                        yield (x, y, similarity)
+
+    return probe
+
+
+### sparse matrix products ###
+
+def sparse_matrix(memory_budget=256 * 1024 * 1024):
+    """Return an engine that computes overlaps with blocked sparse matrix products.
+
+    Documents become rows of a binary CSR document x phrase matrix X. Overlap
+    counts for a block of new documents against a block of all documents are
+    the entries of one tile of X * X^T, and unions follow from the row sizes.
+    Only the pairs over min_similarity leave NumPy.
+
+    memory_budget bounds the bytes used by a single tile, so corpora of any
+    size can be processed. Requires SciPy.
+    """
+
+    import scipy.sparse
+
+    # a tile entry is an int32 overlap plus row and column indexes, with
+    # about the same again for temporaries.
+    tile_size = max(1, int(math.sqrt(memory_budget / 24)))
+
+    @_indexed
+    def engine(docs, min_similarity):
+        if not isinstance(docs, DocumentPhrases):
+            docs = DocumentPhrases.from_dict(docs)
+        doc_ids = docs.doc_ids
+        sizes = docs.sizes()
+        indptr = docs.offsets
+        (_, columns) = numpy.unique(docs.phrases, return_inverse=True)
+
+        matrix = scipy.sparse.csr_matrix(
+            (numpy.ones(len(columns), numpy.int32), columns, indptr),
+            shape=(len(doc_ids), columns.max() + 1 if len(columns) else 0))
+        column_blocks = [(start, matrix[start:start + tile_size].T.tocsr()) for start in range(0, len(doc_ids), tile_size)]
+
+        def probe(new_doc_ids):
+            new_positions = numpy.searchsorted(doc_ids, sorted(set(new_doc_ids).intersection(docs)))
+            row_blocks = [new_positions[i:i + tile_size] for i in range(0, len(new_positions), tile_size)]
+            row_matrices = [matrix[block] for block in row_blocks]
+
+            for (start, block_columns) in column_blocks:
+                for (block, rows) in zip(row_blocks, row_matrices):
+                    # only pairs with x < y are wanted
+                    if block[-1] <= start:
+                        continue
+
+                    tile = rows.dot(block_columns).tocoo()
+                    y = block[tile.row]
+                    x = tile.col + start
+                    keep = x < y
+                    (x, y, intersection) = (x[keep], y[keep], tile.data[keep])
+
+                    similarity = intersection / (sizes[x] + sizes[y] - intersection).astype(numpy.float64)
+                    keep = similarity >= min_similarity
+                    for (i, j, s) in itertools.izip(x[keep], y[keep], similarity[keep]):
+                        yield (int(doc_ids[i]), int(doc_ids[j]), float(s))
+
+        return probe
+
+    engine.compact = True
+    return engine
+
+
+ENGINES = {
+    'exhaustive': lambda: exhaustive,
+    'lsh': minhash_lsh,
+    'postings': phrase_postings,
+    'ppjoin': lambda: prefix_filtered,
+    'sparse': sparse_matrix,
+}
+
+def engine_by_name(name, **options):
+    """Return the engine registered under name, built with the given options."""
+
+    if name not in ENGINES:
+        raise ValueError("Unknown similarity engine '%s'. Must be one of %s." % (name, ", ".join(sorted(ENGINES))))
+    return ENGINES[name](**options)
@@ -2,6 +2,7 @@
 #include <stdio.h>
 
 #include "cpartition.h"
+#include "speedmerge.h"
 #include "lz4.h"
 
 /* from python-lz4 */
@@ -62,6 +63,14 @@ static inline int decompress_lz4_file(char* file_name, char** dest_ptr) {
 }
 
 void merge_lz4_file(cpartition_ptr part, char* file_name) {
+    merge_lz4_file_filtered(part, file_name, NULL, 0);
+}
+
+static inline int is_deleted(unsigned char* deleted, int deleted_length, unsigned int x) {
+    return (x >> 3) < (unsigned int) deleted_length && (deleted[x >> 3] & (0x80 >> (x & 7)));
+}
+
+void merge_lz4_file_filtered(cpartition_ptr part, char* file_name, unsigned char* deleted, int deleted_length) {
     char* buffer;
     unsigned int* ibuffer;
     int size, i;
@@ -70,7 +79,34 @@ void merge_lz4_file(cpartition_ptr part, char* file_name) {
     ibuffer = (unsigned int *) buffer;
 
     for (i = 0; i < size; i += 2) {
+        if (deleted_length && (is_deleted(deleted, deleted_length, ibuffer[i]) || is_deleted(deleted, deleted_length, ibuffer[i + 1]))) {
+            continue;
+        }
         cpartition_merge(part, ibuffer[i], ibuffer[i + 1]);
     }
     free(buffer);
-}
\ No newline at end of file
+}
+
+void merge_scored_lz4_file(cpartition_ptr part, char* file_name, int min_score, int max_score, unsigned char* deleted, int deleted_length) {
+    char* buffer;
+    unsigned int* pairs;
+    unsigned char* scores;
+    int count, i;
+
+    /* a chunk holds count pairs, then their count one-byte scores */
+    count = decompress_lz4_file(file_name, &buffer) / (2 * sizeof(unsigned int) + 1);
+    pairs = (unsigned int *) buffer;
+    scores = (unsigned char *) (buffer + 2 * sizeof(unsigned int) * count);
+
+    /* scores are in descending order, so the rest of the chunk is below min_score */
+    for (i = 0; i < count && scores[i] >= min_score; i++) {
+        if (scores[i] >= max_score) {
+            continue;
+        }
+        if (deleted_length && (is_deleted(deleted, deleted_length, pairs[2 * i]) || is_deleted(deleted, deleted_length, pairs[2 * i + 1]))) {
+            continue;
+        }
+        cpartition_merge(part, pairs[2 * i], pairs[2 * i + 1]);
+    }
+    free(buffer);
+}
@@ -5,4 +5,10 @@
 
 void merge_lz4_file(cpartition_ptr part, char* file_name);
 
+/* skips pairs with a document set in deleted, a bitmap of deleted_length bytes, most significant bit first */
+void merge_lz4_file_filtered(cpartition_ptr part, char* file_name, unsigned char* deleted, int deleted_length);
+
+/* merges the pairs of a scored chunk with min_score <= score < max_score, skipping deleted ones as above */
+void merge_scored_lz4_file(cpartition_ptr part, char* file_name, int min_score, int max_score, unsigned char* deleted, int deleted_length);
+
 #endif
\ No newline at end of file
@@ -0,0 +1,124 @@
+"""Phrase summaries of a corpus' clusters, saved between requests.
+
+Summarizing a cluster means scoring the phrases of the sentence corpus by
+how particular they are to the cluster's documents, and looking up the
+text of the best ones. A ClusterSummaries keeps the result for each
+cluster, along with the document frequency of every phrase and the text
+of the phrases shown. Ingestion brings the summaries up to date, see
+Corpus.refresh_summaries(), so requests only have to look them up.
+
+Clusters only grow while documents are added, so a cluster with the same
+cutoff, root and size has the same members and keeps its summary, as in
+HierarchyState.hierarchy(). New documents change the phrase counts the
+summaries are scored with, though, so counting them rescores every cluster.
+Deleting documents removes the summaries.
+"""
+
+import json
+import os
+import tempfile
+
+try:
+    import numpypy as numpy
+except ImportError:
+    import numpy
+
+from bsims import DATA_DIR
+
+
+def cluster_key(cluster):
+    return "%s_%s" % (cluster['cutoff'], cluster['name'])
+
+
+class ClusterSummaries(object):
+    """Representative phrases of a corpus' clusters.
+
+    doc_ids is the ascending array of the sentence corpus' documents whose
+    phrases are counted, and doc_freqs[i] the number of them phrase_ids[i]
+    occurs in. Phrases are indexed by their position in phrase_ids, which
+    is the order they were first counted in, by ID within each batch.
+
+    clusters maps cluster_key() of each summarized cluster to its 'size'
+    and the IDs of its limit best 'phrases', best first. phrase_text has
+    the text shown for each of those phrases.
+    """
+
+    def __init__(self, limit, doc_ids, phrase_ids, doc_freqs, clusters, phrase_text):
+        self.limit = limit
+        self.doc_ids = doc_ids
+        self.phrase_ids = phrase_ids
+        self.doc_freqs = doc_freqs
+        self.clusters = clusters
+        self.phrase_text = phrase_text
+        self._phrase_order = numpy.argsort(phrase_ids)
+
+    @classmethod
+    def empty(cls, limit):
+        return cls(limit, numpy.zeros(0, numpy.int32), numpy.zeros(0, numpy.int32), numpy.zeros(0, numpy.int32), {}, {})
+
+    @staticmethod
+    def path(corpus_id, root=DATA_DIR):
+        return os.path.join(root, "%s.summaries.npz" % corpus_id)
+
+    @classmethod
+    def load(cls, corpus_id, root=DATA_DIR):
+        """Return the saved summaries, or None if there aren't any."""
+
+        path = cls.path(corpus_id, root)
+        if not os.path.exists(path):
+            return None
+
+        saved = numpy.load(path)
+        meta = json.loads(str(saved['meta']))
+        phrase_text = dict((int(phrase_id), text) for (phrase_id, text) in meta['phrase_text'].iteritems())
+        return cls(meta['limit'], saved['doc_ids'], saved['phrase_ids'], saved['doc_freqs'], meta['clusters'], phrase_text)
+
+    def save(self, corpus_id, root=DATA_DIR):
+        # written to a temporary file first, so readers never see part of the summaries
+        meta = dict(limit=self.limit, clusters=self.clusters, phrase_text=self.phrase_text)
+        with tempfile.NamedTemporaryFile(dir=root, suffix='.summaries.new', delete=False) as f:
+            numpy.savez(f, doc_ids=self.doc_ids, phrase_ids=self.phrase_ids, doc_freqs=self.doc_freqs, meta=numpy.array(json.dumps(meta)))
+        os.rename(f.name, self.path(corpus_id, root))
+
+    @staticmethod
+    def remove(corpus_id, root=DATA_DIR):
+        path = ClusterSummaries.path(corpus_id, root)
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def phrases(self, cluster):
+        """Return the saved phrase texts of a hierarchy cluster, or None if it isn't summarized."""
+
+        entry = self.clusters.get(cluster_key(cluster))
+        if entry is None or entry['size'] != cluster['size']:
+            return None
+        return [self.phrase_text.get(phrase_id, "") for phrase_id in entry['phrases']]
+
+    def add_documents(self, doc_ids, occurrences):
+        """Count the phrases of new documents, given as (k, 2) distinct (document ID, phrase ID) rows."""
+
+        occurrences = numpy.asarray(occurrences, numpy.int64).reshape(-1, 2)
+        new_phrases = numpy.setdiff1d(occurrences[:, 1], self.phrase_ids)
+        if len(new_phrases):
+            self.phrase_ids = numpy.concatenate([self.phrase_ids, new_phrases]).astype(numpy.int32)
+            self.doc_freqs = numpy.concatenate([self.doc_freqs, numpy.zeros(len(new_phrases), numpy.int32)])
+            self._phrase_order = numpy.argsort(self.phrase_ids)
+
+        self.doc_freqs += numpy.bincount(self.phrase_indexes(occurrences[:, 1]), minlength=len(self.phrase_ids)).astype(numpy.int32)
+        self.doc_ids = numpy.union1d(self.doc_ids, doc_ids).astype(numpy.int32)
+
+    def phrase_indexes(self, phrase_ids):
+        """Return the index of each of an array of counted phrase IDs."""
+
+        return self._phrase_order[numpy.searchsorted(self.phrase_ids[self._phrase_order], phrase_ids)]
+
+    def set_phrases(self, cluster, phrase_ids):
+        self.clusters[cluster_key(cluster)] = dict(size=cluster['size'], phrases=list(phrase_ids))
+
+    def retain(self, clusters):
+        """Drop the summaries of all but the given clusters, and the text of phrases they don't show."""
+
+        keys = set(cluster_key(cluster) for cluster in clusters)
+        self.clusters = dict((key, entry) for (key, entry) in self.clusters.iteritems() if key in keys)
+        shown = set(phrase_id for entry in self.clusters.itervalues() for phrase_id in entry['phrases'])
+        self.phrase_text = dict((phrase_id, text) for (phrase_id, text) in self.phrase_text.iteritems() if phrase_id in shown)
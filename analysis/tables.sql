@@ -2,7 +2,8 @@
 
 create table corpora (
     corpus_id serial PRIMARY KEY,
-    metadata hstore
+    metadata hstore,
+    phrase_dictionary varchar
 );
 
 create table documents (
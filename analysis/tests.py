@@ -1,17 +1,37 @@
 import shutil
 import os
+import tempfile
+from random import Random
+from functools import partial
+
+import numpy
+import struct
+from cStringIO import StringIO
 
 from django.test import TestCase
+from django.core.cache import get_cache
 from django.db import connection
 
 from ingestion import *
-from phrases import PhraseSequencer
-from parser import _sentence_boundaries, _ngram_boundaries, sentence_parse
-from utils import execute_file, binary_search
+import pgcopy
+import benchmarks
+from phrases import PhraseSequencer, PhraseDictionary, phrase_hash
+from parser import _sentence_boundaries, _ngram_boundaries, sentence_parse, ngram_parser
+from utils import execute_file, binary_search, wirth_n_largest, cluster_top_phrases
 from corpus import Corpus
 from partition import Partition
-from utils import BufferedCompressedWriter, BufferedCompressedReader
-from bsims import SimilarityWriter, SimilarityReader
+from npartition import NumpyPartition
+from utils import BufferedCompressedWriter, BufferedCompressedReader, read_manifest
+from bsims import SimilarityWriter, SimilarityReader, LZ4SimilarityWriter, LZ4SimilarityReader, PairsSimilarityWriter, PairsSimilarityReader, \
+    DeltaLZ4SimilarityWriter, DeltaLZ4SimilarityReader, ScoredLZ4SimilarityWriter, ScoredLZ4SimilarityReader, \
+    STORED_SIMILARITY_CUTOFFS, remove_documents, store_format, convert, get_similarity_reader, compact, read_tombstones, max_deleted_id, \
+    store_size, needs_compaction
+import bsims
+from paircodec import encode_pairs, decode_pairs, encode_varints, decode_varints
+from hierarchy import HierarchyState, CompactHierarchy, replay_similarities
+from summaries import ClusterSummaries
+from hiercache import HierarchyCache, serialize, deserialize
+from similarity import exhaustive, minhash_lsh, phrase_postings, prefix_filtered, sparse_matrix, DocumentPhrases
 
 
 class DBTestCase(TestCase):
@@ -41,12 +61,60 @@ class TestPartition(TestCase):
         self.assertEqual([['a', 'c', 'b', 'd'], ['e']], p.sets())
         p.merge('b', 'e')
         self.assertEqual([['a', 'c', 'b', 'e', 'd']], p.sets())
-        
+
+    def test_numpy_partition(self):
+        random = Random(0)
+        values = random.sample(xrange(1000), 300)
+        pairs = [tuple(random.sample(values, 2)) for _ in range(200)]
+
+        expected = Partition(values)
+        for (x, y) in pairs:
+            expected.merge(x, y)
+        expected = sorted(sorted(s) for s in expected.sets())
+
+        p = NumpyPartition(values)
+        p.merge_many([x for (x, _) in pairs[:150]], [y for (_, y) in pairs[:150]])
+        for (x, y) in pairs[150:]:
+            p.merge(x, y)
+
+        (offsets, members) = p.sets()
+        self.assertEqual(expected, sorted(sorted(members[offsets[i]:offsets[i + 1]].tolist()) for i in range(len(offsets) - 1)))
+        (representatives, sizes) = p.sets_overview()
+        self.assertEqual(sorted(len(s) for s in expected), sorted(sizes.tolist()))
+        for (representative, size) in zip(representatives, sizes):
+            self.assertEqual(size, len(p.group(representative)))
+            self.assertEqual(representative, p.representative(representative))
+
+        # sparse values, and a star that hooks many roots onto one
+        p = NumpyPartition([10 ** 9] + range(100))
+        p.merge_many([10 ** 9] * 99, range(99))
+        self.assertEqual(set([10 ** 9] + range(99)), p.group(50))
+        self.assertEqual(set([99]), p.group(99))
+
+    def test_numpy_partition_unknown_values(self):
+        # missing inside the table's range, below and above it, and between sparse values
+        for values in ([0, 1, 2, 5, 6], [10 ** 9, 0, 1, 2, 5, 6]):
+            p = NumpyPartition(values)
+            for unknown in [3, -1, 7]:
+                self.assertRaises(KeyError, p.merge_many, [unknown], [6])
+                self.assertRaises(KeyError, p.merge, 6, unknown)
+                self.assertRaises(KeyError, p.representative, unknown)
+            self.assertEqual(set([6]), p.group(6))
+        self.assertRaises(KeyError, NumpyPartition([]).representative, 0)
+
 
 class TestSequencer(DBTestCase):
-        
+
+    def setUp(self):
+        DBTestCase.setUp(self)
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        DBTestCase.tearDown(self)
+
     def test_basic(self):
-        s = PhraseSequencer(self.corpus)
+        s = PhraseSequencer(self.corpus, self.root)
         a = s.sequence('a')
         b = s.sequence('b')
         c = s.sequence('c')
@@ -59,7 +127,7 @@ class TestSequencer(DBTestCase):
         self.assertEqual(c, s.sequence('c'))
         
     def test_persistence(self):
-        s1 = PhraseSequencer(self.corpus)
+        s1 = PhraseSequencer(self.corpus, self.root)
         a = s1.sequence('a')
         b = s1.sequence('b')
         c = s1.sequence('c')
@@ -67,20 +135,52 @@ class TestSequencer(DBTestCase):
         # new sequencer shouldn't see updates that haven't been persisted
         # note: should never do this in practice--should only ever be one
         # active sequencer per corpus.
-        s2 = PhraseSequencer(self.corpus)
+        s2 = PhraseSequencer(self.corpus, self.root)
         self.assertEqual(0, s2.sequence('a'))
         
         s1.upload_new_phrases()
         self.assertEqual(1, s1.sequence('b')) # existing phrases still present
         self.assertEqual(3, s1.sequence('d')) # new phrases can still be added
         
-        s3 = PhraseSequencer(self.corpus)
+        s3 = PhraseSequencer(self.corpus, self.root)
         self.assertEqual(2, s3.sequence('c')) # previously uploaded phrase appears
         self.assertEqual(3, s3.sequence('e')) # but not d=3, which wasn't uploaded
         
-        s4 = PhraseSequencer(Corpus())
+        s4 = PhraseSequencer(Corpus(), self.root)
         self.assertEqual(0, s4.sequence('f'))  # sequencer with different corpus doesn't show at all
 
+    def test_phrase_dictionary(self):
+        s1 = PhraseSequencer(self.corpus, self.root)
+        for phrase in 'abc':
+            s1.sequence(phrase)
+        s1.upload_new_phrases()
+
+        # the saved dictionary matches the phrases table
+        d = PhraseDictionary.load(self.corpus.id, self.root)
+        self.assertEqual(self.corpus.phrase_dictionary_token(), d.token)
+        self.assertEqual(1, d.get('b', self.corpus.phrase_id))
+        self.assertEqual(None, d.get('d', self.corpus.phrase_id))
+
+        # an out of date dictionary is rebuilt from the phrases table
+        self.corpus.set_phrase_dictionary_token('stale')
+        s2 = PhraseSequencer(self.corpus, self.root)
+        self.assertEqual(2, s2.sequence('c'))
+        self.assertEqual(3, s2.sequence('d'))
+        self.assertNotEqual('stale', self.corpus.phrase_dictionary_token())
+
+        # the token isn't part of the corpus' metadata
+        self.assertEqual({}, Corpus(self.corpus.id).metadata)
+
+    def test_hash_collision(self):
+        # a phrase stored under 'a''s key, but with a different check
+        (key, check) = phrase_hash('a')
+        d = PhraseDictionary(numpy.array([key], numpy.uint64), numpy.array([check ^ 1], numpy.uint64), numpy.array([0], numpy.int32))
+
+        # the fallback decides
+        self.assertEqual(None, d.get('a', lambda phrase: None))
+        self.assertEqual(7, d.get('a', lambda phrase: 7))
+        self.assertEqual(None, d.get('b', lambda phrase: 7))
+
 
 class TestParser(DBTestCase):
     
@@ -196,6 +296,9 @@ class TestDocumentIngester(DBTestCase):
         
         c.execute("select count(*) from phrase_occurrences")
         self.assertEqual(7, c.fetchone()[0])
+
+        docs = self.corpus.all_docs_csr()
+        self.assertEqual(self.corpus.all_docs(), dict((id, list(phrases)) for (id, phrases) in docs.iteritems()))
         
     def test_all_docs(self):
         i = DocumentIngester(self.corpus)
@@ -213,6 +316,90 @@ class TestDocumentIngester(DBTestCase):
         
         self.assertEqual(dict([(0, [0, 1, 2]), (1, [1, 3]), (2, [3, 4])]), self.corpus.all_docs())
 
+    def test_streaming(self):
+        docs = [
+            'This document has three sentences. One of which matches. Two of which do not.',
+            'This document has only two sentences. One of which matches.',
+            'This document has only two sentences. Only one of which is new.',
+            ''
+        ]
+
+        # every batch is uploaded on its own
+        i = DocumentIngester(self.corpus, compute_similarities=False, batch_size=3, upload_threshold=1)
+        self.assertEqual([0, 1, 2, 3], i.ingest(d for d in docs))
+
+        self.assertEqual(4, self.corpus.num_docs())
+        self.assertEqual(dict([(0, [0, 1, 2]), (1, [1, 3]), (2, [3, 4])]), self.corpus.all_docs())
+
+    def test_copy_formats(self):
+        docs = [
+            {'text': u'Unicode h\xe9re. And "quotes", commas\\backslashes.', 'metadata': {'title': u'"T\xeftle"', 'docket': 'A-1'}},
+            'This document has only two sentences. One of which matches.',
+            ''
+        ]
+
+        csv_corpus = Corpus()
+        DocumentIngester(csv_corpus, compute_similarities=False, copy_format='csv').ingest(docs)
+        DocumentIngester(self.corpus, compute_similarities=False, copy_format='binary').ingest(docs)
+
+        self.assertEqual(csv_corpus.all_phrases(), self.corpus.all_phrases())
+        self.assertEqual(csv_corpus.all_docs(), self.corpus.all_docs())
+        for doc_id in range(len(docs)):
+            self.assertEqual(csv_corpus.doc(doc_id), self.corpus.doc(doc_id))
+
+        occurrences = "select document_id, phrase_id, indexes from phrase_occurrences where corpus_id = %s order by document_id, phrase_id"
+        self.cursor.execute(occurrences, [csv_corpus.id])
+        expected = self.cursor.fetchall()
+        self.cursor.execute(occurrences, [self.corpus.id])
+        self.assertEqual(expected, self.cursor.fetchall())
+
+        self.assertRaises(ValueError, DocumentIngester, self.corpus, copy_format='text')
+
+    def test_parallel_parse(self):
+        docs = [
+            'This document has three sentences. One of which matches. Two of which do not.',
+            {'text': 'This document has only two sentences. One of which matches.', 'metadata': {'source': 'test'}},
+            'This document has only two sentences. Only one of which is new.',
+            ''
+        ]
+
+        serial = Corpus()
+        DocumentIngester(serial, compute_similarities=False).ingest(docs)
+
+        # phrase IDs come out in the same order as a serial parse
+        i = DocumentIngester(self.corpus, compute_similarities=False, processes=3, batch_size=2)
+        self.assertEqual([0, 1, 2, 3], i.ingest(docs))
+
+        self.assertEqual(serial.all_phrases(), self.corpus.all_phrases())
+        self.assertEqual(serial.all_docs(), self.corpus.all_docs())
+        self.assertEqual(dict(source='test'), self.corpus.doc_metadatas([1])[0][1])
+
+    def test_dual_corpus_ids(self):
+        docs = [
+            'This document has three sentences. One of which matches. Two of which do not.',
+            'This document has only two sentences. One of which matches.',
+            'This document has only two sentences. Only one of which is new.'
+        ]
+
+        sentences = self.corpus
+        ngrams = Corpus()
+        DocumentIngester(sentences, compute_similarities=False).ingest(docs)
+        DocumentIngester(ngrams, parser=ngram_parser(4)).ingest(docs)
+
+        # the top document is deleted and inserted again, one parse after the other.
+        # Only the 4-gram corpus keeps the deleted ID reserved.
+        next_id = next_doc_id([sentences, ngrams])
+        sentences.delete([2])
+        self.assertEqual(2, next_doc_id([sentences]))
+        sentence_ids = DocumentIngester(sentences, compute_similarities=False, next_id=next_id).ingest(docs[2:])
+        ngrams.delete([2])
+        self.assertEqual(3, next_doc_id([ngrams]))
+        ngram_ids = DocumentIngester(ngrams, parser=ngram_parser(4), next_id=next_id).ingest(docs[2:])
+
+        self.assertEqual([3], sentence_ids)
+        self.assertEqual(sentence_ids, ngram_ids)
+        self.assertEqual(sentences.max_doc_id(), ngrams.max_doc_id())
+
     def test_similarities(self):
         
         self.test_ingester()
@@ -281,6 +468,350 @@ class TestDocumentIngester(DBTestCase):
         
         return c.fetchone()[0]
         
+# 40 templates, with similarities spread over the whole range
+synthetic_docs = partial(benchmarks.synthetic_docs, 240, doc_size=80, copies=6, vocabulary=100000, max_noise=0.6)
+
+
+class TestSimilarityEngines(TestCase):
+
+    def setUp(self):
+        self.docs = synthetic_docs()
+        self.new_ids = [id for id in self.docs if id % 3 == 0]
+
+    def assertFindsPairs(self, engine, new_ids, min_recall=1.0, docs=None):
+        docs = docs or self.docs
+        expected = dict(((x, y), s) for (x, y, s) in exhaustive(docs, new_ids, 0.5))
+        found = dict(((x, y), s) for (x, y, s) in engine(docs, new_ids, 0.5))
+
+        # never report a pair that isn't there, or with the wrong value
+        for (pair, similarity) in found.items():
+            self.assertEqual(expected[pair], similarity)
+        self.assertTrue(len(found) >= min_recall * len(expected))
+
+    def test_minhash_lsh(self):
+        self.assertFindsPairs(minhash_lsh(), self.docs.keys(), 0.95)
+        self.assertFindsPairs(minhash_lsh(), self.new_ids, 0.95)
+        self.assertFindsPairs(minhash_lsh(recall=0.999, num_permutations=256), self.docs.keys(), 0.99)
+
+    def test_phrase_postings(self):
+        self.assertFindsPairs(phrase_postings(), self.docs.keys())
+        self.assertFindsPairs(phrase_postings(), self.new_ids)
+
+        # boilerplate phrases are over the cap, and some pairs only match on them
+        docs = synthetic_docs(boilerplate=200)
+        self.assertFindsPairs(phrase_postings(max_postings=20), docs.keys(), docs=docs)
+        self.assertFindsPairs(phrase_postings(max_postings=20), self.new_ids, docs=docs)
+        self.assertFindsPairs(phrase_postings(max_postings=0), self.new_ids, docs=docs)
+
+    def test_prefix_filtered(self):
+        self.assertFindsPairs(prefix_filtered, self.docs.keys())
+        self.assertFindsPairs(prefix_filtered, self.new_ids)
+
+        docs = synthetic_docs(boilerplate=200)
+        self.assertFindsPairs(prefix_filtered, docs.keys(), docs=docs)
+
+    def test_sparse_matrix(self):
+        self.assertFindsPairs(sparse_matrix(), self.docs.keys())
+        self.assertFindsPairs(sparse_matrix(), self.new_ids)
+
+        # small budget, so the products are split over many tiles
+        self.assertFindsPairs(sparse_matrix(memory_budget=24 * 50 * 50), self.docs.keys())
+        self.assertFindsPairs(sparse_matrix(memory_budget=24 * 50 * 50), self.new_ids)
+
+    def test_document_phrases(self):
+        docs = DocumentPhrases.from_dict(self.docs)
+        self.assertEqual(sorted(self.docs.keys()), docs.keys())
+        self.assertEqual(len(self.docs), len(docs))
+        for (id, phrases) in docs.iteritems():
+            self.assertEqual(self.docs[id], list(phrases))
+        self.assertFalse(max(self.docs) + 1 in docs)
+        self.assertRaises(KeyError, docs.__getitem__, -1)
+
+        for engine in [exhaustive, minhash_lsh(), phrase_postings(), prefix_filtered, sparse_matrix()]:
+            self.assertEqual(sorted(engine(self.docs, self.new_ids, 0.5)), sorted(engine(docs, self.new_ids, 0.5)))
+
+    def test_prepare(self):
+        docs = DocumentPhrases.from_dict(self.docs)
+        for engine in [minhash_lsh(), phrase_postings(max_postings=20), prefix_filtered, sparse_matrix(memory_budget=24 * 50 * 50)]:
+            # one index, probed shard by shard as the ingester's workers do
+            probe = engine.prepare(docs, 0.5)
+            found = []
+            for shard in shard_new_ids(self.docs.keys(), 5):
+                found.extend(probe(shard))
+            self.assertEqual(sorted(engine(docs, self.docs.keys(), 0.5)), sorted(found))
+
+
+class TestParallelSimilarities(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def stored_pairs(self, processes, engine=exhaustive):
+        root = os.path.join(self.root, str(processes))
+        os.mkdir(root)
+        docs = synthetic_docs()
+        write_similarities(0, docs, docs.keys(), 0.5, engine, processes, root)
+        return sorted(LZ4SimilarityReader(0, root))
+
+    def test_matches_single_process(self):
+        expected = self.stored_pairs(1)
+        self.assertTrue(len(expected) > 0)
+        self.assertEqual(expected, self.stored_pairs(3))
+        self.assertEqual(expected, self.stored_pairs(4, prefix_filtered))
+
+    def test_shards(self):
+        shards = shard_new_ids(range(10), 3)
+        self.assertEqual([[0, 3, 6, 9], [1, 4, 7], [2, 5, 8]], shards)
+        self.assertEqual([[0], [1]], shard_new_ids([1, 0], 4))
+
+
+class TestHierarchyState(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.docs = synthetic_docs()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def ingest(self, doc_ids):
+        docs = dict((id, phrases) for (id, phrases) in self.docs.iteritems() if id < max(doc_ids) + 1)
+        write_similarities(0, docs, doc_ids, 0.5, exhaustive, 1, self.root)
+        return numpy.array(sorted(docs), numpy.int32)
+
+    def clusters(self, hierarchy):
+        result = set()
+        def walk_clusters(h):
+            for cluster in h:
+                result.add((cluster['cutoff'], cluster['size'], frozenset(cluster['members']), frozenset(c['name'] for c in cluster['children'])))
+                self.assertEqual(cluster['size'], len(cluster['members']))
+                walk_clusters(cluster['children'])
+        walk_clusters(hierarchy)
+        return result
+
+    def test_incremental(self):
+        old_ids = self.ingest(range(200))
+        state = replay_similarities(0, old_ids, self.root)
+        state.save(0, self.root)
+        old_h = state.hierarchy(STORED_SIMILARITY_CUTOFFS)
+        for cluster in old_h:
+            cluster['phrases'] = ['summary']
+
+        doc_ids = self.ingest(range(200, 240))
+        state = HierarchyState.load(0, self.root).updated(0, doc_ids, self.root)
+        h = state.hierarchy(STORED_SIMILARITY_CUTOFFS, old_h)
+
+        full = replay_similarities(0, doc_ids, self.root)
+        self.assertEqual(self.clusters(full.hierarchy(STORED_SIMILARITY_CUTOFFS)), self.clusters(h))
+
+        # only the clusters of the last template changed
+        reused = [c for c in h if c['phrases'] is not None]
+        self.assertTrue(len(reused) > 0)
+        self.assertTrue(all(c['members'][0] < 198 for c in reused))
+        self.assertTrue(all(c in old_h for c in reused))
+        self.assertTrue(any(c['phrases'] is None for c in h))
+
+        # nothing new to merge
+        self.assertEqual(self.clusters(h), self.clusters(state.updated(0, doc_ids, self.root).hierarchy(STORED_SIMILARITY_CUTOFFS)))
+
+    def test_compact(self):
+        old_ids = self.ingest(range(200))
+        state = replay_similarities(0, old_ids, self.root)
+        old_h = state.hierarchy(STORED_SIMILARITY_CUTOFFS)
+        old_h[0]['phrases'] = [u'caf\xe9', 'b']
+
+        # reused clusters keep their member order, which is still a slice of their parents'
+        doc_ids = self.ingest(range(200, 240))
+        h = replay_similarities(0, doc_ids, self.root).hierarchy(STORED_SIMILARITY_CUTOFFS, old_h)
+
+        compact = CompactHierarchy.from_hierarchy(h)
+        self.assertEqual(sum(c['size'] for c in h), len(compact.members))
+        self.assertEqual(h, compact.to_d3())
+        self.assertEqual(h[0]['members'], compact.cluster_members(0).tolist())
+
+        compact.save(0, self.root)
+        loaded = CompactHierarchy.load(0, self.root)
+        self.assertTrue(isinstance(loaded.members, numpy.memmap))
+        self.assertEqual(h, loaded.to_d3())
+        self.assertEqual([], CompactHierarchy.fromstring(CompactHierarchy.from_hierarchy([]).tostring()).to_d3())
+
+        CompactHierarchy.remove(0, self.root)
+        self.assertEqual(None, CompactHierarchy.load(0, self.root))
+
+        child = {'name': 3, 'size': 2, 'members': [3, 7], 'children': [], 'cutoff': 0.9, 'phrases': None}
+        self.assertRaises(ValueError, CompactHierarchy.from_hierarchy,
+                          [{'name': 1, 'size': 3, 'members': [3, 1, 7], 'children': [child], 'cutoff': 0.5, 'phrases': None}])
+
+    def test_cutoffs(self):
+        doc_ids = self.ingest(range(240))
+        replay_similarities(0, doc_ids, self.root).save(0, self.root)
+        state = HierarchyState.load(0, self.root)
+
+        members = lambda h, cutoff: set(frozenset(c['members']) for c in h if c['cutoff'] == cutoff)
+        def flatten(h):
+            return h + [c for cluster in h for c in flatten(cluster['children'])]
+
+        full = flatten(state.hierarchy(STORED_SIMILARITY_CUTOFFS))
+        partial = flatten(state.hierarchy([0.8, 0.6]))
+        self.assertEqual(members(full, 0.8), members(partial, 0.8))
+        self.assertEqual(members(full, 0.6), members(partial, 0.6))
+        self.assertEqual(set([0.8, 0.6]), set(c['cutoff'] for c in partial))
+
+        # only bucketed similarities are stored
+        self.assertEqual(state.labels(0.8).tolist(), state.labels(0.75).tolist())
+        self.assertNotEqual(state.labels(0.8).tolist(), state.labels(0.7).tolist())
+        self.assertEqual(range(240), state.labels(1.0).tolist())
+
+    def test_zlib(self):
+        doc_ids = self.ingest(range(240))
+        lz4_state = replay_similarities(0, doc_ids, self.root)
+
+        zlib_root = os.path.join(self.root, 'zlib')
+        os.mkdir(zlib_root)
+        with SimilarityWriter(0, zlib_root) as w:
+            for (x, y, s) in LZ4SimilarityReader(0, self.root):
+                w.write(x, y, s)
+        zlib_state = replay_similarities(0, doc_ids, zlib_root)
+
+        self.assertEqual(None, zlib_state.applied)
+        for cutoff in STORED_SIMILARITY_CUTOFFS:
+            self.assertEqual(lz4_state.labels(cutoff).tolist(), zlib_state.labels(cutoff).tolist())
+
+    def test_store_formats(self):
+        for format in ['pairs', 'delta', 'scored']:
+            HierarchyState.remove(0, self.root)
+            shutil.rmtree(os.path.join(self.root, '0'), ignore_errors=True)
+
+            old_ids = self.ingest(range(200))
+            lz4_state = replay_similarities(0, old_ids, self.root)
+            convert(0, format, self.root)
+            self.assertEqual(format, store_format(0, self.root))
+
+            state = replay_similarities(0, old_ids, self.root)
+            for cutoff in STORED_SIMILARITY_CUTOFFS:
+                self.assertEqual(lz4_state.labels(cutoff).tolist(), state.labels(cutoff).tolist())
+            state.save(0, self.root)
+
+            # later similarities are added in the same format
+            doc_ids = self.ingest(range(200, 240))
+            self.assertEqual(format, store_format(0, self.root))
+            state = HierarchyState.load(0, self.root).updated(0, doc_ids, self.root)
+            full = replay_similarities(0, doc_ids, self.root)
+            self.assertEqual(full.applied, state.applied)
+            self.assertEqual(self.clusters(full.hierarchy(STORED_SIMILARITY_CUTOFFS)), self.clusters(state.hierarchy(STORED_SIMILARITY_CUTOFFS)))
+
+    def test_scored_cutoffs(self):
+        doc_ids = self.ingest(range(240))
+        self.assertRaises(ValueError, lambda: replay_similarities(0, doc_ids, self.root, cutoffs=[0.75]))
+
+        shutil.rmtree(os.path.join(self.root, '0'))
+        default_format = bsims.DEFAULT_STORE_FORMAT
+        try:
+            bsims.DEFAULT_STORE_FORMAT = 'scored'
+            self.ingest(range(240))
+        finally:
+            bsims.DEFAULT_STORE_FORMAT = default_format
+        self.assertEqual('scored', store_format(0, self.root))
+
+        stored = list(ScoredLZ4SimilarityReader(0, self.root))
+        state = replay_similarities(0, doc_ids, self.root, cutoffs=[0.95, 0.75, 0.55])
+        self.assertEqual(None, state.applied)
+        members = lambda labels: set(frozenset(doc_ids[labels == root].tolist()) for root in numpy.unique(labels))
+        for cutoff in [0.95, 0.75, 0.55]:
+            partition = Partition(doc_ids.tolist())
+            for (x, y, s) in stored:
+                if s >= cutoff:
+                    partition.merge(x, y)
+            self.assertEqual(set(frozenset(s) for s in partition.sets()), members(state.labels(cutoff)))
+
+        # the stored cutoffs give the same clusters as bucketed stores
+        bucketed = replay_similarities(0, doc_ids, self.root)
+        for cutoff in STORED_SIMILARITY_CUTOFFS:
+            self.assertEqual(members(bucketed.labels(cutoff)), members(replay_similarities(0, doc_ids, self.root, cutoffs=[cutoff]).labels(cutoff)))
+
+    def test_scored_steps(self):
+        default_format = bsims.DEFAULT_STORE_FORMAT
+        try:
+            bsims.DEFAULT_STORE_FORMAT = 'scored'
+            old_ids = self.ingest(range(200))
+            replay_similarities(0, old_ids, self.root).save(0, self.root)
+            doc_ids = self.ingest(range(200, 240))
+        finally:
+            bsims.DEFAULT_STORE_FORMAT = default_format
+
+        # the default replay has a level per score step, so it can be cut at any cutoff
+        stored = list(ScoredLZ4SimilarityReader(0, self.root))
+        full = replay_similarities(0, doc_ids, self.root)
+        members = lambda labels: set(frozenset(doc_ids[labels == root].tolist()) for root in numpy.unique(labels))
+        for cutoff in [0.95, 0.75, 0.55]:
+            partition = Partition(doc_ids.tolist())
+            for (x, y, s) in stored:
+                if s >= cutoff:
+                    partition.merge(x, y)
+            self.assertEqual(set(frozenset(s) for s in partition.sets()), members(full.labels(cutoff)))
+
+        # and keeps them when updated
+        state = HierarchyState.load(0, self.root).updated(0, doc_ids, self.root)
+        self.assertEqual(full.applied, state.applied)
+        self.assertEqual(full.height.tolist(), state.height.tolist())
+        for cutoff in [0.95, 0.75, 0.55] + STORED_SIMILARITY_CUTOFFS:
+            self.assertEqual(full.labels(cutoff).tolist(), state.labels(cutoff).tolist())
+
+    def test_deletion(self):
+        doc_ids = self.ingest(range(100))
+        replay_similarities(0, doc_ids, self.root).save(0, self.root)
+        self.assertEqual(None, HierarchyState.load(0, self.root).updated(0, doc_ids[1:], self.root))
+
+        # similarities of deleted documents are skipped until they're compacted away
+        remove_documents(0, range(10, 30), self.root)
+        live_ids = numpy.array([id for id in doc_ids if not 10 <= id < 30], numpy.int32)
+        state = replay_similarities(0, live_ids, self.root)
+        state.save(0, self.root)
+        compact(0, self.root)
+        self.assertEqual(None, HierarchyState.load(0, self.root).updated(0, live_ids, self.root))
+        compacted = replay_similarities(0, live_ids, self.root)
+        for cutoff in STORED_SIMILARITY_CUTOFFS:
+            self.assertEqual(state.labels(cutoff).tolist(), compacted.labels(cutoff).tolist())
+
+        HierarchyState.remove(0, self.root)
+        self.assertEqual(None, HierarchyState.load(0, self.root))
+
+    def test_deletion_reuse(self):
+        old_ids = self.ingest(range(200))
+        old_h = replay_similarities(0, old_ids, self.root).hierarchy(STORED_SIMILARITY_CUTOFFS)
+        leaves = []
+        def walk_clusters(h):
+            for cluster in h:
+                cluster['phrases'] = ['summary']
+                if not cluster['children']:
+                    leaves.append(cluster)
+                walk_clusters(cluster['children'])
+        walk_clusters(old_h)
+
+        # a document other than a leaf's root is deleted and inserted again under a new ID,
+        # so the leaf keeps its cutoff, root and size
+        deleted = max(leaves[0]['members'])
+        remove_documents(0, [deleted], self.root)
+        self.docs[200] = self.docs.pop(deleted)
+        doc_ids = numpy.array(sorted(self.docs), numpy.int32)
+        write_similarities(0, self.docs, [200], 0.5, exhaustive, 1, self.root)
+
+        state = replay_similarities(0, doc_ids, self.root)
+        h = state.hierarchy(STORED_SIMILARITY_CUTOFFS, old_h)
+        self.assertEqual(self.clusters(state.hierarchy(STORED_SIMILARITY_CUTOFFS)), self.clusters(h))
+
+        def flatten(h):
+            return h + [c for cluster in h for c in flatten(cluster['children'])]
+        leaf = [c for c in flatten(h) if (c['cutoff'], c['name']) == (leaves[0]['cutoff'], leaves[0]['name'])][0]
+        self.assertEqual(leaves[0]['size'], leaf['size'])
+        self.assertTrue(200 in leaf['members'] and deleted not in leaf['members'])
+        # neither it nor the clusters above it keep their old summaries
+        self.assertTrue(all(c['phrases'] is None for c in flatten(h) if 200 in c['members']))
+
+
 class TestAnalysis(DBTestCase):
     
     def test_basic(self):
@@ -325,6 +856,30 @@ class TestAnalysis(DBTestCase):
         overlap = self.corpus.phrase_overlap(2, [id for (id, _) in self.corpus.similar_docs(2, 0.4)])
         self.assertEqual({4: {'count': 1L, 'indexes': '{"(38,63)"}'}}, overlap)
 
+    def test_summaries_rescored(self):
+        def hierarchy(phrases=None):
+            return [{'cutoff': 0.9, 'name': 0, 'size': 2, 'members': [0, 1], 'children': [], 'phrases': phrases}]
+
+        i = DocumentIngester(self.corpus, compute_similarities=False)
+        i.ingest(["Alpha beta. Gamma delta.", "Alpha beta. Gamma delta."])
+        try:
+            old = hierarchy()
+            self.corpus._add_representative_phrases(old, limit=1, refresh=True)
+
+            # the cluster is unchanged, but its first phrase is now common elsewhere
+            i.ingest(["Alpha beta.", "Alpha beta."])
+            reused = hierarchy(old[0]['phrases'])
+            self.corpus._add_representative_phrases(reused, limit=1, refresh=True)
+
+            ClusterSummaries.remove(self.corpus.id)
+            fresh = hierarchy()
+            self.corpus._add_representative_phrases(fresh, limit=1, refresh=True)
+
+            self.assertEqual(fresh[0]['phrases'], reused[0]['phrases'])
+            self.assertNotEqual(old[0]['phrases'], reused[0]['phrases'])
+        finally:
+            ClusterSummaries.remove(self.corpus.id)
+
 class TestRealData(DBTestCase):
 
     def test_multiline_doc(self):
@@ -380,6 +935,43 @@ class TestRealData(DBTestCase):
         self.assertEqual(u'This has a bad \ufffdharacter.', self.cursor.fetchone()[0])
 
 
+class TestBinaryCopy(TestCase):
+
+    def test_writer(self):
+        f = StringIO()
+        w = pgcopy.BinaryCopyWriter(f, [pgcopy.encode_integer, pgcopy.encode_text])
+        w.writerow((1, u'\xe9'))
+        w.writerow((-2, None))
+        w.close()
+
+        self.assertEqual(pgcopy.HEADER
+                         + '\x00\x02' + '\x00\x00\x00\x04\x00\x00\x00\x01' + '\x00\x00\x00\x02\xc3\xa9'
+                         + '\x00\x02' + '\x00\x00\x00\x04\xff\xff\xff\xfe' + '\xff\xff\xff\xff'
+                         + '\xff\xff', f.getvalue())
+
+    def test_occurrences(self):
+        # the fast path packs the same bytes as the generic encoders
+        rows = [(3, 4, 5, [(0, 10)]), (3, 4, 6, [(1, 2), (30, 40), (50, 60)]), (3, 4, 7, [])]
+
+        generic = StringIO()
+        w = pgcopy.BinaryCopyWriter(generic, [pgcopy.encode_integer] * 3 + [pgcopy.int_bounds_array_encoder(99)])
+        fast = StringIO()
+        o = pgcopy.occurrence_writer(fast, 99)
+        for row in rows:
+            w.writerow(row)
+            o.writerow(row)
+
+        self.assertEqual(generic.getvalue(), fast.getvalue())
+
+        self.assertEqual(struct.pack('>iiiii', 1, 0, 99, 1, 1) + struct.pack('>iiiiiiii', 28, 2, 23, 4, 0, 23, 4, 10),
+                         pgcopy.int_bounds_array_encoder(99)([(0, 10)]))
+
+    def test_hstore(self):
+        self.assertEqual('\x00\x00\x00\x01' + '\x00\x00\x00\x01k' + '\xff\xff\xff\xff', pgcopy.encode_hstore({'k': None}))
+        # surrogates are replaced, as in CSV uploads
+        self.assertEqual('\xef\xbf\xbd', pgcopy.encode_text(u'\ud800'))
+
+
 class TestBinarySearch(TestCase):
     
     def test(self):
@@ -407,6 +999,138 @@ class TestBinarySearch(TestCase):
         self.assertEqual(5, binary_search([2, 2, 2, 2, 1], 1))
         
 
+class TestClusterTopPhrases(TestCase):
+
+    def test_matches_dense(self):
+        random = Random(0)
+        num_phrases = 60
+        occurrences = sorted(set((random.randint(0, 99), random.randint(0, num_phrases - 1)) for _ in range(1500)))
+        # documents 100-109 have no phrases, and phrases 50-59 occur in few documents
+        occurrences = [(d, p) for (d, p) in occurrences if p < 50 or d < 3]
+        clusters = [random.sample(range(110), random.randint(2, 40)) for _ in range(30)] + [[100, 101], [0, 105]]
+
+        # the original dense computation
+        totals = numpy.zeros(num_phrases, 'f')
+        for (d, p) in occurrences:
+            totals[p] += 1.0
+        expected = []
+        for members in clusters:
+            counts = numpy.zeros(num_phrases, 'f')
+            for (d, p) in occurrences:
+                if d in members:
+                    counts[p] += 1.0
+            expected.append(wirth_n_largest(counts / (float(len(members)) + totals - counts), 5).tolist())
+
+        top = cluster_top_phrases(clusters, numpy.array(occurrences), num_phrases, 5)
+        self.assertEqual(expected, [phrases.tolist() for phrases in top])
+        self.assertEqual([0, 1, 2, 3, 4], top[-2].tolist())
+
+
+class TestClusterSummaries(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_summaries(self):
+        summaries = ClusterSummaries.empty(2)
+        summaries.add_documents([1, 2], [(1, 30), (1, 10), (2, 30)])
+        summaries.add_documents([3], [(3, 20), (3, 30)])
+        self.assertEqual([1, 2, 3], summaries.doc_ids.tolist())
+        self.assertEqual([10, 30, 20], summaries.phrase_ids.tolist())
+        self.assertEqual([1, 3, 1], summaries.doc_freqs.tolist())
+        self.assertEqual([1, 0, 2], summaries.phrase_indexes([30, 10, 20]).tolist())
+
+        cluster = {'cutoff': 0.9, 'name': 1, 'size': 2}
+        other = {'cutoff': 0.8, 'name': 1, 'size': 3}
+        self.assertEqual(None, summaries.phrases(cluster))
+        summaries.set_phrases(cluster, [30, 10])
+        summaries.set_phrases(other, [20, 30])
+        summaries.phrase_text.update({10: 'ten', 20: u'twenty \xe9', 30: 'thirty'})
+
+        summaries.save(0, self.root)
+        loaded = ClusterSummaries.load(0, self.root)
+        self.assertEqual(['thirty', 'ten'], loaded.phrases(cluster))
+        self.assertEqual(None, loaded.phrases(dict(cluster, size=3)))
+        self.assertEqual([1, 3, 1], loaded.doc_freqs.tolist())
+
+        loaded.retain([cluster])
+        self.assertEqual(None, loaded.phrases(other))
+        self.assertEqual([10, 30], sorted(loaded.phrase_text))
+
+        ClusterSummaries.remove(0, self.root)
+        self.assertEqual(None, ClusterSummaries.load(0, self.root))
+
+
+class TestHierarchyCache(TestCase):
+
+    def setUp(self):
+        self.backend = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='test-hierarchy-cache')
+        self.backend.clear()
+        self.cutoffs = [0.9, 0.5]
+        child = {'name': 3, 'size': 2, 'members': [3, 7], 'children': [], 'cutoff': 0.9, 'phrases': None}
+        self.h = [{'name': 1, 'size': 4, 'members': [3, 7, 1, 2], 'children': [child], 'cutoff': 0.5, 'phrases': [u'caf\xe9', 'b']},
+                  {'name': 5, 'size': 2, 'members': [5, 6], 'children': [], 'cutoff': 0.5, 'phrases': None}]
+
+    def test_serialize(self):
+        self.assertEqual(self.h, deserialize(serialize(self.h)))
+        self.assertEqual([], deserialize(serialize([])))
+
+    def test_fetch(self):
+        computed = []
+        def compute():
+            computed.append(True)
+            return self.h
+
+        workers = [HierarchyCache(self.backend, lru_size=1), HierarchyCache(self.backend, lru_size=1)]
+        (generation, h) = workers[0].fetch(0, self.cutoffs, compute)
+        self.assertTrue(h is self.h)
+        self.assertTrue(workers[0].fetch(0, self.cutoffs, compute)[1] is self.h)
+        self.assertEqual((generation, self.h), workers[1].fetch(0, self.cutoffs, compute))
+        self.assertEqual(1, len(computed))
+
+        # evicted from the process, but still shared
+        workers[0].fetch(1, self.cutoffs, lambda: [])
+        self.assertEqual(self.h, workers[0].fetch(0, self.cutoffs, compute)[1])
+        self.assertEqual(1, len(computed))
+
+        # while one worker computes the new generation, the others get the old one
+        workers[0].invalidate(0)
+        new_h = self.h[:1]
+        def compute_new():
+            self.assertEqual((generation, self.h), workers[1].fetch(0, self.cutoffs, compute))
+            return new_h
+        (new_generation, h) = workers[0].fetch(0, self.cutoffs, compute_new)
+        self.assertTrue(new_generation > generation)
+        self.assertEqual((new_generation, new_h), workers[1].fetch(0, self.cutoffs, compute))
+
+        newer_generation = workers[1].publish(0, self.cutoffs, self.h)
+        self.assertEqual((newer_generation, self.h), workers[0].fetch(0, self.cutoffs, compute))
+
+        workers[0].invalidate(0, keep_stale=False)
+        self.assertEqual(None, workers[1].latest(0, self.cutoffs))
+        self.assertEqual(1, len(computed))
+
+
+class TestPairCodec(TestCase):
+
+    def test_varints(self):
+        values = numpy.array([0, 1, 127, 128, 300, 2 ** 14, 2 ** 32, 2 ** 35 - 1], numpy.uint64)
+        encoded = encode_varints(values)
+        self.assertEqual([0, 1, 127, 128, 1], encoded[:5].tolist())
+        self.assertEqual(values.tolist(), decode_varints(encoded).tolist())
+
+    def test_pairs(self):
+        random = Random(0)
+        for pairs in [[], [(5, 3)], [(5, 3), (5, 3), (5, 9), (1, 2), (2 ** 32 - 1, 0), (0, 2 ** 32 - 1)],
+                      [(random.randint(0, 1000), random.randint(0, 1000)) for _ in range(1000)]]:
+            decoded = decode_pairs(encode_pairs(numpy.array(pairs, numpy.uint32)))
+            self.assertEqual(numpy.uint32, decoded.dtype)
+            self.assertEqual(sorted(pairs), [tuple(p) for p in decoded.tolist()])
+
+
 class TestBufferedCompressedIO(TestCase):
 
     def assertReadWriterConsistent(self, value, buffer_size=1000000):
@@ -484,5 +1208,153 @@ class TestBufferedCompressedIO(TestCase):
                         values)
 
 
+    def test_sim_chunks(self):
+        root = tempfile.mkdtemp()
+        try:
+            for (Writer, Reader) in [(SimilarityWriter, SimilarityReader), (LZ4SimilarityWriter, LZ4SimilarityReader), (PairsSimilarityWriter, PairsSimilarityReader),
+                                     (DeltaLZ4SimilarityWriter, DeltaLZ4SimilarityReader)]:
+                shutil.rmtree(os.path.join(root, '0'), ignore_errors=True)
+                with Writer(0, root) as w:
+                    w.write(1, 2, 0.95)
+                    w.write_pairs(0.9, numpy.array([[1, 3], [1, 4]]))
+                    w.write_pairs(0.6, numpy.array([[5, 6]]))
+                    w.write(3, 4, 0.4)
+
+                chunks = [(cutoff, sorted(map(tuple, pairs.tolist()))) for (cutoff, pairs) in Reader(0, root).iter_chunks() if len(pairs)]
+                self.assertEqual([(0.9, [(1, 2), (1, 3), (1, 4)]), (0.6, [(5, 6)])], chunks)
+                self.assertEqual([(1, 2, .9 + .05), (1, 3, .9 + .05), (1, 4, .9 + .05), (5, 6, .6 + .05)], sorted(Reader(0, root)))
+
+                remove_documents(0, [3, 6, 7], root)
+                self.assertEqual([(1, 2, .9 + .05), (1, 4, .9 + .05)], sorted(Reader(0, root)))
+                self.assertEqual(7, max_deleted_id(0, root))
+
+                self.assertTrue(compact(0, root))
+                self.assertEqual(None, read_tombstones(0, root))
+                self.assertEqual([(1, 2, .9 + .05), (1, 4, .9 + .05)], sorted(Reader(0, root)))
+                self.assertEqual(2, sum(len(pairs) for (_, pairs) in Reader(0, root).iter_chunks()))
+
+                for format in ['lz4', 'pairs', 'delta', 'zlib']:
+                    convert(0, format, root)
+                    self.assertEqual(format, store_format(0, root))
+                    self.assertEqual([(1, 2, .9 + .05), (1, 4, .9 + .05)], sorted(get_similarity_reader(0, root)))
+        finally:
+            shutil.rmtree(root)
+
+    def test_manifest(self):
+        root = tempfile.mkdtemp()
+        try:
+            for chunk in ([[1, 2], [2, 3]], [[10, 11]], [[20, 21], [20, 22], [21, 30]]):
+                with LZ4SimilarityWriter(0, root) as w:
+                    w.write_pairs(0.9, numpy.array(chunk))
+            chunk_dir = os.path.join(root, '0', '9.lz4sims')
+
+            manifest = read_manifest(chunk_dir)
+            self.assertEqual(['0.lz4', '1.lz4', '2.lz4'], [c['name'] for c in manifest['chunks']])
+            self.assertEqual([(2, 1, 3), (1, 10, 11), (3, 20, 30)], [(c['pairs'], c['min_id'], c['max_id']) for c in manifest['chunks']])
+            self.assertEqual(3, manifest['next'])
+            self.assertEqual((0.9, 6, sum(os.path.getsize(os.path.join(chunk_dir, c['name'])) for c in manifest['chunks'])), store_size(0, root)[0])
+            self.assertEqual((0.8, 0, 0), store_size(0, root)[1])
+
+            # only chunks that can hold the documents are read
+            os.unlink(os.path.join(chunk_dir, '1.lz4'))
+            self.assertEqual([[2, 3], [20, 22]], [p for (_, pairs) in LZ4SimilarityReader(0, root).iter_chunks([3, 22]) for p in pairs.tolist()])
+
+            # stores written before manifests get one on the next write
+            os.unlink(os.path.join(chunk_dir, 'manifest.json'))
+            with LZ4SimilarityWriter(0, root) as w:
+                w.write_pairs(0.9, numpy.array([[40, 41]]))
+            self.assertEqual(['0.lz4', '2.lz4', '3.lz4'], [c['name'] for c in read_manifest(chunk_dir)['chunks']])
+
+            with open(os.path.join(chunk_dir, '3.lz4'), 'r+') as f:
+                f.seek(-1, os.SEEK_END)
+                f.write('x')
+            self.assertRaises(IOError, lambda: list(LZ4SimilarityReader(0, root)))
+        finally:
+            shutil.rmtree(root)
+
+    def test_scored_store(self):
+        root = tempfile.mkdtemp()
+        (memory, chunk_pairs) = (bsims.COMPACTION_MEMORY, bsims.COMPACTED_CHUNK_PAIRS)
+        try:
+            (bsims.COMPACTION_MEMORY, bsims.COMPACTED_CHUNK_PAIRS) = (32 * 50, 70)
+
+            random = Random(0)
+            pairs = random.sample([(x, y) for x in range(40) for y in range(x + 1, 40)], 300)
+            scored = [(x, y, random.randint(80, 200) / 200.0) for (x, y) in pairs]
+            for start in range(0, 300, 100):
+                with ScoredLZ4SimilarityWriter(0, root) as w:
+                    for (x, y, s) in scored[start:start + 100]:
+                        w.write(x, y, s)
+            expected = sorted((x, y, s) for (x, y, s) in scored if s >= 0.5)
+            self.assertEqual('scored', store_format(0, root))
+            self.assertEqual(expected, sorted(ScoredLZ4SimilarityReader(0, root)))
+
+            # pairs of other stores are stored at their cutoff
+            with ScoredLZ4SimilarityWriter(0, root) as w:
+                w.write_pairs(0.9, numpy.array([[50, 51]]))
+            low_chunk = os.path.join(root, '0', '9.slz4sims', read_manifest(os.path.join(root, '0', '9.slz4sims'))['chunks'][-1]['name'])
+            self.assertEqual([(50, 51, 0.9)], [(x, y, s) for (x, y, s) in ScoredLZ4SimilarityReader(0, root) if x == 50])
+            expected.append((50, 51, 0.9))
+
+            # chunks are only read as far as the range needs, and not at all if it's out of their range
+            reader = ScoredLZ4SimilarityReader(0, root)
+            self.assertTrue(low_chunk in reader.scored_files(0.9))
+            self.assertFalse(low_chunk in reader.scored_files(0.905))
+            self.assertFalse(any('/8.slz4sims/' in path for path in reader.scored_files(0.9)))
+            for (similarities, _) in reader.iter_scored_chunks(0.5):
+                self.assertEqual(sorted(similarities.tolist(), reverse=True), similarities.tolist())
+            between = [(x, y, s) for (similarities, chunk) in reader.iter_scored_chunks(0.73, 0.9) for ((x, y), s) in zip(chunk.tolist(), similarities.tolist())]
+            self.assertEqual([(x, y, s) for (x, y, s) in expected if 0.73 <= s < 0.9], sorted(between))
+            self.assertEqual([(x, y, s) for (x, y, s) in expected if s >= 0.73 and 3 in (x, y)],
+                             sorted((x, y, s) for (similarities, chunk) in reader.iter_scored_chunks(0.73, doc_ids=[3]) for ((x, y), s) in zip(chunk.tolist(), similarities.tolist())))
+
+            # compaction keeps the scores, and sorts each bucket by them
+            remove_documents(0, [7, 8], root)
+            expected = [(x, y, s) for (x, y, s) in expected if 7 not in (x, y) and 8 not in (x, y)]
+            self.assertEqual(expected, sorted(ScoredLZ4SimilarityReader(0, root)))
+            self.assertTrue(compact(0, root))
+            self.assertEqual(expected, sorted(ScoredLZ4SimilarityReader(0, root)))
+            for i in range(len(STORED_SIMILARITY_CUTOFFS)):
+                chunks = read_manifest(os.path.join(root, '0', '%s.slz4sims' % (9 - i)))['chunks']
+                self.assertTrue(all(c['pairs'] <= 70 for c in chunks))
+                self.assertTrue(all(a['min_score'] >= b['max_score'] for (a, b) in zip(chunks, chunks[1:])))
+        finally:
+            (bsims.COMPACTION_MEMORY, bsims.COMPACTED_CHUNK_PAIRS) = (memory, chunk_pairs)
+            shutil.rmtree(root)
+
+    def test_compaction(self):
+        root = tempfile.mkdtemp()
+        (memory, chunk_pairs) = (bsims.COMPACTION_MEMORY, bsims.COMPACTED_CHUNK_PAIRS)
+        try:
+            # small enough to spill several runs
+            (bsims.COMPACTION_MEMORY, bsims.COMPACTED_CHUNK_PAIRS) = (32 * 50, 70)
+
+            random = Random(0)
+            expected = set()
+            for _ in range(bsims.MAX_CHUNKS + 1):
+                with LZ4SimilarityWriter(0, root) as w:
+                    pairs = [tuple(random.sample(range(100), 2)) for _ in range(20)]
+                    w.write_pairs(0.7, numpy.array(pairs + pairs[:5]))
+                expected.update((min(p), max(p)) for p in pairs)
+            self.assertTrue(needs_compaction(0, root))
+
+            remove_documents(0, [7, 8], root)
+            expected = set(p for p in expected if 7 not in p and 8 not in p)
+
+            self.assertTrue(compact(0, root))
+            self.assertFalse(needs_compaction(0, root))
+
+            chunk_dir = os.path.join(root, '0', '7.lz4sims')
+            chunks = read_manifest(chunk_dir)['chunks']
+            self.assertEqual((len(expected) + 69) / 70, len(chunks))
+            self.assertEqual(sorted(c['min_id'] for c in chunks), [c['min_id'] for c in chunks])
+
+            stored = [p for (_, pairs) in LZ4SimilarityReader(0, root).iter_chunks() for p in pairs.tolist()]
+            self.assertEqual(sorted(expected), [tuple(p) for p in stored])
+        finally:
+            (bsims.COMPACTION_MEMORY, bsims.COMPACTED_CHUNK_PAIRS) = (memory, chunk_pairs)
+            shutil.rmtree(root)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,10 @@
 from datetime import datetime
 import csv
+import errno
+import fcntl
+import json
 import re
+import tempfile
 from cStringIO import StringIO
 import zlib
 import lz4
@@ -12,6 +16,15 @@ except ImportError:
 
 from django.conf import settings
 
+def ensure_dir(path):
+    """Create directory path unless it exists. Safe against concurrent creation."""
+
+    try:
+        os.mkdir(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
 def execute_file(cursor, filename):
     contents = " ".join([line for line in open(filename, 'r') if line[0:2] != '--'])
     statements = contents.split(';')[:-1] # split on semi-colon. Last element will be trailing whitespace
@@ -87,13 +100,97 @@ class BufferedCompressedWriter(object):
         self.outputstream.flush()
         self.compressor = None
 
+def _chunk_number(name):
+    return int(name.split('.')[0])
+
+def _manifest_path(dir):
+    return os.path.join(dir, "manifest.json")
+
+def read_manifest(dir):
+    """Return the manifest of an LZ4 chunk directory, or None if it has none.
+
+    The manifest is a dict: 'chunks' lists an entry for each complete chunk
+    file, in the order they were written, with its 'name', 'bytes' of
+    compressed data, 'crc32' of those bytes, and the number of uint32
+    'pairs' and the 'min_id' and 'max_id' among them, plus any fields the
+    writer's codec describes. 'next' is the number to try first for the
+    next chunk file.
+    """
+
+    path = _manifest_path(dir)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def chunk_names(dir):
+    """Return the names of the complete chunk files of an LZ4 chunk directory, in order."""
+
+    manifest = read_manifest(dir)
+    if manifest is not None:
+        names = [str(chunk['name']) for chunk in manifest['chunks']]
+    else:
+        names = [fname for fname in os.listdir(dir) if fname.endswith('.lz4')] if os.path.isdir(dir) else []
+    return sorted(names, key=_chunk_number)
+
+def _chunk_entry(name, compressed_bytes, uncompressed_bytes, codec=None):
+    pair_bytes = codec.decode(uncompressed_bytes) if codec else uncompressed_bytes
+    values = numpy.fromstring(pair_bytes[:len(pair_bytes) - len(pair_bytes) % 4], numpy.uint32)
+    entry = dict(name=name,
+                 bytes=len(compressed_bytes),
+                 crc32=zlib.crc32(compressed_bytes) & 0xffffffff,
+                 pairs=len(values) / 2,
+                 min_id=int(values.min()) if len(values) else None,
+                 max_id=int(values.max()) if len(values) else None)
+    if hasattr(codec, 'describe'):
+        entry.update(codec.describe(uncompressed_bytes))
+    return entry
+
+def _update_manifest(dir, update, codec=None):
+    """Apply update to the directory's manifest, creating it from the chunk files if it's missing.
+
+    Changes are serialized by a lock, and the new manifest is swapped in
+    with a rename, so readers never see part of one.
+    """
+
+    with open(os.path.join(dir, "manifest.lock"), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        manifest = read_manifest(dir)
+        if manifest is None:
+            # files claimed by writers that haven't flushed yet are empty
+            chunks = []
+            for name in chunk_names(dir):
+                compressed = open(os.path.join(dir, name)).read()
+                if compressed:
+                    chunks.append(_chunk_entry(name, compressed, lz4.uncompress(compressed), codec))
+            manifest = dict(chunks=chunks, next=max([_chunk_number(c['name']) + 1 for c in chunks] or [0]))
+
+        update(manifest)
+
+        with tempfile.NamedTemporaryFile(dir=dir, suffix='.manifest', delete=False) as f:
+            json.dump(manifest, f)
+        os.rename(f.name, _manifest_path(dir))
+
+
 class LZ4CompressedWriter(BufferedCompressedWriter):
-    def __init__(self, outdir, buffer_size=_DEFAULT_BUFFER_SIZE):
+    """Writes each flush as a separate LZ4 compressed chunk file of a directory.
+
+    Every chunk is recorded in the directory's manifest once it's complete,
+    see read_manifest(). Chunks are expected to hold uint32 pairs. If given,
+    codec.encode() is applied to each chunk's bytes before compression, and
+    codec.decode() must turn the result back into uint32 pairs when reading.
+    A codec may also describe() encoded chunks with extra manifest fields.
+    """
+
+    def __init__(self, outdir, buffer_size=_DEFAULT_BUFFER_SIZE, codec=None):
         self.outputdir = outdir
-        if not os.path.exists(outdir):
-            os.mkdir(outdir)
+        self.codec = codec
+        ensure_dir(outdir)
+        # make sure chunks written before manifests existed are listed first
+        _update_manifest(outdir, lambda manifest: None, codec)
 
-        self.outputstream = open(self._get_next_file(), 'w')
+        self.outputstream = self._open_next_file()
         self.buffer_size = buffer_size
         self.buffer = StringIO()
 
@@ -104,28 +201,48 @@ class LZ4CompressedWriter(BufferedCompressedWriter):
         if len(buffered_bytes) == 0:
             # we don't want to write an empty file because decompressing it does weird things
             if keep_closed:
-                name = self.outputstream.name
                 self.outputstream.close()
-                os.unlink(name)
+                os.unlink(self.outputname)
                 return
             else:
                 # if we're still writing, this can be a noop
                 return
 
-        compressed_bytes = lz4.compressHC(buffered_bytes)
+        encoded_bytes = self.codec.encode(buffered_bytes) if self.codec else buffered_bytes
+        compressed_bytes = lz4.compressHC(encoded_bytes)
 
         self.outputstream.write(compressed_bytes)
         self.outputstream.close()
+
+        entry = _chunk_entry(os.path.basename(self.outputname), compressed_bytes, encoded_bytes, self.codec)
+        def record(manifest):
+            manifest['chunks'].append(entry)
+            manifest['next'] = max(manifest['next'], _chunk_number(entry['name']) + 1)
+        _update_manifest(self.outputdir, record, self.codec)
+
         if not keep_closed:
-            self.outputstream = open(self._get_next_file(), 'w')
+            self.outputstream = self._open_next_file()
 
     def close(self):
         self.flush(keep_closed=True)
 
     def _get_next_file(self):
-        filenums = [int(fname.split('.')[0]) for fname in os.listdir(self.outputdir) if fname.endswith('.lz4')]
-        num = max(filenums) + 1 if filenums else 0
-        return os.path.join(self.outputdir, "%s.lz4" % num)
+        return os.path.join(self.outputdir, "%s.lz4" % read_manifest(self.outputdir)['next'])
+
+    def _open_next_file(self):
+        # several processes may write chunks to the same directory,
+        # so claim the file name atomically and move on if it's taken.
+        name = self._get_next_file()
+        while True:
+            try:
+                stream = os.fdopen(os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL), 'w')
+                self.outputname = name
+                return stream
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            num = int(os.path.basename(name).split('.')[0]) + 1
+            name = os.path.join(self.outputdir, "%s.lz4" % num)
 
 
 class BufferedCompressedReader(object):
@@ -180,8 +297,17 @@ class BufferedCompressedReader(object):
         return decompressed[:byte_count]
 
 class LZ4CompressedReader(BufferedCompressedReader):
-    def __init__(self, indir, buffer_size=_DEFAULT_BUFFER_SIZE):
+    """Reads the chunk files of an LZ4CompressedWriter's directory as one stream.
+
+    With a manifest, only complete chunks are read and their checksums are
+    verified, and chunk_filter, a predicate on manifest entries, can skip
+    chunks. codec is the writer's.
+    """
+
+    def __init__(self, indir, buffer_size=_DEFAULT_BUFFER_SIZE, chunk_filter=None, codec=None):
         self.inputdir = indir
+        self.chunk_filter = chunk_filter
+        self.codec = codec
         self.decompressed_buffer = StringIO()
         self.file_iter = self._get_file_iter()
 
@@ -191,12 +317,16 @@ class LZ4CompressedReader(BufferedCompressedReader):
     def read(self, byte_count=None):
         while self.decompressed_buffer.tell() < byte_count:
             try:
-                fname = self.file_iter.next()
+                (fname, crc32) = self.file_iter.next()
             except StopIteration:
                 break
 
             compressed = open(fname).read()
+            if crc32 is not None and zlib.crc32(compressed) & 0xffffffff != crc32:
+                raise IOError("Checksum mismatch in %s." % fname)
             new_uncompressed_bytes = lz4.uncompress(compressed) if compressed else ""
+            if self.codec and new_uncompressed_bytes:
+                new_uncompressed_bytes = self.codec.decode(new_uncompressed_bytes)
             self.decompressed_buffer.write(new_uncompressed_bytes)
 
         decompressed = self.decompressed_buffer.getvalue()
@@ -206,9 +336,13 @@ class LZ4CompressedReader(BufferedCompressedReader):
         return decompressed[:byte_count]
 
     def _get_file_iter(self):
-        filenums = sorted([int(fname.split('.')[0]) for fname in os.listdir(self.inputdir) if fname.endswith('.lz4')])
-        files = [os.path.join(self.inputdir, "%s.lz4" % num) for num in filenums]
-        return iter(files)
+        manifest = read_manifest(self.inputdir)
+        if manifest is None:
+            return iter([(os.path.join(self.inputdir, name), None) for name in chunk_names(self.inputdir)])
+
+        chunks = sorted(manifest['chunks'], key=lambda chunk: _chunk_number(chunk['name']))
+        return iter([(os.path.join(self.inputdir, chunk['name']), chunk['crc32'])
+                     for chunk in chunks if self.chunk_filter is None or self.chunk_filter(chunk)])
 
 
 def binary_search(a, x, key=None):
@@ -301,4 +435,73 @@ def wirth_n_largest(a, n):
     selected = wirthselect(a, a.size - n)
     nth = selected[-n:].min()
     maxes = [idx for idx in xrange(a.size) if a[idx] >= nth]
-    return numpy.array(sorted(maxes, key=lambda x: a[x], reverse=True)[:n])
\ No newline at end of file
+    return numpy.array(sorted(maxes, key=lambda x: a[x], reverse=True)[:n])
+
+
+def cluster_top_phrases(clusters, occurrences, num_phrases, n, doc_freqs=None):
+    """Return the indexes of each cluster's n most representative phrases, best first.
+
+    clusters is a list of arrays of member document IDs, and occurrences a
+    (k, 2) array of distinct (document ID, phrase index) rows, phrase indexes
+    being below num_phrases. A phrase scores the number of members it occurs
+    in over the size of the union of the members and all the documents it
+    occurs in, computed in float32. doc_freqs, the number of documents each
+    phrase occurs in, defaults to the count in occurrences, which then must
+    include every document's rows. Ties go to the lower index, as in
+    wirth_n_largest(), so phrases that don't occur in a cluster fill out its
+    list in index order.
+
+    Counts come from a product of sparse cluster x document and document x
+    phrase indicator matrices, so memory grows with the counts that aren't
+    zero. Requires SciPy.
+    """
+
+    import scipy.sparse
+
+    occurrences = numpy.asarray(occurrences, numpy.int64).reshape(-1, 2)
+    members = numpy.concatenate([numpy.asarray(m, numpy.int64) for m in clusters] + [numpy.zeros(0, numpy.int64)])
+    rows = numpy.repeat(numpy.arange(len(clusters)), [len(m) for m in clusters])
+
+    # documents are columns of the membership matrix, looked up in a table
+    # indexed by ID if IDs are mostly dense, as in NumpyPartition
+    ids = numpy.concatenate([occurrences[:, 0], members])
+    low = ids.min() if len(ids) else 0
+    span = ids.max() - low + 1 if len(ids) else 0
+    if span <= 4 * len(ids) + 1024:
+        (num_docs, positions) = (span, ids - low)
+    else:
+        (doc_ids, positions) = numpy.unique(ids, return_inverse=True)
+        num_docs = len(doc_ids)
+    (occurrence_docs, member_docs) = (positions[:len(occurrences)], positions[len(occurrences):])
+
+    membership = scipy.sparse.csr_matrix(
+        (numpy.ones(len(members), numpy.int32), (rows, member_docs)),
+        shape=(len(clusters), num_docs))
+    phrases = scipy.sparse.csr_matrix(
+        (numpy.ones(len(occurrences), numpy.int32), (occurrence_docs, occurrences[:, 1])),
+        shape=(num_docs, num_phrases))
+    counts = membership.dot(phrases).tocsr()
+
+    if doc_freqs is None:
+        doc_freqs = numpy.bincount(occurrences[:, 1], minlength=num_phrases)
+    totals = numpy.asarray(doc_freqs).astype(numpy.float32)
+    sizes = numpy.array([len(m) for m in clusters], numpy.float32)
+
+    top = []
+    for i in xrange(len(clusters)):
+        columns = counts.indices[counts.indptr[i]:counts.indptr[i + 1]]
+        in_cluster = counts.data[counts.indptr[i]:counts.indptr[i + 1]].astype(numpy.float32)
+        scores = in_cluster / (sizes[i] + totals[columns] - in_cluster)
+
+        if len(scores) > n:
+            # everything tied with the nth largest score is a candidate
+            nth = scores[numpy.argpartition(scores, len(scores) - n)[len(scores) - n]]
+            (columns, scores) = (columns[scores >= nth], scores[scores >= nth])
+        best = columns[numpy.lexsort((columns, -scores))[:n]]
+
+        if len(best) < n:
+            zeros = numpy.setdiff1d(numpy.arange(min(num_phrases, len(columns) + n)), columns)
+            best = numpy.concatenate([best, zeros[:n - len(best)]])
+        top.append(best)
+
+    return top